@@ -16,10 +16,9 @@ __author__ = 'mbforbes'
 
 # Builtins
 from collections import OrderedDict
-import yaml
 
 # Local
-from util import Fs
+from util import Fs, Yaml
 
 
 ########################################################################
@@ -29,16 +28,33 @@ from util import Fs
 DATA_DIR = Fs.data_dir()
 COMMAND_GRAMMAR = 'commands.yml'
 WORLD_DEFAULT = 'world_default.yml'
-SIDES = yaml.load(open(DATA_DIR + COMMAND_GRAMMAR))['parameters']['side']
-sm = {}
-for idx, side_name in enumerate(SIDES):
-    sm[side_name] = idx
 
 
 ########################################################################
 # Classes
 ########################################################################
 
+class FromGrammar(object):
+    '''A class attribute computed from the grammar file, which is only
+    loaded when the attribute is first used.'''
+
+    def __init__(self, fn):
+        '''
+        Args:
+            fn (function): Takes the YAML-loaded grammar, returns the
+                attribute's value.
+        '''
+        self.fn = fn
+        self.computed = False
+        self.val = None
+
+    def __get__(self, obj, cls):
+        if not self.computed:
+            self.val = self.fn(Yaml.load(DATA_DIR + COMMAND_GRAMMAR))
+            self.computed = True
+        return self.val
+
+
 class N(object):
     # Command scoring.
     MIN_SCORE = 0.1  # What to boost scores to *before* normalizing.
@@ -70,10 +86,11 @@ class C(object):
     obj_param = 'obj'
 
     # Side names
-    sides = SIDES
+    sides = FromGrammar(lambda grammar: grammar['parameters']['side'])
 
     # How to index into object properties by side
-    side_to_idx = sm
+    side_to_idx = FromGrammar(lambda grammar: {
+        side: idx for idx, side in enumerate(grammar['parameters']['side'])})
 
     # Object constants
     # ---------------
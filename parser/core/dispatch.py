@@ -0,0 +1,476 @@
+'''Machinery for using the parser without blocking the caller.
+
+    - Future:          A result that will be available later.
+    - UpdateScheduler: Runs queries and state updates in the background,
+                       queries first, collapsing bursts of updates so
+                       only the latest state is applied (rate-limited).
+    - LocalBus:        In-process stand-in for ROS topics and services.
+    - ChangeFeed:      Latest state by key, for pushing only what
+                       changed to clients (e.g. server-sent events).
+'''
+
+__author__ = 'mbforbes'
+
+
+########################################################################
+# Imports
+########################################################################
+
+# Builtins
+from collections import OrderedDict, defaultdict, deque
+import sys
+import threading
+import time
+
+
+########################################################################
+# Constants
+########################################################################
+
+# Removed keys a ChangeFeed remembers (so clients can be told of the
+# removal) before forgetting the oldest.
+FEED_MAX_REMOVED = 1000
+
+
+########################################################################
+# Classes
+########################################################################
+
+class Future(object):
+    '''The result of a call that runs on another thread.'''
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.finished = False
+        self.res = None
+        self.exc_info = None
+        self.callbacks = []
+
+    def done(self):
+        '''
+        Returns:
+            bool: Whether the result (or exception) is available.
+        '''
+        return self.finished
+
+    def result(self, timeout=None):
+        '''
+        Waits for and returns the result, re-raising any exception the
+        call raised.
+
+        Args:
+            timeout (float, optional): Seconds to wait. Defaults to None
+                (wait forever).
+
+        Returns:
+            object
+        '''
+        self.cond.acquire()
+        if timeout is None:
+            while not self.finished:
+                self.cond.wait()
+        elif not self.finished:
+            self.cond.wait(timeout)
+        finished = self.finished
+        self.cond.release()
+        if not finished:
+            raise RuntimeError('Future timed out.')
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.res
+
+    def add_done_callback(self, fn):
+        '''
+        Calls fn(self) once done (immediately if already done).
+
+        Args:
+            fn (function)
+        '''
+        self.cond.acquire()
+        finished = self.finished
+        if not finished:
+            self.callbacks += [fn]
+        self.cond.release()
+        if finished:
+            fn(self)
+
+    def set_result(self, res):
+        '''
+        Args:
+            res (object)
+        '''
+        self._finish(res, None)
+
+    def set_exception(self, exc_info):
+        '''
+        Args:
+            exc_info (tuple): As from sys.exc_info().
+        '''
+        self._finish(None, exc_info)
+
+    def _finish(self, res, exc_info):
+        '''
+        Args:
+            res (object)
+            exc_info (tuple|None)
+        '''
+        self.cond.acquire()
+        self.res = res
+        self.exc_info = exc_info
+        self.finished = True
+        callbacks = self.callbacks
+        self.callbacks = []
+        self.cond.notify_all()
+        self.cond.release()
+        for fn in callbacks:
+            fn(self)
+
+
+class UpdateScheduler(object):
+    '''
+    Runs queries and applies state updates on one background (daemon)
+    thread, which is started on first use.
+
+    - Queries (e.g. parses) run in order, and always before any pending
+        update, so a waiting parse never queues behind a rebuild.
+
+    - Updates are sets of keyword arguments for an apply function. They
+        are merged while pending (newer values win), so a burst results
+        in applying only the latest state once.
+
+    - Updates are applied at most max_rate times per second.
+    '''
+
+    def __init__(self, apply_fn, max_rate=None):
+        '''
+        Args:
+            apply_fn (function): Called with the keyword arguments of
+                the latest (merged) update. Arguments not updated since
+                the last call are omitted.
+            max_rate (float, optional): Maximum updates applied per
+                second. Defaults to None (no limit).
+        '''
+        self.apply_fn = apply_fn
+        self.min_interval = 0.0 if max_rate is None else 1.0 / max_rate
+        self.cond = threading.Condition()
+        self.queries = deque()
+        self.pending = {}
+        self.update_futures = []
+        self.last_apply = 0.0
+        self.running = True
+        self.thread = None
+
+        # Stats
+        self.n_received = 0  # Updates submitted.
+        self.n_applied = 0  # Times apply_fn was called.
+        self.n_merged = 0  # Updates folded into another's apply.
+        self.n_dropped = 0  # Values overwritten before being applied.
+
+    def submit_query(self, fn, *args, **kwargs):
+        '''
+        Args:
+            fn (function): Called as fn(*args, **kwargs).
+
+        Returns:
+            Future: Resolves to what fn returns (or raises RuntimeError
+                if stopped).
+        '''
+        future = Future()
+        self.cond.acquire()
+        if not self.running:
+            self.cond.release()
+            future.set_exception(_stopped_exc())
+            return future
+        self._ensure_thread()
+        self.queries.append((future, fn, args, kwargs))
+        self.cond.notify()
+        self.cond.release()
+        return future
+
+    def submit_update(self, **update):
+        '''
+        Args:
+            update ({str: object}): Keyword arguments for apply_fn;
+                those that are None are ignored.
+
+        Returns:
+            Future: Resolves (to None) once a state including this
+                update has been applied (or raises RuntimeError if
+                stopped).
+        '''
+        future = Future()
+        self.cond.acquire()
+        if not self.running:
+            self.cond.release()
+            future.set_exception(_stopped_exc())
+            return future
+        self._ensure_thread()
+        for key, val in update.iteritems():
+            if val is not None:
+                if key in self.pending:
+                    self.n_dropped += 1
+                self.pending[key] = val
+        self.update_futures += [future]
+        self.n_received += 1
+        self.cond.notify()
+        self.cond.release()
+        return future
+
+    def get_stats(self):
+        '''
+        Returns:
+            {str: int}: Counts of updates received, applied, merged
+                (folded into another update's apply), dropped (values
+                overwritten before being applied), and queries waiting.
+        '''
+        self.cond.acquire()
+        stats = {
+            'received': self.n_received,
+            'applied': self.n_applied,
+            'merged': self.n_merged,
+            'dropped': self.n_dropped,
+            'queries_waiting': len(self.queries),
+        }
+        self.cond.release()
+        return stats
+
+    def stop(self):
+        '''Stops the thread once queued queries and updates are done.
+        Later submissions fail.'''
+        self.cond.acquire()
+        self.running = False
+        self.cond.notify()
+        thread = self.thread
+        self.cond.release()
+        if thread is not None:
+            thread.join()
+
+    def _ensure_thread(self):
+        '''Starts the thread if needed. Must hold self.cond.'''
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _next_job(self):
+        '''
+        Waits for the next thing to do.
+
+        Returns:
+            function|None: Runs the job; None if stopped.
+        '''
+        self.cond.acquire()
+        while True:
+            if len(self.queries) > 0:
+                future, fn, args, kwargs = self.queries.popleft()
+                self.cond.release()
+                return lambda: self._run_query(future, fn, args, kwargs)
+            if len(self.update_futures) > 0:
+                wait = self.last_apply + self.min_interval - time.time()
+                if wait <= 0.0 or not self.running:
+                    update, futures = self.pending, self.update_futures
+                    self.pending, self.update_futures = {}, []
+                    self.n_merged += len(futures) - 1
+                    self.cond.release()
+                    return lambda: self._run_update(update, futures)
+                # Rate limited; wake early for queries.
+                self.cond.wait(wait)
+                continue
+            if not self.running:
+                self.cond.release()
+                return None
+            self.cond.wait()
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            job()
+
+    def _run_query(self, future, fn, args, kwargs):
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except:
+            future.set_exception(sys.exc_info())
+
+    def _run_update(self, update, futures):
+        exc_info = None
+        try:
+            self.apply_fn(**update)
+        except:
+            exc_info = sys.exc_info()
+        self.cond.acquire()
+        self.n_applied += 1
+        self.last_apply = time.time()
+        self.cond.release()
+        for future in futures:
+            if exc_info is None:
+                future.set_result(None)
+            else:
+                future.set_exception(exc_info)
+
+
+class LocalBus(object):
+    '''
+    In-process stand-in for ROS topics and services, so frontends can
+    be wired up and tested without ROS. Messages are delivered
+    synchronously on the publisher's thread.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = defaultdict(list)
+        self.services = {}
+
+    def subscribe(self, topic, callback):
+        '''
+        Args:
+            topic (str)
+            callback (function): Called with each message published to
+                topic.
+        '''
+        self.lock.acquire()
+        self.subscribers[topic] += [callback]
+        self.lock.release()
+
+    def publish(self, topic, msg):
+        '''
+        Args:
+            topic (str)
+            msg (object)
+        '''
+        self.lock.acquire()
+        callbacks = self.subscribers[topic][:]
+        self.lock.release()
+        for callback in callbacks:
+            callback(msg)
+
+    def advertise(self, service, handler):
+        '''
+        Args:
+            service (str)
+            handler (function): Called with each request; returns the
+                response.
+        '''
+        self.lock.acquire()
+        self.services[service] = handler
+        self.lock.release()
+
+    def call(self, service, req):
+        '''
+        Args:
+            service (str)
+            req (object)
+
+        Returns:
+            object: The handler's response.
+        '''
+        self.lock.acquire()
+        handler = self.services[service]
+        self.lock.release()
+        return handler(req)
+
+
+class ChangeFeed(object):
+    '''
+    The latest (serialized) value for each of a set of keys, each
+    stamped with the sequence number of the change that set it. Clients
+    remember the last sequence number they saw and get only the keys
+    changed since, waiting (long-polling) if there are none.
+
+    Values are stored as given, so serializing happens once per change
+    however many clients there are. A value of None means the key was
+    removed.
+
+    Only the latest max_removed removals are remembered. A client that
+    last saw a change from before a forgotten removal can't be told of
+    it, so starts over from the full state (see get_since(...)).
+    '''
+
+    # Change telling a client to forget everything it had.
+    RESET = (0, None, None)
+
+    def __init__(self, max_removed=FEED_MAX_REMOVED):
+        '''
+        Args:
+            max_removed (int, optional): Defaults to FEED_MAX_REMOVED.
+        '''
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.state = {}  # key: (seq, value)
+        self.max_removed = max_removed
+
+        # Map of removed key: seq, oldest first.
+        self.removed = OrderedDict()
+
+        # Sequence number of the latest forgotten removal; clients that
+        # saw only changes before it must start over.
+        self.forgotten_seq = 0
+
+    def put(self, key, value):
+        '''
+        Args:
+            key (str)
+            value (str|None): None to remove key.
+        '''
+        self.cond.acquire()
+        self.seq += 1
+        self.state[key] = (self.seq, value)
+        if key in self.removed:
+            del self.removed[key]
+        if value is None:
+            self.removed[key] = self.seq
+            while len(self.removed) > self.max_removed:
+                old_key, self.forgotten_seq = self.removed.popitem(
+                    last=False)
+                del self.state[old_key]
+        self.cond.notify_all()
+        self.cond.release()
+
+    def get_since(self, seq, timeout=None):
+        '''
+        Waits for and returns changes after seq.
+
+        If seq is from before a restart, or before a forgotten removal,
+        the client starts over: the changes begin with RESET, after
+        which it should forget everything it had, then the full state.
+
+        Args:
+            seq (int): The last sequence number seen (0 for the full
+                state).
+            timeout (float, optional): Seconds to wait for changes.
+                Defaults to None (wait forever).
+
+        Returns:
+            (int, [(int, str, str|None)]): The sequence number to pass
+                next time, and the changes (sequence number, key,
+                value) after seq, oldest first; empty if timed out.
+        '''
+        self.cond.acquire()
+        reset = seq > self.seq or 0 < seq < self.forgotten_seq
+        if reset:
+            seq = 0
+        if self.seq <= seq:
+            self.cond.wait(timeout)
+        changes = sorted([
+            (key_seq, key, value)
+            for key, (key_seq, value) in self.state.iteritems()
+            if key_seq > seq and (seq > 0 or value is not None)])
+        if reset:
+            changes = [ChangeFeed.RESET] + changes
+        cur_seq = self.seq
+        self.cond.release()
+        return cur_seq, changes
+
+
+########################################################################
+# Functions
+########################################################################
+
+def _stopped_exc():
+    '''
+    Returns:
+        tuple: exc_info (see Future.set_exception(...)).
+    '''
+    return (RuntimeError, RuntimeError('UpdateScheduler is stopped.'), None)
@@ -1,9 +1,12 @@
 '''Frontends for the hands-free pbd parser.
 
-    - Frontend:    Access parser, no-frills. Can buffer & grab logs.
-    - ROSFrontend: Add option to enable ROS capabilities.
-    - WebFrontend: Frontend for web interface. ROS-enabled, if desired.
-    - CLFrontend:  Command-line interface. ROS-enabled, if desired.
+    - Frontend:      Access parser, no-frills. Can buffer & grab logs.
+    - AsyncFrontend: Non-blocking access; world updates are scheduled
+                     and coalesced in the background. Attaches to a
+                     message bus (ROS, or in-process).
+    - ROSFrontend:   Add option to enable ROS capabilities.
+    - WebFrontend:   Frontend for web interface. ROS-enabled, if desired.
+    - CLFrontend:    Command-line interface. ROS-enabled, if desired.
 '''
 
 __author__ = 'mbforbes'
@@ -14,15 +17,32 @@ __author__ = 'mbforbes'
 ########################################################################
 
 # Builtins
+import time
+IMPORT_START = time.time()  # For reporting startup time.
+import json
 import sys
-import yaml
+import threading
 
 # Local
+# NOTE(mbforbes): The parser (hybridbayes) is imported when first
+# needed (see Frontend.parser) to keep startup fast.
 from constants import C
-from grammar import ObjectOption
-from hybridbayes import Parser
+from dispatch import ChangeFeed, UpdateScheduler
 from roslink import WorldObject, Robot
-from util import Logger, Debug, Info, Error
+from util import Logger, Debug, Info, Error, Yaml
+IMPORT_END = time.time()
+
+
+########################################################################
+# Module-level constants
+########################################################################
+
+# Topics and services, for ROS and the local stand-in bus.
+TOPIC_SPEECH = 'recognizer/output'
+TOPIC_ROBOT_STATE = 'handsfree_robotstate'
+TOPIC_COMMAND = 'handsfree_command'
+TOPIC_GROUNDING = 'handsfree_grounding'
+SERVICE_WORLD_CHANGE = 'handsfree_worldchange'
 
 
 ########################################################################
@@ -33,24 +53,108 @@ class Frontend(object):
     '''
     Basic functionality.
     '''
-    def __init__(self, buffer_printing=False):
+    def __init__(self, buffer_printing=False, parser=None, grammar=None):
+        '''
+        Args:
+            buffer_printing (bool, optional): Defaults to False.
+            parser (Parser|ParserPool, optional): Defaults to None (make
+                a Parser).
+            grammar (CompiledGrammar, optional): For the Parser made if
+                none is provided. Defaults to None (the process's).
+        '''
         Logger.buffer_printing = buffer_printing
-        self.parser = Parser()
+
+        # Made on first use if not provided (see parser).
+        self._parser = parser
+        self.grammar = grammar
+        self.parser_lock = threading.Lock()
 
         # Initialize for clarity
         self.start_buffer = ''
         self.parse_buffer = ''
 
+    @property
+    def parser(self):
+        '''
+        The Parser, which is made (and its module imported) on first
+        use, or the one provided.
+
+        Returns:
+            Parser|ParserPool
+        '''
+        if self._parser is None:
+            self.parser_lock.acquire()
+            if self._parser is None:
+                start = time.time()
+                from hybridbayes import Parser
+                self._parser = Parser(grammar=self.grammar)
+                Info.p('Parser init: %0.4fs' % (time.time() - start))
+            self.parser_lock.release()
+        return self._parser
+
     def parse(self, utterance):
         '''
         Parses and returns result.
 
+        Args:
+            utterance (str|{str: float}): Utterance, or a weighted bag
+                of words (see Parser.parse(...)).
+
         Returns:
             RobotCommand
         '''
-        rc = self.parser.parse(utterance)
+        return self.parse_followup(utterance)[0]
+
+    def parse_followup(self, utterance, context=None):
+        '''
+        Parses and returns result. If context is given, the utterance is
+        first tried as an answer to the clarification it's from. The
+        caller keeps the returned context (e.g. per user) and passes it
+        back with their next utterance; the frontend keeps none.
+
+        Args:
+            utterance (str|{str: float}): Utterance, or a weighted bag
+                of words (see Parser.parse(...)).
+            context (ClarifyContext, optional): What the caller's last
+                parse asked to clarify. Defaults to None.
+
+        Returns:
+            (RobotCommand, ClarifyContext|None): The result, and what it
+                asks to clarify (if it does).
+        '''
+        rc, context = self.parser.parse_in_context(utterance, context)
         self.parse_buffer = Logger.get_buffer()
-        return rc
+        return rc, context
+
+    def parse_batch(self, utterances):
+        '''
+        Parses many utterances against the current world.
+
+        Args:
+            utterances ([str|{str: float}])
+
+        Returns:
+            [RobotCommand]: One per utterance, in order.
+        '''
+        rcs = self.parser.parse_batch(utterances)
+        self.parse_buffer = Logger.get_buffer()
+        return rcs
+
+    def parse_nbest(self, hyps, k=5):
+        '''
+        Parses and returns the top k commands.
+
+        Args:
+            hyps (str|[(str, float)]): The utterance, or a list of
+                (utterance, confidence) recognizer hypotheses.
+            k (int, optional): Defaults to 5.
+
+        Returns:
+            [RobotCommand]
+        '''
+        rcs = self.parser.parse_nbest(hyps, k)
+        self.parse_buffer = Logger.get_buffer()
+        return rcs
 
     def describe(self, grab_buffer=True):
         '''
@@ -82,6 +186,20 @@ class Frontend(object):
         self.parse_buffer = Logger.get_buffer()
         return gprobs
 
+    def ground_batch(self, grounding_queries):
+        '''
+        Grounds many expressions against the current world.
+
+        Args:
+            grounding_queries ([str])
+
+        Returns:
+            [{str: float}]: One map of obj : P(obj) per query, in order.
+        '''
+        gprobs = self.parser.ground_batch(grounding_queries)
+        self.parse_buffer = Logger.get_buffer()
+        return gprobs
+
     def get_buffer(self):
         '''
         Returns the buffer from grammar generation as well as the last
@@ -96,19 +214,22 @@ class Frontend(object):
         '''
         Sets "default" (file-specified) world objects and robot.
         '''
-        world_dict = yaml.load(open(C.world_default))
+        world_dict = Yaml.load(C.world_default)
         w_objects = WorldObject.from_dicts(world_dict['objects'])
-        robot = Robot(world_dict['robot'])
+        robot = Robot.from_dict(world_dict['robot'])
         self.set_world(w_objects, robot)
 
-    def set_world(self, world_objects=[], robot=Robot()):
+    def set_world(self, world_objects=[], robot=None):
         '''
         Updates the objects in the world and the robot.
 
         Args:
             world_objects ([WorldObject], optional): Defaults to []
-            robot ([Robot], optional): Defaults to Robot().
+            robot ([Robot], optional): Defaults to None (an empty
+                Robot()).
         '''
+        if robot is None:
+            robot = Robot()
         self._set_world_internal(world_objects, robot)
 
     def update_objects(self, world_objects=[]):
@@ -120,13 +241,16 @@ class Frontend(object):
         '''
         self._set_world_internal(world_objects, None)
 
-    def update_robot(self, robot=Robot()):
+    def update_robot(self, robot=None):
         '''
         Updates only the robot.
 
         Args:
-            robot ([Robot], optional): Defaults to Robot().
+            robot ([Robot], optional): Defaults to None (an empty
+                Robot()).
         '''
+        if robot is None:
+            robot = Robot()
         self._set_world_internal(None, robot)
 
     def _set_world_internal(self, world_objects, robot):
@@ -143,51 +267,212 @@ class Frontend(object):
         self.start_buffer = Logger.get_buffer()
 
 
-class ROSFrontend(Frontend):
-    '''Adds ROS compatability to interface (if desired).'''
+class AsyncFrontend(Frontend):
+    '''
+    Non-blocking frontend. Queries (parse, ground, describe) and world
+    and robot updates run on a background thread and return Futures
+    (see dispatch.UpdateScheduler): queries go ahead of updates, and
+    bursts of updates are collapsed so only the latest state is
+    applied, at most max_update_rate times per second.
+
+    Can attach to a message bus carrying the parser's topics and
+    services with parser-native messages: utterances (str) and Robots
+    in, RobotCommands and (grounding, query) pairs out, and [WorldObject]
+    world change requests answered with descriptions. LocalBus is
+    in-process; RosBus carries them over ROS. Once attached, all parses
+    and (nonempty) groundings are published.
+    '''
 
     # Override functions -----------------------------------------------
 
-    def __init__(self, buffer_printing=False):
-        super(ROSFrontend, self).__init__(buffer_printing)
-
-        # Initialize (for clarify)
-        self.hfcmd_pub = None
-        self.hfgrounding_pub = None
-        self.ros_running = False
-
-    def parse(self, utterance):
+    def __init__(
+            self, buffer_printing=False, max_update_rate=None, parser=None,
+            grammar=None):
+        '''
+        Args:
+            buffer_printing (bool, optional): Defaults to False.
+            max_update_rate (float, optional): Maximum world/robot
+                updates applied per second. Defaults to None (no
+                limit).
+            parser (Parser|ParserPool, optional): Defaults to None (make
+                a Parser).
+            grammar (CompiledGrammar, optional): For the Parser made if
+                none is provided. Defaults to None (the process's).
+        '''
+        super(AsyncFrontend, self).__init__(buffer_printing, parser, grammar)
+        self.scheduler = UpdateScheduler(self._apply_update, max_update_rate)
+        self.bus = None
+
+    def parse_followup(self, utterance, context=None):
         # Parse as normal
-        rc = super(ROSFrontend, self).parse(utterance)
+        rc, context = super(AsyncFrontend, self).parse_followup(
+            utterance, context)
 
-        # Maybe publish to ROS.
-        if self.ros_running and self.hfcmd_pub is not None:
-            self.hfcmd_pub.publish(rc.to_rosmsg())
+        # Maybe publish.
+        if self.bus is not None and rc is not None:
+            self.bus.publish(TOPIC_COMMAND, rc)
 
         # And finally return
-        return rc
+        return rc, context
 
     def ground(self, query):
         # Ground as normal
-        res = super(ROSFrontend, self).ground(query)
+        res = super(AsyncFrontend, self).ground(query)
 
-        # Maybe publish to ROS.
-        if (len(res) > 0 and self.ros_running and
-                self.hfgrounding_pub is not None):
-            self.hfgrounding_pub.publish(self.make_grounding_msg(res, query))
+        # Maybe publish.
+        if self.bus is not None and len(res) > 0:
+            self.bus.publish(TOPIC_GROUNDING, (res, query))
 
         # And finally return
         return res
 
     # New functions ----------------------------------------------------
 
-    def startup_ros(self, spin=False):
+    def parse_async(self, utterance):
+        '''
+        Args:
+            utterance (str|{str: float})
+
+        Returns:
+            Future: Resolves to a RobotCommand.
+        '''
+        return self.scheduler.submit_query(self.parse, utterance)
+
+    def ground_async(self, grounding_query):
+        '''
+        Args:
+            grounding_query (str)
+
+        Returns:
+            Future: Resolves to a map of obj : P(obj) ({str: float}).
+        '''
+        return self.scheduler.submit_query(self.ground, grounding_query)
+
+    def describe_async(self, grab_buffer=True):
+        '''
+        Args:
+            grab_buffer (bool, optional): Defaults to True.
+
+        Returns:
+            Future: Resolves to a map of object names to their
+                descriptions ({str: str}).
+        '''
+        return self.scheduler.submit_query(self.describe, grab_buffer)
+
+    def set_world_async(self, world_objects=None, robot=None):
+        '''
+        Schedules a world and/or robot update; only parameters that are
+        not None are updated.
+
+        Args:
+            world_objects ([WorldObject], optional): Defaults to None.
+            robot (Robot, optional): Defaults to None.
+
+        Returns:
+            Future: Resolves (to None) once a state at least as new as
+                this one has been applied.
+        '''
+        return self.scheduler.submit_update(
+            world_objects=world_objects, robot=robot)
+
+    def update_objects_async(self, world_objects):
+        '''
+        Args:
+            world_objects ([WorldObject])
+
+        Returns:
+            Future
+        '''
+        return self.set_world_async(world_objects=world_objects)
+
+    def update_robot_async(self, robot):
+        '''
+        Args:
+            robot (Robot)
+
+        Returns:
+            Future
+        '''
+        return self.set_world_async(robot=robot)
+
+    def get_update_stats(self):
+        '''
+        Returns:
+            {str: int}: See UpdateScheduler.get_stats().
+        '''
+        return self.scheduler.get_stats()
+
+    def attach(self, bus):
+        '''
+        Subscribes to utterances and robot state, and provides world
+        change handling, on bus.
+
+        Args:
+            bus (LocalBus|RosBus)
+        '''
+        self.bus = bus
+        bus.subscribe(TOPIC_SPEECH, self._on_utterance)
+        bus.subscribe(TOPIC_ROBOT_STATE, self.update_robot_async)
+        bus.advertise(SERVICE_WORLD_CHANGE, self._on_world_change)
+
+    def shutdown(self):
+        '''Finishes scheduled work and stops the background thread.
+        Later async calls fail (see UpdateScheduler.stop()).'''
+        self.scheduler.stop()
+
+    def _apply_update(self, world_objects=None, robot=None):
+        '''
+        Args:
+            world_objects ([WorldObject], optional): Defaults to None.
+            robot (Robot, optional): Defaults to None.
+        '''
+        self._set_world_internal(world_objects, robot)
+
+    def _on_utterance(self, utterance):
+        '''
+        Bus callback: schedules parsing (which publishes the command).
+
+        Args:
+            utterance (str)
+        '''
+        # Ensure we actually got something.
+        if len(utterance.strip()) == 0:
+            return
+        self.parse_async(utterance)
+
+    def _on_world_change(self, world_objects):
+        '''
+        Bus service handler: applies the objects and describes them.
+
+        Args:
+            world_objects ([WorldObject])
+
+        Returns:
+            {str: str}: Map of object names to their description.
+        '''
+        self.update_objects_async(world_objects).result()
+        return self.describe_async(False).result()
+
+
+class ROSFrontend(AsyncFrontend):
+    '''Adds ROS compatability to interface (if desired).'''
+
+    def startup_ros(self, spin=False, bus=None):
         '''ROS-specific: Sets up callbacks for
             - recognized speech from pocketsphinx
             - world state updates
             - robot state updates
         and publishers for
             - HandsFreeCommand
+            - HandsFreeGrounding
+
+        World and robot updates are scheduled (see AsyncFrontend).
+
+        Args:
+            spin (bool, optional): Whether to wait here until ROS shuts
+                down. Defaults to False.
+            bus (LocalBus, optional): Transport to use instead of ROS
+                (e.g. for running offline). Defaults to None (ROS).
 
         Returns:
             bool: Whether the setup succeeded. Note that this won't
@@ -200,84 +485,101 @@ class ROSFrontend(Frontend):
         self.set_world()
 
         # Setup ROS.
-        try:
-            import roslib
-            roslib.load_manifest('pr2_pbd_interaction')
-            import rospy
-            from std_msgs.msg import String
-            from pr2_pbd_interaction.msg import (
-                HandsFreeCommand, WorldObjects, RobotState, Description,
-                HandsFreeGrounding)
-            from pr2_pbd_interaction.srv import WorldChange
-            # TODO(mbforbes); This waits for ROS. This is annoying, but
-            # actually may be OK for now.
-            rospy.init_node('hfpbd_parser', anonymous=True)
-
-            # We get: speech, world objects, robot state.
-            rospy.Subscriber('recognizer/output', String, self.sphinx_cb)
-            rospy.Subscriber(
-                'handsfree_robotstate', RobotState, self.robot_state_cb)
-
-            # We send: parsed commands, grounding results.
-            self.hfcmd_pub = rospy.Publisher(
-                'handsfree_command', HandsFreeCommand)
-            self.hfgrounding_pub = rospy.Publisher(
-                'handsfree_grounding', HandsFreeGrounding)
-
-            # We provide: descriptions for objects.
-            rospy.Service(
-                'handsfree_worldchange', WorldChange, self.handle_world_change)
-
-            # Setup complete
-            self.ros_running = True
-
-            # If no other frontend, just wait here.
-            if spin:
-                rospy.spin()
-            return True
-        except ImportError:
-            # We don't have ROS installed! That's OK.
-            return False
-
-    def sphinx_cb(self, recognized):
-        '''ROS-specific: Callback for when data received from
-        Pocketsphinx.
+        if bus is None:
+            try:
+                bus = RosBus()
+            except ImportError:
+                # We don't have ROS installed! That's OK.
+                return False
+        self.attach(bus)
 
-        Args:
-            recognized (String)
-        '''
-        # Ensure we actually got something.
-        recog_str = recognized.data
-        if len(recog_str.strip()) == 0:
-            return
+        # If no other frontend, just wait here.
+        if spin and isinstance(bus, RosBus):
+            bus.spin()
+        return True
 
-        # Parse; ROS response happens in parser automatically.
-        self.parse(recog_str)
 
-    def handle_world_change(self, req):
-        '''ROS-specific: Callback for when world objects are received
-        from the robot.
-
-        Args:
-            req (WorldChangeRequest)
+class RosBus(object):
+    '''
+    Carries the parser's topics and services over ROS, converting to
+    and from ROS messages at the boundary. Has the same interface as
+    dispatch.LocalBus.
+    '''
 
-        Returns:
-            WorldChangeResponse
+    def __init__(self):
         '''
-        from pr2_pbd_interaction.srv import WorldChangeResponse
-        self.update_objects(WorldObject.from_ros(req.wo))
-        return WorldChangeResponse(self.make_desc_msg(self.describe(False)))
+        Raises:
+            ImportError: If ROS isn't installed.
+        '''
+        import roslib
+        roslib.load_manifest('pr2_pbd_interaction')
+        import rospy
+        from pr2_pbd_interaction.msg import (
+            HandsFreeCommand, HandsFreeGrounding)
+        # TODO(mbforbes); This waits for ROS. This is annoying, but
+        # actually may be OK for now.
+        rospy.init_node('hfpbd_parser', anonymous=True)
+        self.rospy = rospy
+
+        # We send: parsed commands, grounding results.
+        self.pubs = {
+            TOPIC_COMMAND: rospy.Publisher(TOPIC_COMMAND, HandsFreeCommand),
+            TOPIC_GROUNDING: rospy.Publisher(
+                TOPIC_GROUNDING, HandsFreeGrounding),
+        }
 
-    def robot_state_cb(self, robot_state):
-        '''ROS-specific: Callback for when robot state is received from
-        the robot.
+    def subscribe(self, topic, callback):
+        '''
+        Args:
+            topic (str): TOPIC_SPEECH or TOPIC_ROBOT_STATE.
+            callback (function): Called with the parser-native message.
+        '''
+        from std_msgs.msg import String
+        from pr2_pbd_interaction.msg import RobotState
+        if topic == TOPIC_SPEECH:
+            self.rospy.Subscriber(
+                topic, String, lambda msg: callback(msg.data))
+        elif topic == TOPIC_ROBOT_STATE:
+            self.rospy.Subscriber(
+                topic, RobotState, lambda msg: callback(Robot.from_ros(msg)))
+        else:
+            Error.p("RosBus can't subscribe to unknown topic: " + topic)
 
+    def publish(self, topic, msg):
+        '''
         Args:
-            robot_state (RobotState)
+            topic (str): TOPIC_COMMAND or TOPIC_GROUNDING.
+            msg (RobotCommand|({str: float}, str))
         '''
-        self.update_robot(Robot.from_ros(robot_state))
+        if topic == TOPIC_COMMAND:
+            self.pubs[topic].publish(msg.to_rosmsg())
+        elif topic == TOPIC_GROUNDING:
+            self.pubs[topic].publish(RosBus.make_grounding_msg(*msg))
+        else:
+            Error.p("RosBus can't publish to unknown topic: " + topic)
 
-    def make_grounding_msg(self, raw_ground, query):
+    def advertise(self, service, handler):
+        '''
+        Args:
+            service (str): SERVICE_WORLD_CHANGE.
+            handler (function): Takes [WorldObject], returns
+                descriptions ({str: str}).
+        '''
+        from pr2_pbd_interaction.srv import WorldChange, WorldChangeResponse
+        if service == SERVICE_WORLD_CHANGE:
+            self.rospy.Service(
+                service, WorldChange, lambda req: WorldChangeResponse(
+                    RosBus.make_desc_msg(
+                        handler(WorldObject.from_ros(req.wo)))))
+        else:
+            Error.p("RosBus can't provide unknown service: " + service)
+
+    def spin(self):
+        '''Waits until ROS shuts down.'''
+        self.rospy.spin()
+
+    @staticmethod
+    def make_grounding_msg(raw_ground, query):
         '''
         Args:
             raw_ground ({str: float}): Result of calling ground(...) on
@@ -297,7 +599,8 @@ class ROSFrontend(Frontend):
         from pr2_pbd_interaction.msg import HandsFreeGrounding
         return HandsFreeGrounding(names, probs, query)
 
-    def make_desc_msg(self, desc_map):
+    @staticmethod
+    def make_desc_msg(desc_map):
         '''
         Args:
             descs ({str: [WordOption]}): Map of object names to their
@@ -318,16 +621,69 @@ class ROSFrontend(Frontend):
 
 
 class WebFrontend(ROSFrontend):
-    '''Frontend for the web interface.'''
+    '''
+    Frontend for the web interface.
+
+    Keeps a ChangeFeed of the world for pushing to clients, with keys
+    'object/<name>' and 'robot' (JSON of their properties) and 'parse'
+    (JSON of the latest RobotCommand). Objects and the robot are only
+    fed when their properties change.
+    '''
 
     # Override functions -----------------------------------------------
 
-    def __init__(self):
+    def __init__(self, parser=None):
+        '''
+        Args:
+            parser (Parser|ParserPool, optional): Defaults to None (make
+                a Parser).
+        '''
+        self.feed = ChangeFeed()
+        self.fed_props = {}  # feed key: properties last put
+        self.feed_lock = threading.Lock()
+
         # We want to buffer printing for the web!
-        super(WebFrontend, self).__init__(buffer_printing=True)
+        super(WebFrontend, self).__init__(buffer_printing=True, parser=parser)
+
+    def parse_followup(self, utterance, context=None):
+        rc, context = super(WebFrontend, self).parse_followup(
+            utterance, context)
+        if rc is not None:
+            self.feed.put('parse', json.dumps(rc.to_dict()))
+        return rc, context
+
+    def _set_world_internal(self, world_objects, robot):
+        super(WebFrontend, self)._set_world_internal(world_objects, robot)
+        self.feed_lock.acquire()
+        if world_objects is not None:
+            keys = set()
+            for obj in world_objects:
+                key = 'object/' + repr(obj)
+                keys.add(key)
+                self._feed_props(key, obj)
+            for key in self.fed_props.keys():
+                if key.startswith('object/') and key not in keys:
+                    del self.fed_props[key]
+                    self.feed.put(key, None)
+        if robot is not None:
+            self._feed_props('robot', robot)
+        self.feed_lock.release()
 
     # New functions ----------------------------------------------------
 
+    def _feed_props(self, key, getter):
+        '''
+        Puts getter's properties in the feed if they changed. Must hold
+        self.feed_lock.
+
+        Args:
+            key (str)
+            getter (PropertyGetter)
+        '''
+        if self.fed_props.get(key) != getter.properties:
+            self.fed_props[key] = getter.to_dict()
+            self.feed.put(key, getter.to_json())
+
     def get_world_objects_str(self):
         '''
         For display (e.g. web interface).
@@ -353,6 +709,20 @@ class WebFrontend(ROSFrontend):
             ret = self.parser.robot.to_dict_str()
         return ret
 
+    def get_world_dict(self):
+        '''
+        For serializing (e.g. JSON API).
+
+        Returns:
+            {str: object}: 'objects' ([{str: object}]) and 'robot'
+                ({str: object}|None).
+        '''
+        objs, robot = self.parser.world_objects, self.parser.robot
+        return {
+            'objects': [] if objs is None else [o.to_dict() for o in objs],
+            'robot': None if robot is None else robot.to_dict(),
+        }
+
 
 class CLFrontend(ROSFrontend):
     '''Command-line frontend for the parser.'''
@@ -386,9 +756,12 @@ class CLFrontend(ROSFrontend):
         Answers queries using the already-set world objects and robot
         state.
         '''
+        # One user, so answers to clarifications are followed up.
+        context = None
         while True:
             utterance = raw_input('u> ')
-            Info.p(self.parse(utterance))
+            rc, context = self.parse_followup(utterance, context)
+            Info.p(rc)
 
     def default_grounding_loop(self):
         '''
@@ -429,14 +802,25 @@ class CLFrontend(ROSFrontend):
         # space of possible sentences explodes (into the millions). So
         # we seprately generate all sentences without objects, then
         # separately generate object phrases.
-        self.set_world()
-        for sentence in self.parser.sentences:
+        #
+        # The world is set once (with all objects); commands without
+        # objects are the same as in a world without them.
+        #
+        # Commands that can say the same sentence share it (see
+        # SentenceStore), so each is printed once.
+        from grammar import ObjectOption, SentenceStore
+        wobjs = [WorldObject(o) for o in WorldObject.gen_objs()]
+        self.set_world(world_objects=wobjs)
+        store = SentenceStore.from_commands([
+            cmd for cmd in self.parser.commands
+            if not any(
+                [type(opt) == ObjectOption
+                    for opt in cmd.option_map.itervalues()])])
+        for sentence in store.sentences:
             print sentence.get_raw()
 
         # Look for object options
-        wobjs = [WorldObject(o) for o in WorldObject.gen_objs()]
         sentence_set = set()
-        self.set_world(world_objects=wobjs)
         for opt in self.parser.options:
             if type(opt) == ObjectOption:
                 phrase_lists = opt.get_phrases(True)
@@ -451,6 +835,10 @@ class CLFrontend(ROSFrontend):
             print phrase
 
     def main(self, args=[]):
+        # (Sentences mode prints only sentences.)
+        if args[:1] != ['sentences']:
+            Info.p('Startup: %0.4fs imports, %0.4fs total' % (
+                IMPORT_END - IMPORT_START, time.time() - IMPORT_START))
         if args == []:
             self.run_default_query()
         else:
@@ -23,43 +23,98 @@ __author__ = 'mbforbes'
 ########################################################################
 
 # Builtins
-from collections import OrderedDict, defaultdict
-import copy
+from collections import OrderedDict
+import threading
 
 # Local
 from constants import C, N
 from matchers import DefaultMatcher, MatchingStrategy, Matchers
-from util import Logger, Error, Info, Debug, Algo, Numbers
+from vocab import Vocabulary
+from util import Logger, Error, Info, Debug, Algo, Numbers, Yaml
 
 
 ########################################################################
 # Classes
 ########################################################################
 
-class CommandDict(object):
-    '''The Python representation of our YAML-defined commands file.'''
+class CompiledGrammar(object):
+    '''The Python representation of our YAML-defined commands file:
+    everything made from it that doesn't depend on the world.
 
-    longest_cmd_name_len = 0
+    Commands aren't part of it, even those of templates without
+    objects: they hold their world's scores, so each Parser makes its
+    own from the (shared) templates.
+
+    Has state: NO (not modified once made, so one is shared by all
+    Parsers in a process; see load(...))
+    '''
+
+    # Map of path: CompiledGrammar.
+    compiled = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def load(path=C.command_grammar):
+        '''
+        Args:
+            path (str, optional): Path to the commands file. Defaults to
+                C.command_grammar.
+
+        Returns:
+            CompiledGrammar: The (shared) grammar, compiled on first
+                load.
+        '''
+        CompiledGrammar.lock.acquire()
+        try:
+            if path not in CompiledGrammar.compiled:
+                CompiledGrammar.compiled[path] = CompiledGrammar(
+                    Yaml.load(path))
+            return CompiledGrammar.compiled[path]
+        finally:
+            CompiledGrammar.lock.release()
 
     def __init__(self, ydict):
         '''
         Args:
-            ydict (dict): YAML-loaded dictionary.
+            ydict (dict): YAML-loaded dictionary. Not modified (it may
+                be shared; see Yaml.load(...)).
         '''
-        self.ydict = ydict
-        CommandDict.longest_cmd_name_len = max(
-            [len(cmd) for cmd, params in self.ydict['commands'].iteritems()])
+        # For padding command names when displaying them.
+        self.longest_cmd_name_len = max(
+            [len(cmd) for cmd, params in ydict['commands'].iteritems()])
 
-        # Programmatically modify the commands.yaml file.
+        # Programmatically modify (a copy of) the commands.yaml file.
+        # Only what's modified is copied.
+        self.ydict = dict(ydict)
+        self.ydict['options'] = dict(ydict['options'])
         for desc_type, props in ydict['descriptors'].iteritems():
             if 'adjective' in props and props['adjective']:
                 for option in props['options']:
+                    opt = dict(self.ydict['options'][option])
                     # We make the option optional (meaning that it can
                     # be skipped when generating phrases).
-                    ydict['options'][option]['optional'] = True
+                    opt['optional'] = True
                     # We also give it the 'adj' (adjective) matching
                     # strategy, which makes it important when grounding.
-                    ydict['options'][option]['strategy'] = 'adj'
+                    opt['strategy'] = 'adj'
+                    self.ydict['options'][option] = opt
+
+        # Phrases don't depend on the world, so are made once, with
+        # their tokens' and their IDs.
+        self.vocab = Vocabulary()
+        self.phrases = []  # Phrase, by ID
+        self.phrase_map = self._make_phrases()
+
+        # Nor does anything else but object options and what uses them
+        # (the object parameter and its templates). Make the rest once.
+        self.word_options = self._make_word_options(self.phrase_map)
+        self.static_params = self._make_parameters(self.word_options)
+        self.static_templates = self._make_templates(self.static_params)
+
+        # Templates are always given in the order of the commands file.
+        self.template_order = {}  # name: int
+        for cmd in self.ydict['commands'].iterkeys():
+            self.template_order[cmd] = len(self.template_order)
 
     def get_grammar(self, wobjs):
         '''
@@ -69,16 +124,35 @@ class CommandDict(object):
 
         Returns:
             3-tuple of: (
-                [Phrase]
+                [Phrase] (by ID)
                 [Option]
                 [CommandTemplate],
             )
+            Only the ObjectOptions and the templates that use them are
+            new; the rest are made once (see static_templates).
+        '''
+        obj_opts = self._make_object_options(wobjs)
+        options = self.word_options.values() + obj_opts
+        templates = sorted(
+            self.static_templates + self._make_object_templates(obj_opts),
+            key=lambda t: self.template_order[t.name])
+        return (self.phrases, options, templates)
+
+    def _make_object_templates(self, obj_opts):
+        '''
+        Args:
+            obj_opts ([ObjectOption])
+
+        Returns:
+            [CommandTemplate]: The templates with the object parameter.
         '''
-        phrase_map = self._make_phrases()
-        options = self._make_options(phrase_map, wobjs)
-        parameters = self._make_parameters(options)
-        templates = self._make_templates(parameters)
-        return (phrase_map.values(), options.values(), templates)
+        if len(obj_opts) == 0:
+            return []
+        parameters = dict(self.static_params)
+        parameters[C.obj_param] = Parameter(C.obj_param, obj_opts)
+        return [
+            t for t in self._make_templates(parameters)
+            if t.has_params([C.obj_param])]
 
     def _make_templates(self, parameters):
         '''
@@ -102,7 +176,8 @@ class CommandDict(object):
 
             # If any parameters were missing, don't add.
             if len(params) == len(pnames):
-                templates += [CommandTemplate(cmd, params)]
+                templates += [CommandTemplate(
+                    cmd, params, self.longest_cmd_name_len)]
         return templates
 
     def _make_parameters(self, options):
@@ -145,16 +220,14 @@ class CommandDict(object):
         Debug.p('Params: ' + str(params.values()))
         return params
 
-    def _make_options(self, phrase_map, wobjs):
+    def _make_word_options(self, phrase_map):
         '''
         Args:
             phrase_map ({(str, class): Phrase}): Map of
                 {('words', strategy): Phrase}.
-            wobjs ([WorldObject]): The object wes see in the world (or
-                from a YAML file or python dict).
 
         Returns:
-            {str: Option}: Map of {'option name': Option}.
+            {str: WordOption}: Map of {'option name': WordOption}.
         '''
         options = {}
         # Make word options from phrases.
@@ -172,18 +245,29 @@ class CommandDict(object):
             w_opt = WordOption(opt_name, phrases, props)
             options[opt_name] = w_opt
 
-        # Now make object options, because they are described by word
-        # options.
-        for wobj in wobjs:
-            options[wobj.get_property('name')] = ObjectOption(wobj, options)
-
-        Debug.p('Options: ' + str(options.values()))
+        Debug.p('Word options: ' + str(options.values()))
         return options
 
+    def _make_object_options(self, wobjs):
+        '''
+        Args:
+            wobjs ([WorldObject]): The object wes see in the world (or
+                from a YAML file or python dict).
+
+        Returns:
+            [ObjectOption]: One per object, in order.
+        '''
+        # Object options are described by word options.
+        obj_opts = [ObjectOption(wobj, self.word_options) for wobj in wobjs]
+        Debug.p('Object options: ' + str(obj_opts))
+        return obj_opts
+
     def _make_phrases(self):
         '''
+        Makes all phrases (adding them to self.vocab and self.phrases).
+
         Returns:
-            {str: Phrase}: Map of {'words': Phrase}.
+            {(str, class): Phrase}: Map of {('words', strategy): Phrase}.
         '''
         phrases = {}
         # Make phrases
@@ -198,8 +282,10 @@ class CommandDict(object):
                 key = (words, matcher)
                 # Avoid making duplicates and pushing the other ones
                 # out just for convenience.
-                if key not in phrases:
-                    phrases[key] = Phrase(words, matcher)
+                phrase_id = self.vocab.intern_phrase(words, matcher)
+                if phrase_id == len(self.phrases):
+                    self.phrases += [Phrase(words, matcher, phrase_id)]
+                phrases[key] = self.phrases[phrase_id]
 
         Debug.p('Phrases: ' + str(phrases.values()))
         return phrases
@@ -208,15 +294,18 @@ class CommandDict(object):
 class CommandTemplate(object):
     '''An uninstantiated command.'''
 
-    def __init__(self, name, params):
+    def __init__(self, name, params, name_width=0):
         '''
         Args:
             name (str)
             params ([Parameter])
+            name_width (int, optional): What to pad command names to
+                when displaying them. Defaults to 0 (no padding).
         '''
 
         self.name = name
         self.params = params
+        self.name_width = name_width
 
     def __repr__(self):
         arr = ['<<' + self.name + '>>:'] + [str(p) for p in self.params]
@@ -276,7 +365,7 @@ class CommandTemplate(object):
             new_results = []
             for opt in next_opts:
                 for r in results:
-                    newr = copy.copy(r)
+                    newr = OrderedDict(r)
                     newr[param.name] = opt
                     new_results += [newr]
         return CommandTemplate._gen_opts(todo, new_results)
@@ -300,16 +389,29 @@ class Command(object):
         self.template = template
         self.phrase_sets = []  # Caching
         self.sentences = []  # Caching
+        self.sentence_ids = []  # Caching (into self.store)
+        self.store = None  # SentenceStore of sentence_ids.
 
         # P(C|W,R)
         self.score = N.START_SCORE
 
-        # P(L|C)
-        self.sentence_match_probs = defaultdict(float)  # Default: 0.0.
-
-        # P(L|C) * P(L) (marginalize across L)
+        # P(L|C) * P(L) (marginalize across L); see FactoredScorer.
         self.lang_score = 0.0
 
+    def __getstate__(self):
+        '''
+        For pickling: drops the sentences cache, which can be huge and
+        is easily regenerated.
+
+        Returns:
+            dict
+        '''
+        state = self.__dict__.copy()
+        state['sentences'] = []
+        state['sentence_ids'] = []
+        state['store'] = None
+        return state
+
     def __repr__(self):
         '''
         Returns:
@@ -340,6 +442,18 @@ class Command(object):
         '''
         return self.name
 
+    def get_key(self):
+        '''
+        Returns a hashable key that is equal for Commands with the same
+        name and option names (e.g. the same command in another
+        process, or regenerated for a new world).
+
+        Returns:
+            (str, ((str, str)))
+        '''
+        return (self.name, tuple(sorted([
+            (pname, opt.name) for pname, opt in self.option_map.iteritems()])))
+
     def _score_str(self):
         '''
         Any scores that have been set.
@@ -358,8 +472,7 @@ class Command(object):
         Returns:
             str
         '''
-        lnl = CommandDict.longest_cmd_name_len
-        padding = 0 if len(self.name) == lnl else lnl - len(self.name)
+        padding = max(self.template.name_width - len(self.name), 0)
         return ''.join(['<', self.name, '>', ' ' * padding])
 
     def _opt_str(self):
@@ -372,13 +485,23 @@ class Command(object):
         return ', '.join([': '.join(
             [str(k), str(v)]) for k, v in self.option_map.iteritems()])
 
-    def generate_sentences(self):
+    def generate_sentences(self, store=None):
         '''
+        Args:
+            store (SentenceStore, optional): To get (shared) sentences
+                from, which are then referred to by ID. Defaults to None
+                (make this command's own).
+
         Returns:
             [Sentence]
         '''
         # Cache.
-        if len(self.sentences) == 0:
+        if store is not None and store is not self.store:
+            phrase_lists = Algo.gen_phrases(self.option_map.values())
+            self.sentence_ids = [store.intern(pl) for pl in phrase_lists]
+            self.sentences = [store.get(i) for i in self.sentence_ids]
+            self.store = store
+        elif len(self.sentences) == 0:
             phrase_lists = Algo.gen_phrases(self.option_map.values())
             self.sentences = [Sentence(pl) for pl in phrase_lists]
         return self.sentences
@@ -539,36 +662,6 @@ class Command(object):
                 if not loc_reachable:
                     self.score += N.P_LOCUNR
 
-    def score_match_sentences(self, sentences):
-        '''
-        Score how well a command matches with sentences.
-
-        This can be done in advance of actually receiving an utterance.
-        The result is stored in self.sentence_match_probs
-
-        Args:
-            sentences ([Sentence])
-        '''
-        s_score = 1.0 / len(self.sentences)
-        for s in self.sentences:
-            self.sentence_match_probs[s] = s_score
-
-    def apply_l(self, sentences):
-        '''
-        Applies utterance-scored sentences to command-matched score.
-
-        Must first call score_match_sentences(...).
-
-        Args:
-            sentences ([Sentence])
-        '''
-        self.lang_score = 0.0
-        # Only its own sentences have any score, so just iterate over
-        # them.
-        for s in self.sentences:
-            self.lang_score += s.score * self.sentence_match_probs[s]
-        return
-
     @staticmethod
     def cmp(cmd1, cmd2):
         '''
@@ -637,6 +730,36 @@ class Option(object):
         Error.p("Option:get_phrases must be implemented by a subclass.")
         sys.exit(1)
 
+    def get_phrase_ids(self):
+        '''
+        Returns:
+            [[int]]: get_phrases(), by phrase ID.
+        '''
+        return [[p.id for p in ps] for ps in self.get_phrases()]
+
+    def get_phrase_lookup(self):
+        '''
+        Returns (making once and caching) what's needed to pick an
+        option's phrase set for an utterance (see
+        RobotCommand.from_command(...)).
+
+        Returns:
+            ({Phrase: [int]}, [str]): For each phrase, the phrase sets
+                (indices into get_phrases()) it's in, and each phrase
+                set joined into a string.
+        '''
+        if self.phrase_lookup is None:
+            index = {}
+            joined = []
+            for idx, phrase_set in enumerate(self.get_phrases()):
+                for phrase in phrase_set:
+                    index.setdefault(phrase, [])
+                    if idx not in index[phrase]:
+                        index[phrase] += [idx]
+                joined += [' '.join([str(p) for p in phrase_set])]
+            self.phrase_lookup = (index, joined)
+        return self.phrase_lookup
+
     def pure_str(self):
         '''
         Returns the 'cannonical' name of the option.
@@ -671,6 +794,10 @@ class WordOption(Option):
         self.phrases = phrases
         self.opt = 'optional' in props and props['optional']
 
+        # Made with the grammar, as this is used for every parse.
+        self.phrase_lookup = None
+        self.get_phrase_lookup()
+
     def get_phrases(self):
         '''
         Returns a list, where each element is a single-element list of
@@ -711,6 +838,7 @@ class ObjectOption(Option):
             i for s in self.structured_word_options.values() for i in s]
         self.phrases = []  # Compute later and cache.
         self.phrases_skipping = []  # Compute later and cache.
+        self.phrase_lookup = None  # Compute later and cache.
         self.opt = False
 
     def _get_structured_word_options(self, options):
@@ -827,12 +955,20 @@ class Sentence(object):
     Has state: YES
     '''
 
-    def __init__(self, phrases):
+    def __init__(self, phrases, weights=None):
         '''
         Args:
             phrases ([Phrase])
+            weights ({Phrase: float}, optional): How confidently each
+                phrase was heard, for utterances from weighted
+                hypotheses. Defaults to None (all phrases fully
+                heard).
         '''
         self.phrases = phrases
+        self.weights = weights
+        self.matched = None  # Compute later and cache.
+        self.heard = None  # Compute later and cache.
+        self.ids = None  # Compute later and cache.
         self.score = 0
 
     def __repr__(self):
@@ -849,13 +985,10 @@ class Sentence(object):
             other (Sentence)
 
         Returns:
-            bool
+            bool: Whether the sentences have the same phrases (in any
+                order).
         '''
-        # Allow mismatched ordering.
-        for phrase in self.phrases:
-            if phrase not in other.get_phrases():
-                return False
-        return True
+        return self.get_ids() == other.get_ids()
 
     def __ne__(self, other):
         '''
@@ -867,6 +1000,13 @@ class Sentence(object):
         '''
         return not self.__eq__(other)
 
+    def __hash__(self):
+        '''
+        Returns:
+            int
+        '''
+        return hash(self.get_ids())
+
     def get_raw(self):
         '''
         Returns just the sentences words as a string
@@ -883,6 +1023,64 @@ class Sentence(object):
         '''
         return self.phrases
 
+    def get_weight(self, phrase):
+        '''
+        Args:
+            phrase (Phrase): One of this sentence's phrases.
+
+        Returns:
+            float: How confidently phrase was heard.
+        '''
+        return 1.0 if self.weights is None else self.weights[phrase]
+
+    def get_matched(self):
+        '''
+        Returns:
+            {Phrase: float}: Map of each phrase to how confidently it
+                was heard (see get_weight(...)).
+        '''
+        if self.matched is None:
+            if self.weights is None:
+                self.matched = dict.fromkeys(self.phrases, 1.0)
+            else:
+                self.matched = self.weights
+        return self.matched
+
+    def get_heard(self):
+        '''
+        Returns:
+            [float]: How confidently each phrase was heard, by phrase ID
+                (0.0 for phrases not in this sentence). Only as long as
+                needed for this sentence's phrases' IDs.
+        '''
+        if self.heard is None:
+            n = 1 + max([p.id for p in self.phrases]) if self.phrases else 0
+            self.heard = [0.0] * n
+            for p in self.phrases:
+                self.heard[p.id] = self.get_weight(p)
+        return self.heard
+
+    def get_ids(self):
+        '''
+        Returns:
+            (int): This sentence's phrase IDs, sorted (its canonical
+                form).
+        '''
+        if self.ids is None:
+            self.ids = tuple(sorted([p.id for p in self.phrases]))
+        return self.ids
+
+    def get_key(self):
+        '''
+        Returns a hashable key that is equal for Sentences with the same
+        phrases and weights (i.e. that score identically).
+
+        Returns:
+            ((int), (float)): Phrase IDs (sorted) and their weights.
+        '''
+        by_id = sorted([(p.id, self.get_weight(p)) for p in self.phrases])
+        return (self.get_ids(), tuple([w for i, w in by_id]))
+
     @staticmethod
     def compute_score(sentences, u_sentence, normalize=True, ground=False):
         '''
@@ -894,53 +1092,116 @@ class Sentence(object):
             ground (bool, optional): Whether we are parsing (False) or
                 grounding (True). Defaults to False (parsing).
         '''
-        u_phrases = u_sentence.get_phrases()
-
-        # Mark phrases as seen.
-        for p in u_phrases:
-            p.seen = True
+        # How confidently each phrase (by ID) was heard.
+        heard = u_sentence.get_heard()
+        n_heard = len(heard)
 
-        # Score all sentences by adding scores of seen phrases.
+        # Score all sentences by adding (weighted) scores of heard
+        # phrases.
         for sentence in sentences:
             sentence.score = 0.0
             for phrase in sentence.phrases:
-                if phrase.seen:
+                if phrase.id < n_heard and heard[phrase.id]:
                     if ground:
-                        sentence.score += phrase.get_ground_score()
+                        sentence.score += (
+                            phrase.get_ground_score() * heard[phrase.id])
                     else:
-                        sentence.score += phrase.get_match_score()
-
-        # Unmark phrases.
-        for p in u_phrases:
-            p.seen = False
+                        sentence.score += (
+                            phrase.get_match_score() * heard[phrase.id])
 
         # Normalize
         if normalize:
             Numbers.make_prob(sentences)
 
 
+class SentenceStore(object):
+    '''Hash-consed Sentences: one Sentence for each distinct set of
+    phrases, shared by every Command that can say it, which refers to it
+    by ID. Scoring the store's sentences scores each distinct one once.
+
+    Has state: YES (the shared Sentences' scores)
+    '''
+
+    def __init__(self):
+        self.sentences = []  # Sentence, by ID
+        self.ids = {}  # Sentence (phrase IDs, sorted): int
+
+    @staticmethod
+    def from_commands(commands):
+        '''
+        Generates all sentences for commands. The parser itself never
+        needs these (see FactoredScorer); this is for exporting (e.g.
+        for speech recognizer training data), and can be very large.
+
+        Args:
+            commands ([Command])
+
+        Returns:
+            SentenceStore: With each distinct sentence once (shared by
+                the commands that can say it).
+        '''
+        store = SentenceStore()
+        for c in commands:
+            c.generate_sentences(store)
+        Info.p('Sentences: %d (%d distinct)' % (
+            sum([len(c.sentence_ids) for c in commands]), len(store)))
+        return store
+
+    def __len__(self):
+        '''
+        Returns:
+            int: The number of distinct sentences.
+        '''
+        return len(self.sentences)
+
+    def intern(self, phrases):
+        '''
+        Args:
+            phrases ([Phrase])
+
+        Returns:
+            int: The ID of the Sentence with phrases (in any order),
+                made if new.
+        '''
+        key = tuple(sorted([p.id for p in phrases]))
+        if key not in self.ids:
+            self.ids[key] = len(self.sentences)
+            self.sentences += [Sentence(phrases)]
+        return self.ids[key]
+
+    def get(self, sentence_id):
+        '''
+        Args:
+            sentence_id (int)
+
+        Returns:
+            Sentence
+        '''
+        return self.sentences[sentence_id]
+
+
 class Phrase(object):
     '''Holds a set of words and a matching strategy for determining if
     it is matched in an utterance.
 
-    Has state: only briefly, and only during
-    RobotCommand::from_command(...) and Sentence::compute_score(...).
+    Has state: NO (what an utterance matched is kept per request, by
+    phrase ID; see Sentence.get_heard()).
     '''
 
-    def __init__(self, words, strategy):
+    def __init__(self, words, strategy, phrase_id):
         '''
         Args:
             words ([str])
             strategy (MatchingStrategy)
+            phrase_id (int): Dense (0, 1, ...) within a grammar (see
+                Vocabulary).
         '''
         self.words = words
         self.strategy = strategy
+        self.id = phrase_id
         self.match_score = strategy.get_match_score()
         self.ground_score = strategy.get_ground_score()
 
-        # Mark when seen by an utterance.
-        self.seen = False
-
     def get_match_score(self):
         '''
         Returns:
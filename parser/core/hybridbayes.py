@@ -7,10 +7,8 @@ Here's the process:
         probabilities for which commands are most likely (P(C|w,r)).
         (Command.score).
 
-    - Use all Commands to generate all Sentences (L).
-
-    - Pre-match-score all Commands with Sentences based on Phrase
-        matches (P(C|l)).
+    - Each Command's Sentences (L) are all combinations of its
+        Options' phrases, each equally likely (P(L|C)).
 
     - When an utterance comes in, score all Sentences based on Phrase
         matching strategies (subclass of MatchingStrategy) (estimate
@@ -19,6 +17,8 @@ Here's the process:
     - Combine Command-Sentences scores with the Sentence-utterance
         scores to find the language score. (Command.lang_score) (i.e.
         use P(u|L) and marginalize L across P(L|C) to get P(C|u)).
+        Sentence scores factor across Options, so this is done without
+        generating the Sentences (see scoring.py).
 
     - Combine the w, r-induced probability P(C|w,r) with the language
         score P(C|u) to get the final probability P(C|u,w,r). Currently
@@ -33,16 +33,20 @@ __author__ = 'mbforbes'
 ########################################################################
 
 # Builtins
-from collections import Counter
+from collections import Counter, defaultdict
+import cPickle
+from functools import cmp_to_key
+import heapq
 from operator import attrgetter
 import time
 import threading
-import yaml
 
 # Local
 from constants import C, N
-from grammar import CommandDict, Sentence, Command, ObjectOption
+from grammar import (
+    CompiledGrammar, Sentence, Command, ObjectOption)
 from roslink import Robot, WorldObject, RobotCommand
+from scoring import FactoredScorer, GroundingIndex
 from util import Error, Warn, Info, Debug, Numbers
 
 
@@ -64,15 +68,47 @@ GROUND_BASE_SCORE = 0.2
 # Classes
 ########################################################################
 
+class ClarifyContext(object):
+    '''
+    What a clarification asked about: the tied commands, by key (see
+    Command.get_key()), so it can be kept by the caller (e.g. for a
+    session) and passed back with the next utterance (see
+    Parser.parse_in_context(...)). Keys work across processes and world
+    updates.
+    '''
+
+    def __init__(self, cmds):
+        '''
+        Args:
+            cmds ([Command]): The tied commands.
+        '''
+        self.keys = tuple([cmd.get_key() for cmd in cmds])
+
+    def __len__(self):
+        return len(self.keys)
+
+
 class Parser(object):
     '''This is where the magic happens.'''
 
     # Couple settings (currently for debugging)
     display_limit = 5
 
-    def __init__(self, grammar_yaml=C.command_grammar):
-        # Load
-        self.command_dict = CommandDict(yaml.load(open(grammar_yaml)))
+    def __init__(self, grammar_yaml=C.command_grammar, grammar=None):
+        '''
+        Args:
+            grammar_yaml (str, optional): Path to the commands file.
+                Defaults to C.command_grammar.
+            grammar (CompiledGrammar, optional): To use (and share)
+                rather than grammar_yaml's. Defaults to None (the
+                process's, compiled on first use; see
+                CompiledGrammar.load(...)).
+        '''
+        # Load. The grammar is shared; everything else here depends on
+        # the world, so is this parser's own.
+        if grammar is None:
+            grammar = CompiledGrammar.load(grammar_yaml)
+        self.grammar = grammar
 
         # We can't be updating our guts while we try to churn something
         # out.
@@ -85,11 +121,73 @@ class Parser(object):
         self.options = None
         self.templates = None
         self.commands = None
+        self.template_commands = None  # [[Command]], by template
+        self.static_commands = None  # {CommandTemplate: [Command]}
+        self.scorer = None
+        self.grounder = None
+
+        # Commands by key (see Command.get_key()); made on first use for
+        # the current commands.
+        self.command_index = None
+
+        # Descriptions: all (None until made for the current world), and
+        # by object name: (what they depend on, description).
+        self.descs = None
+        self.desc_cache = {}
+
+    def __getstate__(self):
+        '''
+        For pickling (see snapshot()): everything but the lock.
+
+        Returns:
+            dict
+        '''
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        '''
+        For unpickling (see from_snapshot(...)).
+
+        Args:
+            state (dict)
+        '''
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
 
     ####################################################################
     # API
     ####################################################################
 
+    def snapshot(self):
+        '''
+        Returns a compact snapshot of the parser's full state (grammar,
+        world, robot and scored commands), so that a fully initialized
+        parser can be restored elsewhere (see from_snapshot(...))
+        without rebuilding it.
+
+        Returns:
+            str
+        '''
+        self.lock.acquire()
+        try:
+            data = cPickle.dumps(self, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            self.lock.release()
+        return data
+
+    @staticmethod
+    def from_snapshot(data):
+        '''
+        Args:
+            data (str): From snapshot().
+
+        Returns:
+            Parser: Ready to use, in the state snapshot() was called in.
+        '''
+        return cPickle.loads(data)
+
     def set_world(self, world_objects=None, robot=None):
         '''
         Updates the objects in the world and the robot.
@@ -103,13 +201,19 @@ class Parser(object):
             robot ([Robot], optional): Defaults to None.
         '''
         self.lock.acquire()
-        if world_objects is not None:
-            self.world_objects = world_objects
-        if robot is not None:
-            self.robot = robot
-        if self.world_objects is not None and self.robot is not None:
-            self._update_world_internal()
-        self.lock.release()
+        try:
+            if world_objects is not None:
+                self.world_objects = world_objects
+                self.descs = None
+            if robot is not None:
+                self.robot = robot
+            if self.world_objects is not None and self.robot is not None:
+                # Only objects change the commands; a robot update just
+                # rescores them.
+                self._update_world_internal(
+                    world_objects is not None or self.commands is None)
+        finally:
+            self.lock.release()
 
     def describe(self):
         '''
@@ -123,13 +227,302 @@ class Parser(object):
         to use, we have a priority ordering over adjectives that is
         motivated by the literature.
 
+        Descriptions are cached until the world objects change, and then
+        only remade for objects whose description could have changed.
+
         Returns:
             {str: str}: Map of object names to their description.
         '''
         self.lock.acquire()
-        descs = {}
-        obj_opts = [o for o in self.options if isinstance(o, ObjectOption)]
-        Info.p(obj_opts)
+        try:
+            # Sanity check for state.
+            if self.world_objects is None or self.robot is None:
+                Error.p(
+                    'Must set Parser world_objects and robot before '
+                    'describe().')
+                return {}
+
+            if self.descs is None:
+                self.descs = self._describe()
+            descs = dict(self.descs)
+            Info.p('Descriptions: ' + str(descs))
+        finally:
+            self.lock.release()
+        return descs
+
+    def parse(self, u):
+        '''
+        Args:
+            u (str|{str: float}): utterance, or a weighted bag of words
+                (map of word: confidence, e.g. word posteriors from a
+                recognizer's confusion network). For the latter,
+                phrase matches are weighted by their words'
+                confidences, and the returned command's utterance is
+                the words with confidence >= 0.5.
+
+        Returns:
+            RobotCommand: The top command, or a clarification.
+        '''
+        return self.parse_in_context(u)[0]
+
+    def parse_in_context(self, u, context=None):
+        '''
+        Parses a follow-up to a clarification: u is scored against only
+        the commands the clarification was between, if they all still
+        exist, all of u's phrases are in them, and u narrows them down.
+        Otherwise, u is parsed as usual (against all commands).
+
+        Args:
+            u (str|{str: float}): utterance (see parse(...)).
+            context (ClarifyContext, optional): From the previous parse.
+                Defaults to None (parse as usual).
+
+        Returns:
+            (RobotCommand, ClarifyContext|None): The top command, or a
+                clarification and its context (to pass back with the
+                next utterance).
+        '''
+        self.lock.acquire()
+        try:
+
+            # Sanity check for state.
+            if self.world_objects is None or self.robot is None:
+                Error.p(
+                    'Must set Parser world_objects and robot before '
+                    'parse().')
+                return None, None
+
+            # Translate utterance->Phrases and apply L (score all
+            # sentences, marginalized into commands).
+            u_sentence = self._match(u)
+            if isinstance(u, dict):
+                Info.p("Parser received weighted utterance: " + str(u))
+            else:
+                Info.p("Parser received utterance: " + u)
+            u = Parser._utterance_str(u)
+            Info.p('Utterance phrases: ' + str(u_sentence.get_phrases()))
+            commands, top_cmds = None, None
+            if context is not None:
+                commands, top_cmds = self._rank_candidates(
+                    u_sentence, context)
+            if top_cmds is None:
+                commands, top_cmds = self.commands, self._rank(u_sentence)
+            rc = self._make_rc(top_cmds, u_sentence, u)
+            new_context = (
+                ClarifyContext(top_cmds) if len(top_cmds) > 1 else None)
+
+            # We return a standard representation of the command.
+            self._log_results(rc, commands)
+        finally:
+            self.lock.release()
+        return rc, new_context
+
+    def parse_batch(self, utterances):
+        '''
+        Parses many utterances against the same world, e.g. for offline
+        evaluation.
+
+        Utterances that match the same phrases (including duplicates)
+        are scored only once, and per-utterance logging is skipped.
+
+        Args:
+            utterances ([str|{str: float}]): See parse(...).
+
+        Returns:
+            [RobotCommand]: One per utterance, in order (each None, as
+                from parse(...), if the world isn't set).
+        '''
+        self.lock.acquire()
+        try:
+
+            # Sanity check for state.
+            if self.world_objects is None or self.robot is None:
+                Error.p(
+                    'Must set Parser world_objects and robot before '
+                    'parse_batch().')
+                return [None for u in utterances]
+
+            matched = {}  # utterance key: Sentence
+            ranked = {}  # Sentence key: [Command]
+            rcs = []
+            for u in utterances:
+                u_key = Parser._utterance_key(u)
+                if u_key not in matched:
+                    matched[u_key] = self._match(u)
+                u_sentence = matched[u_key]
+                key = u_sentence.get_key()
+                if key not in ranked:
+                    ranked[key] = self._rank(u_sentence)
+                rcs += [self._make_rc(
+                    ranked[key], u_sentence, Parser._utterance_str(u))]
+
+            Info.p("Parsed %d utterances (%d unique, %d scored)" % (
+                len(utterances), len(matched), len(ranked)))
+        finally:
+            self.lock.release()
+        return rcs
+
+    def parse_nbest(self, hyps, k=5):
+        '''
+        Returns the top k commands (no clarification) for an utterance,
+        or for a set of recognizer hypotheses (e.g. an n-best list).
+
+        Hypotheses are combined in a single scoring pass: each
+        command's language score is the confidence-weighted mixture of
+        its language scores under each hypothesis. Hypotheses matching
+        the same phrases are merged.
+
+        Args:
+            hyps (str|[(str, float)]): The utterance, or a list of
+                (utterance, confidence) pairs. Confidences needn't be
+                normalized.
+            k (int, optional): How many commands to return. Defaults to
+                5.
+
+        Returns:
+            [RobotCommand]: Best first, at most k, each with its
+                lang_score and score set. The utterance of each is the
+                most confident hypothesis. Empty if there are no
+                hypotheses (or the world isn't set).
+        '''
+        if isinstance(hyps, basestring):
+            hyps = [(hyps, 1.0)]
+        if len(hyps) == 0:
+            return []
+        self.lock.acquire()
+        try:
+
+            # Sanity check for state.
+            if self.world_objects is None or self.robot is None:
+                Error.p(
+                    'Must set Parser world_objects and robot before '
+                    'parse_nbest().')
+                return []
+
+            # Merge hypotheses that match the same phrases.
+            confs = Numbers.normalize_list([conf for u, conf in hyps])
+            matched = {}  # utterance key: Sentence
+            weights = {}  # Sentence key: float
+            sentences = {}  # Sentence key: Sentence
+            for (u, conf), weight in zip(hyps, confs):
+                u_sentence = self._match(u)
+                matched[Parser._utterance_key(u)] = u_sentence
+                key = u_sentence.get_key()
+                sentences[key] = u_sentence
+                weights[key] = weights.get(key, 0.0) + weight
+            keys = weights.keys()
+            self.scorer.score_hyps(
+                [sentences[key] for key in keys],
+                [weights[key] for key in keys])
+
+            # Partial selection of the top k (as ranked by Command.cmp).
+            top_cmds = heapq.nsmallest(
+                k, self.commands, key=cmp_to_key(Command.cmp))
+
+            best_u = max(hyps, key=lambda hyp: hyp[1])[0]
+            best_sentence = matched[Parser._utterance_key(best_u)]
+            best_u = Parser._utterance_str(best_u)
+            rcs = [
+                RobotCommand.from_command(cmd, best_sentence, best_u)
+                for cmd in top_cmds]
+
+            Info.p("Top %d commands for %d hypotheses (%d unique):" % (
+                len(rcs), len(hyps), len(keys)))
+            for cmd in top_cmds:
+                Info.pl(1, cmd)
+        finally:
+            self.lock.release()
+        return rcs
+
+    def ground(self, gq):
+        '''
+        Args:
+            gq (str): Grounding query.
+
+        Returns:
+            {str: float}: Map of obj : P(obj).
+        '''
+        self.lock.acquire()
+        try:
+
+            # Sanity check for state.
+            if self.world_objects is None or self.robot is None:
+                Error.p(
+                    'Must set Parser world_objects and robot before '
+                    'ground().')
+                return {}
+
+            # Check if we don't have any objects (actually quite common).
+            if len(self.grounder.obj_opts) == 0:
+                Warn.p("Trying to do grounding with no objects; empty result.")
+                return {}
+
+            res = self._ground(self._match(gq))
+
+            # Log for convenience
+            Info.p("Grounding for query: " + gq)
+            for obj, prob in res.iteritems():
+                Info.pl(1, obj + ": " + str(prob))
+
+        finally:
+            self.lock.release()
+        return res
+
+    def ground_batch(self, gqs):
+        '''
+        Grounds many queries against the same world. Queries that match
+        the same phrases (including duplicates) are scored only once.
+
+        Args:
+            gqs ([str]): Grounding queries.
+
+        Returns:
+            [{str: float}]: One map of obj : P(obj) per query, in order.
+        '''
+        self.lock.acquire()
+        try:
+
+            # Sanity check for state.
+            if self.world_objects is None or self.robot is None:
+                Error.p(
+                    'Must set Parser world_objects and robot before '
+                    'ground_batch().')
+                return [{} for gq in gqs]
+
+            # Check if we don't have any objects (actually quite common).
+            if len(self.grounder.obj_opts) == 0:
+                Warn.p("Trying to do grounding with no objects; empty result.")
+                return [{} for gq in gqs]
+
+            matched = {}  # query key: Sentence
+            grounded = {}  # Sentence key: {str: float}
+            res = []
+            for gq in gqs:
+                gq_key = Parser._utterance_key(gq)
+                if gq_key not in matched:
+                    matched[gq_key] = self._match(gq)
+                gq_sentence = matched[gq_key]
+                key = gq_sentence.get_key()
+                if key not in grounded:
+                    grounded[key] = self._ground(gq_sentence)
+                # Copy so callers can't modify each other's results.
+                res += [dict(grounded[key])]
+
+            Info.p("Grounded %d queries (%d unique, %d scored)" % (
+                len(gqs), len(matched), len(grounded)))
+        finally:
+            self.lock.release()
+        return res
+
+    def _describe(self):
+        '''
+        Describes all objects, reusing cached descriptions of objects
+        whose word options and identifier counts are unchanged.
+
+        Returns:
+            {str: str}: Map of object names to their description.
+        '''
+        obj_opts = self.grounder.obj_opts
 
         # Get flattened list of identifiers (color & shape) & count
         # occurrences of each.
@@ -141,9 +534,10 @@ class Parser(object):
             ]
             for i in s])
 
+        descs = {}
+        desc_cache = {}
+        n_made = 0
         for opt in obj_opts:
-            desc = []
-
             # Extract to avoid long variable names.
             swo = opt.structured_word_options
             starts, uniques, ident, type_ = (
@@ -152,148 +546,231 @@ class Parser(object):
                 swo[ObjectOption.IDENT][0],  # Only 1.
                 swo[ObjectOption.TYPE][0]  # Only 1.
             )
-            unique_names = [u.name for u in uniques]
-
-            # Debug
-            Info.pl(0, opt)
-            Info.pl(1, 'swo: ' + str(swo))
-            Info.pl(1, 'starts: ' + str(starts))
-            Info.pl(1, 'uniques: ' + str(uniques))
-            Info.pl(1, 'ident: ' + str(ident))
-            Info.pl(1, 'type: ' + str(type_))
-
-            # First add starters.
-            desc = starts[:]  # Don't want to modify swo.
-
-            # See whether type is sufficient.
-            if idents[type_] > 1:
-                # See if there are any adjectives with higher priority
-                # than color.
-                use_color = True
-                for top_adj in C.color_priority:
-                    if top_adj in unique_names:
-                        use_color = False
-
-                # If nothing higher priority than color, and color is
-                # identifying, then use it.
-                if use_color and idents[ident] == 1:
-                    desc += [ident]
-                else:
-                    # Color's not unique or of lower priority; pull from
-                    # the unique list.
-                    # NOTE(mbforbes): Currently just pull first off of
-                    # the list. Change the order by chaning C.m_wo.
-                    if len(uniques) > 0:
-                        desc += [uniques[0]]
-                    # Note that if we don't have any uniques, then we
-                    # have objects that we cannot distinguish. This will
-                    # happen when we have enough objects.
-
-            # Always add type at end.
-            desc += [type_]
-            Info.pl(1, 'result: ' + str(desc))
-            descs[opt.name] = ' '.join(
-                [str(wo.get_phrases()[0][0]) for wo in desc])
-
-        Info.pl(0, 'returning: ' + str(descs))
-        self.lock.release()
+
+            # Everything the description depends on.
+            key = (
+                tuple([s.name for s in starts]),
+                tuple([u.name for u in uniques]),
+                ident.name,
+                type_.name,
+                idents[ident],
+                idents[type_],
+            )
+            if opt.name in self.desc_cache and (
+                    self.desc_cache[opt.name][0] == key):
+                desc_cache[opt.name] = self.desc_cache[opt.name]
+            else:
+                desc_cache[opt.name] = (key, self._describe_obj(
+                    opt, starts, uniques, ident, type_, idents))
+                n_made += 1
+            descs[opt.name] = desc_cache[opt.name][1]
+        self.desc_cache = desc_cache
+        Info.p('Described %d objects (%d changed)' % (len(descs), n_made))
         return descs
 
-    def parse(self, u):
+    def _describe_obj(self, opt, starts, uniques, ident, type_, idents):
         '''
         Args:
-            u (str): utterance
+            opt (ObjectOption)
+            starts ([WordOption]): opt's starting words.
+            uniques ([WordOption]): opt's unique adjectives.
+            ident (WordOption): opt's identifier (color).
+            type_ (WordOption): opt's type.
+            idents (Counter): Occurrences of each identifier and type
+                across all objects.
 
         Returns:
-            RobotCommand: The top command, or a clarification.
+            str: The description of opt.
         '''
-        self.lock.acquire()
+        unique_names = [u.name for u in uniques]
+
+        # Debug
+        Debug.pl(0, opt)
+        Debug.pl(1, 'starts: ' + str(starts))
+        Debug.pl(1, 'uniques: ' + str(uniques))
+        Debug.pl(1, 'ident: ' + str(ident))
+        Debug.pl(1, 'type: ' + str(type_))
+
+        # First add starters.
+        desc = starts[:]  # Don't want to modify swo.
+
+        # See whether type is sufficient.
+        if idents[type_] > 1:
+            # See if there are any adjectives with higher priority
+            # than color.
+            use_color = True
+            for top_adj in C.color_priority:
+                if top_adj in unique_names:
+                    use_color = False
+
+            # If nothing higher priority than color, and color is
+            # identifying, then use it.
+            if use_color and idents[ident] == 1:
+                desc += [ident]
+            else:
+                # Color's not unique or of lower priority; pull from
+                # the unique list.
+                # NOTE(mbforbes): Currently just pull first off of
+                # the list. Change the order by chaning C.m_wo.
+                if len(uniques) > 0:
+                    desc += [uniques[0]]
+                # Note that if we don't have any uniques, then we
+                # have objects that we cannot distinguish. This will
+                # happen when we have enough objects.
+
+        # Always add type at end.
+        desc += [type_]
+        Debug.pl(1, 'result: ' + str(desc))
+        return ' '.join([str(wo.get_phrases()[0][0]) for wo in desc])
+
+    @staticmethod
+    def _utterance_key(u):
+        '''
+        Args:
+            u (str|{str: float}): Utterance, or a weighted bag of words.
+
+        Returns:
+            str|((str, float)): A hashable key for u.
+        '''
+        if isinstance(u, dict):
+            return tuple(sorted(u.iteritems()))
+        return u
 
-        # Sanity check for state.
-        if self.world_objects is None or self.robot is None:
-            Error.p('Must set Parser world_objects and robot before parse().')
-            return None
+    @staticmethod
+    def _utterance_str(u):
+        '''
+        Args:
+            u (str|{str: float}): Utterance, or a weighted bag of words.
 
-        # Translate utterance->Phrases and score all sentences.
-        Info.p("Parser received utterance: " + u)
-        u_sentence = Sentence([p for p in self.phrases if p.found_in(u)])
-        Info.p('Utterance phrases: ' + str(u_sentence.get_phrases()))
-        Sentence.compute_score(self.sentences, u_sentence)
+        Returns:
+            str: u, or for a bag of words, its words with confidence >=
+                0.5 (most confident first).
+        '''
+        if isinstance(u, dict):
+            return ' '.join(sorted(
+                [w for w, conf in u.iteritems() if conf >= 0.5],
+                key=lambda w: (-u[w], w)))
+        return u
 
-        # Apply L.
-        for c in self.commands:
-            c.apply_l(self.sentences)
-        Numbers.normalize(self.commands, 'lang_score')
+    def _match(self, u):
+        '''
+        Args:
+            u (str|{str: float}): Utterance (or grounding query), or a
+                weighted bag of words.
+
+        Returns:
+            Sentence: The phrases found in u (weighted, for a bag of
+                words).
+        '''
+        vocab = self.grammar.vocab
+        if isinstance(u, dict):
+            id_weights = vocab.match_weights(u)
+            weights = {}
+            for phrase_id, weight in id_weights.iteritems():
+                weights[self.phrases[phrase_id]] = weight
+            return Sentence(
+                [self.phrases[i] for i in sorted(id_weights)], weights)
+        return Sentence([self.phrases[i] for i in vocab.match(u)])
+
+    def _rank(self, u_sentence, commands=None, scorer=None):
+        '''
+        Scores all commands against u_sentence and ranks them. Leaves
+        the commands sorted.
+
+        Args:
+            u_sentence (Sentence): The utterance as a Sentence.
+            commands ([Command], optional): Defaults to None
+                (self.commands).
+            scorer (FactoredScorer, optional): For commands. Defaults
+                to None (self.scorer).
+
+        Returns:
+            [Command]: The top ranked commands (all equally scoring in
+                lang and score).
+        '''
+        if commands is None:
+            commands, scorer = self.commands, self.scorer
+        scorer.score(u_sentence)
 
         # Get top command (calculated by Command.cmp).
-        self.commands.sort(cmp=Command.cmp)
+        commands.sort(cmp=Command.cmp)
 
         # See how many results we got that are top ranked.
-        first_cmd = self.commands[0]
+        first_cmd = commands[0]
         top_lscore = first_cmd.lang_score
         top_cscore = first_cmd.score
-        top_cmds = [
-            c for c in self.commands if
+        return [
+            c for c in commands if
             Numbers.are_floats_close(c.lang_score, top_lscore) and
             Numbers.are_floats_close(c.score, top_cscore, CSCORE_EPSILON)]
-        if len(top_cmds) == 1:
-            # One top command; return it.
-            rc = RobotCommand.from_command(first_cmd, u_sentence, u)
-        else:
-            # Multiple top commands; ask to clarify.
-            # See if we can be more specific about clarifying.
-            rc = self._get_clarify_rc(top_cmds, u)
 
-        # We return a standard representation of the command.
-        self._log_results(rc)
-        self.lock.release()
-        return rc
+    def _rank_candidates(self, u_sentence, context):
+        '''
+        Ranks only the commands a clarification was between.
+
+        Args:
+            u_sentence (Sentence): The utterance as a Sentence.
+            context (ClarifyContext)
 
-    def ground(self, gq):
+        Returns:
+            ([Command], [Command]|None): The candidates (sorted) and the
+                top ranked of them; (None, None) if the candidates
+                aren't all there, u_sentence has phrases they don't, or
+                it doesn't narrow them down.
+        '''
+        if self.command_index is None:
+            self.command_index = {}
+            for cmd in self.commands:
+                self.command_index[cmd.get_key()] = cmd
+        if not all([key in self.command_index for key in context.keys]):
+            return None, None
+        candidates = [self.command_index[key] for key in context.keys]
+        scorer = FactoredScorer(candidates)
+        for p in u_sentence.get_phrases():
+            if not scorer.has_phrase(p):
+                return None, None
+        top_cmds = self._rank(u_sentence, candidates, scorer)
+        if len(top_cmds) == len(candidates):
+            return None, None
+        Info.p('Narrowed %d clarification candidates to %d' % (
+            len(candidates), len(top_cmds)))
+        return candidates, top_cmds
+
+    def _make_rc(self, top_cmds, u_sentence, u):
         '''
         Args:
-            gq (str): Grounding query.
+            top_cmds ([Command]): Result of _rank(...).
+            u_sentence (Sentence): The utterance as a Sentence.
+            u (str): Utterance: what we heard the user say.
 
         Returns:
-            {str: float}: Map of obj : P(obj).
+            RobotCommand: The top command, or a clarification.
         '''
-        self.lock.acquire()
+        if len(top_cmds) == 1:
+            # One top command; return it.
+            return RobotCommand.from_command(top_cmds[0], u_sentence, u)
+        # Multiple top commands; ask to clarify.
+        # See if we can be more specific about clarifying.
+        return self._get_clarify_rc(top_cmds, u)
 
-        res = {}
-        gq_sentence = Sentence([p for p in self.phrases if p.found_in(gq)])
-        opts = [o for o in self.options if isinstance(o, ObjectOption)]
+    def _ground(self, gq_sentence):
+        '''
+        Args:
+            gq_sentence (Sentence): The grounding query as a Sentence.
+                There must be objects.
 
-        # Check if we don't have any objects (actually quite common).
-        if len(opts) == 0:
-            Warn.p("Trying to do grounding with no objects; empty result.")
-            self.lock.release()
-            return res
-
-        scores = []
-        for o in opts:
-            phrase_sets = o.get_phrases()
-            sentences = [Sentence(phrases) for phrases in phrase_sets]
-            # Match with grounding scores for phrases.
-            Sentence.compute_score(
-                sentences,
-                gq_sentence,
-                normalize=False,
-                ground=True
-            )
-            best_score = max([s.score for s in sentences])
-            scores += [best_score]
+        Returns:
+            {str: float}: Map of obj : P(obj).
+        '''
+        # Each object's best phrase set score (see GroundingIndex).
+        scores = self.grounder.score(gq_sentence)
 
         # Normalize to valid probability distribution and save.
         scores = Numbers.normalize_list(scores, GROUND_BASE_SCORE)
+        opts = self.grounder.obj_opts
+        res = {}
         for i in range(len(scores)):
             res[opts[i].name] = scores[i]
-
-        # Log for convenience
-        Info.p("Grounding for query: " + gq)
-        for obj, prob in res.iteritems():
-            Info.pl(1, obj + ": " + str(prob))
-
-        self.lock.release()
         return res
 
     def _get_clarify_rc(self, top_cmds, u):
@@ -320,39 +797,34 @@ class Parser(object):
                 # Doesn't match; we need to clarify the basic command.
                 return RobotCommand.from_strs('clarify', [], [], u)
 
-        # If we made it here, all top commands have the same template.
-        # Thus, we can look for options to clarify. n^3 computation.
-        clarify_args = set()
-        for cmd1 in top_cmds:
-            for cmd2 in top_cmds:
-                for opt_name, opt_val in cmd1.option_map.iteritems():
-                    if cmd2.option_map[opt_name] != opt_val:
-                        clarify_args.add(opt_name)
+        # If we made it here, all top commands have the same template
+        # (so the same option names). In one pass, collect the distinct
+        # options each name takes; those with more than one differ.
+        # (Options compare by identity, and are shared between
+        # commands.)
+        opt_vals = defaultdict(set)  # opt name: set(id(Option))
+        for cmd in top_cmds:
+            for opt_name, opt_val in cmd.option_map.iteritems():
+                opt_vals[opt_name].add(id(opt_val))
+        clarify_args = set([
+            opt_name for opt_name, vals in opt_vals.iteritems()
+            if len(vals) > 1])
         return RobotCommand.from_strs('clarify', list(clarify_args), [], u)
 
-    def _log_results(self, rc):
+    def _log_results(self, rc, commands):
         '''
         Write results of parse to log.
 
         Args:
             rc (RobotCommand): What we're returning.
+            commands ([Command]): What was ranked (sorted).
         '''
         if Info.printing:
-            # Display sentences.
-            self.sentences.sort(key=attrgetter('score'), reverse=True)
-            topscore = self.sentences[0].score
-            Info.p('Top sentences:')
-            for s in self.sentences:
-                if s.score == topscore:
-                    Info.pl(1, s)
-                else:
-                    break
-
             # Display commands.
-            top_lscore = self.commands[0].lang_score
-            top_cscore = self.commands[0].score
+            top_lscore = commands[0].lang_score
+            top_cscore = commands[0].score
             Info.p("Top commands:")
-            for c in self.commands[:10]:
+            for c in commands[:10]:
                 Info.pl(1, c)
                 # if c.lang_score == top_lscore and c.score == top_cscore:
                 #     Info.pl(1, c)
@@ -363,24 +835,31 @@ class Parser(object):
             Info.p('Returning command: %s' % (str(rc)))
             Info.p('.... with phrases: %s' % (' '.join(rc.phrases)))
 
-    def _update_world_internal(self):
+    def _update_world_internal(self, generate=True):
         '''
         Re-generates all phrases, options, parameters, templates,
-        commands, sentences based on (presumably) updated world objects
+        commands, and the scorer based on (presumably) updated world objects
         and/or robot state.
 
         The following must be set prior to calling:
             - self.world_objects ([WorldObject])
             - self.robot (Robot)
+
+        Args:
+            generate (bool, optional): Whether the world objects changed
+                (so the commands need generating), or only the robot.
+                Defaults to True.
         '''
-        self._update_world_internal_generate()
+        if generate:
+            self._update_world_internal_generate()
         self._update_world_internal_score()
 
     def _update_world_internal_generate(self):
         '''
         This part generates all templates (phrases, options, commands,
-        sentences) and takes a long time. It doesn't apply the world
-        objects or robot to the prior scores.
+        scorer) and takes a long time. It doesn't apply the world
+        objects or robot to the prior scores. Only what depends on the
+        world objects is made anew (see CompiledGrammar.static_templates).
         '''
         # Timing
         # Time the generation, as it probably isn't woth the
@@ -391,7 +870,7 @@ class Parser(object):
 
         # Make templates (this extracts options and params).
         self.phrases, self.options, self.templates = (
-            self.command_dict.get_grammar(self.world_objects))
+            self.grammar.get_grammar(self.world_objects))
 
         # Timing
         gitems = len(self.phrases) + len(self.options) + len(self.templates)
@@ -405,30 +884,40 @@ class Parser(object):
             Debug.pl(1, t)
         Info.p("Templates: " + str(len(self.templates)))
 
-        # Make commands
-        self.commands = [ct.generate_commands() for ct in self.templates]
-        self.commands = [i for s in self.commands for i in s]  # Flatten.
+        # Make commands. Templates without objects are the same for
+        # every world, so their commands are made once (per Parser, as
+        # commands hold this Parser's scores).
+        if self.static_commands is None:
+            self.static_commands = {}
+            for ct in self.grammar.static_templates:
+                self.static_commands[ct] = ct.generate_commands()
+        self.template_commands = [
+            self.static_commands[ct] if ct in self.static_commands
+            else ct.generate_commands()
+            for ct in self.templates]
+        self.commands = [
+            c for cmds in self.template_commands for c in cmds]  # Flatten.
+        self.command_index = None
         Info.p("Commands: " + str(len(self.commands)))
 
         # Timing
         times += [(time.time(), "make commands (%d)" % (len(self.commands)))]
 
-        # Make sentences
-        self.sentences = [c.generate_sentences() for c in self.commands]
-        self.sentences = [i for s in self.sentences for i in s]  # Flatten.
-        Info.p("Sentences: " + str(len(self.sentences)))
+        # Prepare to score commands with (implicit) sentences.
+        self.scorer = FactoredScorer(self.commands)
+        Info.p("Sentences: " + str(self.scorer.n_sentences))
 
         # Timing
-        times += [(time.time(), "make sentences (%d)" % (len(self.sentences)))]
+        times += [(time.time(), "make scorer (%d)" % (
+            len(self.scorer.options)))]
 
-        # Pre-score commands with all possible sentences.
-        for c in self.commands:
-            c.score_match_sentences(self.sentences)  # Auto-normalizes.
+        # Index objects' phrases for grounding.
+        self.grounder = GroundingIndex(
+            [o for o in self.options if isinstance(o, ObjectOption)])
 
         # Timing
-        cxs = len(self.commands) * len(self.sentences)
-        times += [
-            (time.time(), "score match commands w/ sentences (%d)" % (cxs))]
+        times += [(time.time(), "make grounder (%d)" % (
+            len(self.grounder.index)))]
         self._display_timing(times)
 
     def _display_timing(self, tuples):
@@ -453,8 +942,14 @@ class Parser(object):
         is relatively fast. This alone can be called if the world
         objects are identicial in core properties.
         '''
+        # Start from the commands in template order (ranking sorts
+        # them), with fresh scores.
+        self.commands = [
+            c for cmds in self.template_commands for c in cmds]  # Flatten.
+
         # Apply W and R to weight C prior.
         for c in self.commands:
+            c.score = N.START_SCORE
             c.apply_w()
             c.apply_r(self.robot)
         Numbers.normalize(self.commands, min_score=N.MIN_SCORE)
@@ -0,0 +1,423 @@
+'''A pool of parser worker processes, for using all of a machine's cores.
+
+    - World and robot updates are broadcast to every worker (each has
+        its own control queue).
+
+    - Queries (parse, ground, describe, ...) are load-balanced: all
+        workers pull from one request queue.
+
+    - Each query carries the world version it was made against, so a
+        worker never answers it with an older world. Each worker reads
+        its updates as they come (on a thread), keeping only the latest
+        state, which it applies when its next query needs it; so idle
+        workers don't pile up updates.
+
+    - Workers that die fail the query they were answering (and, once
+        none are left, all queries), rather than leaving them waiting.
+
+    - Workers can start from a fully initialized Parser, rather than
+        each building one. With fork (e.g. Linux), they inherit it;
+        otherwise it's pickled to them (see Parser.snapshot()). This
+        saves startup time, not memory: queries write scores onto every
+        Command (and reading any object writes its reference count), so
+        each worker soon has its own copy of most of the parser.
+
+ParserPool has the same API as Parser, so a Frontend can use one in
+place of a Parser.
+'''
+
+__author__ = 'mbforbes'
+
+
+########################################################################
+# Imports
+########################################################################
+
+# Builtins
+import gc
+import itertools
+import multiprocessing
+import Queue
+import threading
+import time
+import traceback
+
+# Local
+from dispatch import Future
+from hybridbayes import Parser
+from util import Logger, Error
+
+
+########################################################################
+# Constants
+########################################################################
+
+# How often (seconds) to check that workers are alive.
+LIVENESS_INTERVAL = 0.5
+
+# A worker's current request ID when it has none.
+NO_REQUEST = -1
+
+
+########################################################################
+# Classes
+########################################################################
+
+class ParserPool(object):
+    '''Parser-compatible front for a pool of worker processes.'''
+
+    def __init__(self, n_workers=None, parser=None):
+        '''
+        Args:
+            n_workers (int, optional): Defaults to None (one per CPU).
+            parser (Parser, optional): Initialized parser for all
+                workers to start from; don't use it after. Defaults to
+                None (each worker makes its own).
+        '''
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        self.lock = threading.Lock()
+        self.version = 0
+        self.ids = itertools.count()
+        self.futures = {}  # request id: (Future, capture buffer|None)
+
+        # Mirror the parser state, for display.
+        self.world_objects = None if parser is None else parser.world_objects
+        self.robot = None if parser is None else parser.robot
+
+        # Collect now, so each worker doesn't inherit (and collect) the
+        # garbage.
+        gc.collect()
+
+        self.requests = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.controls = []
+        self.workers = []
+        self.currents = []  # Each worker's current request ID (shared).
+        self.dead = set()  # Indices of workers found dead.
+        self.closing = False
+        for idx in range(n_workers):
+            control = multiprocessing.Queue()
+            current = multiprocessing.Value('l', NO_REQUEST, lock=False)
+            worker = multiprocessing.Process(
+                target=_worker_main,
+                args=(control, self.requests, self.results, current, parser))
+            worker.daemon = True
+            worker.start()
+            self.controls += [control]
+            self.workers += [worker]
+            self.currents += [current]
+
+        self.collector = threading.Thread(target=self._collect)
+        self.collector.daemon = True
+        self.collector.start()
+
+    ####################################################################
+    # API (same as Parser)
+    ####################################################################
+
+    def set_world(self, world_objects=None, robot=None):
+        '''
+        Broadcasts a world and/or robot update to all workers. Like
+        Parser.set_world(...), only updates parameters that are not
+        None. Doesn't wait for workers; later queries will.
+
+        Args:
+            world_objects ([WorldObject], optional): Defaults to None.
+            robot ([Robot], optional): Defaults to None.
+        '''
+        self.lock.acquire()
+        if world_objects is not None:
+            self.world_objects = world_objects
+        if robot is not None:
+            self.robot = robot
+        self.version += 1
+        for control in self.controls:
+            control.put((self.version, world_objects, robot))
+        self.lock.release()
+
+    def describe(self):
+        '''
+        Returns:
+            {str: str}: Map of object names to their description.
+        '''
+        return self.submit('describe').result()
+
+    def parse(self, u):
+        '''
+        Args:
+            u (str|{str: float}): utterance
+
+        Returns:
+            RobotCommand: The top command, or a clarification.
+        '''
+        return self.submit('parse', u).result()
+
+    def parse_in_context(self, u, context=None):
+        '''
+        Args:
+            u (str|{str: float}): utterance
+            context (ClarifyContext, optional): Defaults to None.
+
+        Returns:
+            (RobotCommand, ClarifyContext|None)
+        '''
+        return self.submit('parse_in_context', u, context).result()
+
+    def parse_nbest(self, hyps, k=5):
+        '''
+        Args:
+            hyps (str|[(str, float)])
+            k (int, optional): Defaults to 5.
+
+        Returns:
+            [RobotCommand]
+        '''
+        return self.submit('parse_nbest', hyps, k).result()
+
+    def ground(self, gq):
+        '''
+        Args:
+            gq (str): Grounding query.
+
+        Returns:
+            {str: float}: Map of obj : P(obj).
+        '''
+        return self.submit('ground', gq).result()
+
+    def parse_batch(self, utterances):
+        '''
+        Splits utterances across all workers.
+
+        Args:
+            utterances ([str|{str: float}])
+
+        Returns:
+            [RobotCommand]: One per utterance, in order.
+        '''
+        return self._split('parse_batch', utterances)
+
+    def ground_batch(self, gqs):
+        '''
+        Splits grounding queries across all workers.
+
+        Args:
+            gqs ([str])
+
+        Returns:
+            [{str: float}]: One per query, in order.
+        '''
+        return self._split('ground_batch', gqs)
+
+    ####################################################################
+    # Pool-specific
+    ####################################################################
+
+    def submit(self, method, *args):
+        '''
+        Queues a query for any worker, against the latest world. If
+        logging is muted on the calling thread (see Logger.mute(...)),
+        the worker doesn't log it either. If the calling thread is
+        capturing its log (see Logger.start_capture()), the worker's log
+        goes there.
+
+        Args:
+            method (str): Name of the Parser method to call.
+            args ([object]): Arguments to call it with.
+
+        Returns:
+            Future: Resolves to what the Parser method returns (or
+                raises RuntimeError if no workers are left).
+        '''
+        future = Future()
+        self.lock.acquire()
+        if len(self.dead) == len(self.workers):
+            self.lock.release()
+            future.set_exception(_worker_died_exc('No parser workers left.'))
+            return future
+        req_id = next(self.ids)
+        self.futures[req_id] = (future, Logger.get_capture())
+        self.requests.put(
+            (req_id, self.version, Logger.is_muted(), method, args))
+        self.lock.release()
+        return future
+
+    def close(self):
+        '''Stops all workers once queued queries are answered.'''
+        self.closing = True
+        for worker in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.results.put(None)
+        self.collector.join()
+
+    def _split(self, method, items):
+        '''
+        Args:
+            method (str): Name of a Parser batch method.
+            items ([object]): Its argument.
+
+        Returns:
+            [object]: The concatenated results.
+        '''
+        n_chunks = len(self.workers)
+        size = (len(items) + n_chunks - 1) / n_chunks
+        futures = [
+            self.submit(method, items[i:i + size])
+            for i in range(0, len(items), max(size, 1))]
+        res = []
+        for future in futures:
+            res += future.result()
+        return res
+
+    def _collect(self):
+        '''
+        Resolves futures as workers answer, and checks that workers are
+        alive (runs on a thread).
+        '''
+        last_check = time.time()
+        while True:
+            if time.time() - last_check >= LIVENESS_INTERVAL:
+                self._check_workers()
+                last_check = time.time()
+            try:
+                msg = self.results.get(True, LIVENESS_INTERVAL)
+            except Queue.Empty:
+                continue
+            if msg is None:
+                return
+            req_id, ok, res, log = msg
+            self.lock.acquire()
+            future, capture = self.futures.pop(req_id, (None, None))
+            self.lock.release()
+            if future is None:
+                continue  # Already failed (see _check_workers()).
+
+            # Pass along the worker's log, for whoever's capturing or
+            # buffering.
+            if len(log) > 0 and capture is not None:
+                capture += [log]
+            elif len(log) > 0 and Logger.buffer_printing:
+                Logger.print_buffer += [log]
+            if ok:
+                future.set_result(res)
+            else:
+                Error.p(res)
+                future.set_exception(
+                    (RuntimeError, RuntimeError(res.splitlines()[-1]), None))
+
+    def _check_workers(self):
+        '''
+        Fails the query each newly dead worker was answering, and all
+        queries once no workers are left.
+        '''
+        if self.closing:
+            return
+        failed = []
+        self.lock.acquire()
+        for idx, worker in enumerate(self.workers):
+            if idx in self.dead or worker.is_alive():
+                continue
+            self.dead.add(idx)
+            msg = 'Parser worker %d died (exit code %s).' % (
+                idx, str(worker.exitcode))
+            Error.p(msg)
+            req_id = self.currents[idx].value
+            if req_id in self.futures:
+                failed += [(self.futures.pop(req_id)[0], msg)]
+        if len(self.dead) == len(self.workers):
+            for future, capture in self.futures.itervalues():
+                failed += [(future, 'No parser workers left.')]
+            self.futures = {}
+        self.lock.release()
+        for future, msg in failed:
+            future.set_exception(_worker_died_exc(msg))
+
+
+########################################################################
+# Functions
+########################################################################
+
+def _worker_died_exc(msg):
+    '''
+    Args:
+        msg (str)
+
+    Returns:
+        tuple: exc_info (see Future.set_exception(...)).
+    '''
+    return (RuntimeError, RuntimeError(msg), None)
+
+
+def _worker_main(control, requests, results, current, parser=None):
+    '''
+    Worker process: applies broadcast updates and answers queries.
+
+    Args:
+        control (multiprocessing.Queue): Broadcast (version,
+            world_objects, robot) updates for this worker.
+        requests (multiprocessing.Queue): Shared (id, version, muted,
+            method, args) queries.
+        results (multiprocessing.Queue): Shared (id, ok, result, log)
+            answers.
+        current (multiprocessing.Value): Set to the ID of the query
+            being answered (NO_REQUEST between queries).
+        parser (Parser, optional): To start from. Defaults to None
+            (make one).
+    '''
+    # Logs are returned with each answer.
+    Logger.buffer_printing = True
+    if parser is None:
+        parser = Parser()
+
+    # The latest update read, merged with those before it, and not yet
+    # applied (None if nothing to apply).
+    state = {'version': 0, 'world_objects': None, 'robot': None}
+    cond = threading.Condition()
+
+    def read_updates():
+        '''Reads updates as they come (runs on a thread).'''
+        while True:
+            version, new_objects, new_robot = control.get()
+            cond.acquire()
+            state['version'] = version
+            if new_objects is not None:
+                state['world_objects'] = new_objects
+            if new_robot is not None:
+                state['robot'] = new_robot
+            cond.notify_all()
+            cond.release()
+
+    reader = threading.Thread(target=read_updates)
+    reader.daemon = True
+    reader.start()
+
+    while True:
+        req = requests.get()
+        if req is None:
+            return
+        req_id, version, muted, method, args = req
+        current.value = req_id
+
+        # Wait for (at least) the query's version, then apply it.
+        cond.acquire()
+        while state['version'] < version:
+            cond.wait()
+        world_objects, robot = state['world_objects'], state['robot']
+        state['world_objects'], state['robot'] = None, None
+        cond.release()
+        if world_objects is not None or robot is not None:
+            parser.set_world(world_objects, robot)
+
+        Logger.get_buffer()  # Drop logs from updates.
+        Logger.mute(muted)
+        try:
+            res = getattr(parser, method)(*args)
+            results.put((req_id, True, res, Logger.get_buffer()))
+        except:
+            # The Parser releases its lock on errors, so it's still
+            # usable for the next query.
+            results.put(
+                (req_id, False, traceback.format_exc(), Logger.get_buffer()))
+        current.value = NO_REQUEST
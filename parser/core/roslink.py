@@ -9,12 +9,12 @@ __author__ = 'mbforbes'
 ########################################################################
 
 # Builtins
-import yaml
+import json
 
 # Local
 from constants import C
 from grammar import ObjectOption
-from util import Debug, Info, Error, Algo
+from util import Debug, Info, Error, Algo, Yaml
 
 
 ########################################################################
@@ -27,9 +27,13 @@ class PropertyGetter(object):
 
     Basically allows checking / gettting properties through an API
     rather than directly.
+
+    Serialized forms (YAML, JSON) are cached until a property is set.
+    Frozen objects (e.g. from factories) can't be set, so each form is
+    computed at most once.
     '''
 
-    def __init__(self, properties=None):
+    def __init__(self, properties=None, frozen=False):
         '''
         Args:
             properties ({str: object}, optional): Mapping of names to
@@ -39,10 +43,14 @@ class PropertyGetter(object):
                 basic testing, a programatiicaly-created dictionary in
                 programtic testing, and the real robot (via a ROS
                 message) in real-robot testing.
+            frozen (bool, optional): Whether set_property(...) is
+                disallowed. Defaults to False.
         '''
         if properties is None:
             properties = {}
         self.properties = properties
+        self.frozen = frozen
+        self.serialized = {}  # format: str
 
     def has_property(self, name):
         '''
@@ -65,14 +73,63 @@ class PropertyGetter(object):
         '''
         return self.properties[name]
 
+    def set_property(self, name, value):
+        '''
+        Sets a property by name.
+
+        Args:
+            name (str)
+            value (object)
+
+        Raises:
+            TypeError: If frozen.
+        '''
+        if self.frozen:
+            raise TypeError("Can't set property of frozen " + repr(self))
+        self.properties[name] = value
+        self.serialized = {}
+
     def to_dict_str(self):
         '''
-        For display (e.g. in web interface).
+        For display (e.g. in web interface). Cached.
+
+        Returns:
+            str: YAML.
+        '''
+        import yaml  # Only needed for display; slow to import.
+        return self._serialize('yaml', yaml.dump)
+
+    def to_json(self):
+        '''
+        For serializing (e.g. for web clients). Cached.
 
         Returns:
             str
         '''
-        return yaml.dump(self.properties)
+        return self._serialize(
+            'json', lambda props: json.dumps(props, sort_keys=True))
+
+    def to_dict(self):
+        '''
+        For serializing (e.g. to JSON).
+
+        Returns:
+            {str: object}: A copy of the properties.
+        '''
+        return dict(self.properties)
+
+    def _serialize(self, fmt, fn):
+        '''
+        Args:
+            fmt (str): Cache key.
+            fn (function): Serializes a properties dict.
+
+        Returns:
+            str
+        '''
+        if fmt not in self.serialized:
+            self.serialized[fmt] = fn(self.properties)
+        return self.serialized[fmt]
 
 
 class WorldObject(PropertyGetter):
@@ -104,9 +161,9 @@ class WorldObject(PropertyGetter):
                 supplied for real robot usage.
 
         Returns:
-            [WorldObject]
+            [WorldObject]: Frozen.
         '''
-        return [WorldObject(obj_dict) for obj_dict in objs]
+        return [WorldObject(dict(obj_dict), True) for obj_dict in objs]
 
     @staticmethod
     def from_ros(world_objects):
@@ -115,7 +172,7 @@ class WorldObject(PropertyGetter):
             world_objects (WorldObjects):ROS-msg format WorldObjects.
 
         Returns:
-            [WorldObject]: Array of our own WorldObject format.
+            [WorldObject]: Array of our own WorldObject format (frozen).
         '''
         wobjs = []
         # rwo = ros world object
@@ -158,7 +215,7 @@ class WorldObject(PropertyGetter):
                     if len(rwo_val) == 2:
                         props[op_boolarr] = rwo_val
 
-            wobjs += [WorldObject(props)]
+            wobjs += [WorldObject(props, True)]
         return wobjs
 
     @staticmethod
@@ -167,8 +224,8 @@ class WorldObject(PropertyGetter):
         data), must get exhaustive list of objs.
         '''
         all_opts = []
-        for k, prop in yaml.load(
-                open(C.command_grammar))['descriptors'].iteritems():
+        for k, prop in Yaml.load(
+                C.command_grammar)['descriptors'].iteritems():
             opts = [(k, o) for o in prop['options']]
             all_opts += [opts]
 
@@ -194,6 +251,18 @@ class Robot(PropertyGetter):
     Provides an interface for accessing robot data.
     '''
 
+    @staticmethod
+    def from_dict(props):
+        '''
+        Args:
+            props ({str: object}): Mapping from property name to value
+                (e.g. the YAML-loaded 'robot' component of world dict).
+
+        Returns:
+            Robot: Frozen.
+        '''
+        return Robot(dict(props), True)
+
     @staticmethod
     def from_ros(robot_state):
         '''
@@ -201,7 +270,7 @@ class Robot(PropertyGetter):
             robot_state (RobotState): From ROS.
 
         Returns:
-            Robot
+            Robot: Frozen.
         '''
         props = {}
 
@@ -227,7 +296,7 @@ class Robot(PropertyGetter):
             if len(val) == 2:
                 props[rosname] = val
 
-        return Robot(props)
+        return Robot(props, True)
 
 
 class RobotCommand(object):
@@ -236,7 +305,9 @@ class RobotCommand(object):
     read).
     '''
 
-    def __init__(self, name, args, phrases, utterance):
+    def __init__(
+            self, name, args, phrases, utterance, lang_score=None,
+            score=None):
         '''
         Used internally. Use a factory if you're calling this from
         outside this class.
@@ -246,11 +317,17 @@ class RobotCommand(object):
             args ([str])
             phrases ([str])
             utterance (str)
+            lang_score (float, optional): The Command's language score,
+                if made from one. Defaults to None.
+            score (float, optional): The Command's world and robot
+                score, if made from one. Defaults to None.
         '''
         self.name = name
         self.args = args
         self.phrases = phrases
         self.utterance = utterance
+        self.lang_score = lang_score
+        self.score = score
 
     @staticmethod
     def from_command(command, u_sentence, u):
@@ -272,12 +349,9 @@ class RobotCommand(object):
         # is the name of the command itself.
         opt_names = command.opt_str_list()[1:]
 
-        # Get phrases by matching each option with the sentence.
-        u_phrases = u_sentence.get_phrases()
-
-        # Mark phrases as seen.
-        for p in u_phrases:
-            p.seen = True
+        # Get phrases by matching each option with the sentence: what
+        # was heard, and how confidently.
+        matched = u_sentence.get_matched()
 
         # Match w/ options.
         phrase_strs = []
@@ -291,26 +365,29 @@ class RobotCommand(object):
             # The following is for non-object options:
             # Strategy: return the full option phrase set that has the
             # highest number of phrase hits. Definitely do one for each
-            # option.
-            opt_phrase_sets = opt.get_phrases()
+            # option. Only sets with a heard phrase can score above 0.
+            index, joined = opt.get_phrase_lookup()
+            hit_sets = set()
+            for phrase in matched:
+                if phrase in index:
+                    hit_sets.update(index[phrase])
             # Just pick first by default, as we want something.
-            best_set, best_set_score = opt_phrase_sets[0], -1
-            for phrase_set in opt_phrase_sets:
+            best_idx, best_set_score = 0, 0
+            opt_phrase_sets = opt.get_phrases()
+            for idx in sorted(hit_sets):
                 set_score = 0
-                for phrase in phrase_set:
-                    if phrase.seen:
-                        set_score += phrase.get_match_score()
+                for phrase in opt_phrase_sets[idx]:
+                    if phrase in matched:
+                        set_score += phrase.get_match_score() * matched[phrase]
                 if set_score > best_set_score:
                     best_set_score = set_score
-                    best_set = phrase_set
+                    best_idx = idx
             # Add best.
-            phrase_strs += [' '.join([str(p) for p in best_set])]
-
-        # Unmark phrases.
-        for p in u_phrases:
-            p.seen = False
+            phrase_strs += [joined[best_idx]]
 
-        return RobotCommand(verb, opt_names, phrase_strs, u)
+        return RobotCommand(
+            verb, opt_names, phrase_strs, u, command.lang_score,
+            command.score)
 
     @staticmethod
     def from_strs(name, args, phrases=[], utterance=''):
@@ -328,6 +405,22 @@ class RobotCommand(object):
         '''
         return RobotCommand(name, args, phrases, utterance)
 
+    def to_dict(self):
+        '''
+        For serializing (e.g. to JSON).
+
+        Returns:
+            {str: object}
+        '''
+        return {
+            'name': self.name,
+            'args': self.args,
+            'phrases': self.phrases,
+            'utterance': self.utterance,
+            'lang_score': self.lang_score,
+            'score': self.score,
+        }
+
     def to_rosmsg(self):
         '''
         Returns ROS representation of this command.
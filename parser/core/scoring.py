@@ -0,0 +1,369 @@
+'''Factorized language scoring of Commands, and indexed grounding.
+
+A Command's Sentences are the cartesian product of its Options' phrase
+sets, and a Sentence's score is the sum of the scores of its matched
+Phrases. So a Sentence's score is a sum of independent per-Option
+contributions, and we never need to enumerate Sentences to score
+Commands:
+
+    - Score each Option's phrase sets once per utterance. This gives a
+        distribution over the values the Option can contribute (each
+        phrase set is equally likely).
+
+    - Convolve a Command's Option distributions to get the distribution
+        over its Sentences' scores. Commands from the same template
+        share prefixes of Options, so partial convolutions are cached.
+
+    - Apply the make_prob(...) transform to the values of that
+        distribution and take the expectation; this is exactly the mean
+        of the transformed Sentence scores, which is the Command's
+        language score.
+
+The only approximation available is a switch (approx_support) that caps
+the size of the intermediate distributions; it is off by default.
+
+Grounding (GroundingIndex) scores each object by its best-matching
+phrase set. Phrase sets are indexed by the phrases in them when the
+world is set, so a query only scores the phrase sets its phrases are in.
+
+The Options' phrase sets are kept as flat arrays of phrase IDs, and
+scoring reads what was heard from a per-request array indexed by them
+(never writing to Phrases), so scoring touches few Python objects.
+'''
+
+__author__ = 'mbforbes'
+
+
+########################################################################
+# Imports
+########################################################################
+
+# Builtins
+from array import array
+from collections import defaultdict
+
+# Local
+from util import Numbers
+
+
+########################################################################
+# Classes
+########################################################################
+
+class FactoredScorer(object):
+    '''Computes Command.lang_score for a set of Commands, as if all of
+    their Sentences were scored (Sentence.compute_score(...)) and
+    marginalized over, without generating any Sentences.
+    '''
+
+    # When not None, distributions with more than this many distinct
+    # values are merged into this many (probability-weighted mean)
+    # bins. This bounds the convolution cost, but is approximate, as
+    # the exponential decay of the mean isn't the mean of the decays.
+    # None (the default) means exact.
+    approx_support = None
+
+    def __init__(self, commands):
+        '''
+        Args:
+            commands ([Command])
+        '''
+        self.commands = commands
+
+        # Options are shared between commands; we score each once.
+        self.options = []
+        seen_opts = set()
+        for cmd in commands:
+            for opt in cmd.option_map.itervalues():
+                if opt not in seen_opts:
+                    seen_opts.add(opt)
+                    self.options += [opt]
+
+        # Phrase sets as arrays. The phrase sets of option i are
+        # set_phrases[i][set_ends[i][j - 1]:set_ends[i][j]] (phrase IDs).
+        self.set_phrases = []
+        self.set_ends = []
+        ids = set()
+        for opt in self.options:
+            phrase_ids, ends = array('i'), array('i')
+            for id_set in opt.get_phrase_ids():
+                phrase_ids.extend(id_set)
+                ids.update(id_set)
+                ends.append(len(phrase_ids))
+            self.set_phrases += [phrase_ids]
+            self.set_ends += [ends]
+
+        # Which phrase IDs (up to the largest) are in any option.
+        self.n_phrases = 1 + max(ids) if ids else 0
+        self.in_options = bytearray(self.n_phrases)
+        for phrase_id in ids:
+            self.in_options[phrase_id] = 1
+
+        # How many sentences there would be, were we to make them.
+        self.n_sentences = 0
+        for cmd in commands:
+            n = 1
+            for opt in cmd.option_map.itervalues():
+                n *= len(opt.get_phrases())
+            self.n_sentences += n
+
+    def has_phrase(self, phrase):
+        '''
+        Args:
+            phrase (Phrase)
+
+        Returns:
+            bool: Whether phrase is in any of the commands' options.
+        '''
+        return phrase.id < self.n_phrases and self.in_options[phrase.id] == 1
+
+    def score(self, u_sentence):
+        '''
+        Sets lang_score for all commands (normalized across
+        commands).
+
+        Args:
+            u_sentence (Sentence): The utterance as a Sentence.
+        '''
+        self.score_hyps([u_sentence], [1.0])
+
+    def score_hyps(self, u_sentences, weights):
+        '''
+        Sets lang_score for all commands to the weighted mixture of
+        their (normalized) language scores under each utterance
+        hypothesis. All hypotheses are scored in one pass over the
+        commands.
+
+        Args:
+            u_sentences ([Sentence]): Utterance hypotheses as Sentences.
+            weights ([float]): Confidence of each hypothesis; should
+                sum to 1.0.
+        '''
+        if len(self.commands) == 0:
+            return
+
+        # Per-hypothesis option distributions and the max over all
+        # sentences (what make_prob(...) scales by), which is the max
+        # over commands of the sum of their options' maxes.
+        hyp_dists, hyp_maxes = [], []
+        for u_sentence in u_sentences:
+            opt_dists, opt_maxes = self._score_options(u_sentence)
+            hyp_dists += [opt_dists]
+            hyp_maxes += [max([
+                sum([opt_maxes[opt] for opt in cmd.option_map.itervalues()])
+                for cmd in self.commands])]
+
+        # raw[h][c] is command c's unnormalized score under hypothesis h.
+        raw = [[] for u_sentence in u_sentences]
+        caches = [{} for u_sentence in u_sentences]
+        for cmd in self.commands:
+            for h in range(len(u_sentences)):
+                if hyp_maxes[h] == 0.0:
+                    # make_prob(...) gives every sentence the same
+                    # score, so every command gets the same (mean)
+                    # score.
+                    raw[h] += [1.0 / self.n_sentences]
+                    continue
+                dist = self._command_dist(cmd, hyp_dists[h], caches[h])
+                raw[h] += [sum([
+                    prob * Numbers.prob_decay(val, hyp_maxes[h])
+                    for val, prob in dist.iteritems()])]
+
+        sums = [sum(scores) for scores in raw]
+        for idx, cmd in enumerate(self.commands):
+            cmd.lang_score = sum([
+                weights[h] * raw[h][idx] / sums[h]
+                for h in range(len(u_sentences))])
+        Numbers.normalize(self.commands, 'lang_score')
+
+    def _score_options(self, u_sentence):
+        '''
+        Args:
+            u_sentence (Sentence): The utterance as a Sentence.
+
+        Returns:
+            ({Option: {float: float}}, {Option: float}): Per-option
+                score distributions and max scores.
+        '''
+        # Score of each phrase (by ID) in the utterance.
+        phrase_scores = [0.0] * self.n_phrases
+        for p in u_sentence.get_phrases():
+            if p.id < self.n_phrases:
+                phrase_scores[p.id] = (
+                    p.get_match_score() * u_sentence.get_weight(p))
+
+        opt_dists = {}
+        opt_maxes = {}
+        for idx, opt in enumerate(self.options):
+            opt_dists[opt], opt_maxes[opt] = self._score_option(
+                idx, phrase_scores)
+        return opt_dists, opt_maxes
+
+    def _score_option(self, idx, phrase_scores):
+        '''
+        Args:
+            idx (int): Index of the option (into self.options).
+            phrase_scores ([float]): Score of each phrase (by ID) in the
+                utterance.
+
+        Returns:
+            ({float: float}, float): The distribution of the scores of
+                the option's phrase sets (map of score: probability),
+                and the max score.
+        '''
+        phrase_ids, ends = self.set_phrases[idx], self.set_ends[idx]
+        p_set = 1.0 / len(ends)
+        dist = defaultdict(float)
+        start = 0
+        for end in ends:
+            set_score = 0.0
+            for i in phrase_ids[start:end]:
+                set_score += phrase_scores[i]
+            dist[set_score] += p_set
+            start = end
+        return dist, max(dist.iterkeys())
+
+    def _command_dist(self, cmd, opt_dists, cache):
+        '''
+        Args:
+            cmd (Command)
+            opt_dists ({Option: {float: float}}): Per-option score
+                distributions.
+            cache ({(Option): {float: float}}): Distributions of option
+                prefixes computed so far.
+
+        Returns:
+            {float: float}: Distribution of the scores of cmd's
+                sentences.
+        '''
+        key = ()
+        dist = {0.0: 1.0}
+        for opt in cmd.option_map.itervalues():
+            key += (opt,)
+            if key in cache:
+                dist = cache[key]
+                continue
+            dist = FactoredScorer._convolve(dist, opt_dists[opt])
+            if (FactoredScorer.approx_support is not None and
+                    len(dist) > FactoredScorer.approx_support):
+                dist = FactoredScorer._bin(
+                    dist, FactoredScorer.approx_support)
+            cache[key] = dist
+        return dist
+
+    @staticmethod
+    def _convolve(dist1, dist2):
+        '''
+        Args:
+            dist1 ({float: float})
+            dist2 ({float: float})
+
+        Returns:
+            {float: float}: The distribution of the sum.
+        '''
+        res = defaultdict(float)
+        for val1, prob1 in dist1.iteritems():
+            for val2, prob2 in dist2.iteritems():
+                res[val1 + val2] += prob1 * prob2
+        return res
+
+    @staticmethod
+    def _bin(dist, n_bins):
+        '''
+        Merges dist into n_bins equal-width bins, each represented by
+        the probability-weighted mean of its values.
+
+        Args:
+            dist ({float: float})
+            n_bins (int)
+
+        Returns:
+            {float: float}
+        '''
+        lo, hi = min(dist.iterkeys()), max(dist.iterkeys())
+        width = (hi - lo) / n_bins
+        masses = defaultdict(float)
+        weighted = defaultdict(float)
+        for val, prob in dist.iteritems():
+            idx = min(int((val - lo) / width), n_bins - 1)
+            masses[idx] += prob
+            weighted[idx] += val * prob
+        res = defaultdict(float)
+        for idx, mass in masses.iteritems():
+            if mass > 0.0:
+                res[weighted[idx] / mass] += mass
+        return res
+
+
+class GroundingIndex(object):
+    '''Ground scores for a set of ObjectOptions, as if each of their
+    phrase sets were made a Sentence and scored with
+    Sentence.compute_score(..., ground=True), but only scoring the
+    phrase sets that contain a phrase of the query.
+    '''
+
+    def __init__(self, obj_opts):
+        '''
+        Args:
+            obj_opts ([ObjectOption])
+        '''
+        self.obj_opts = obj_opts
+
+        # Each object's phrase sets, as (phrase, ground score) tuples in
+        # the original order. Phrases that score 0.0 can't change a sum,
+        # so are left out, and phrase sets that become the same are
+        # kept once (they have the same score).
+        self.phrase_sets = []
+        for opt in obj_opts:
+            phrase_sets = set()
+            for phrase_set in opt.get_phrases():
+                phrase_sets.add(tuple([
+                    (phrase, phrase.get_ground_score())
+                    for phrase in phrase_set
+                    if phrase.get_ground_score() != 0.0]))
+            self.phrase_sets += [list(phrase_sets)]
+
+        # Sparse phrase x (object, phrase set) matrix: for each phrase,
+        # the phrase sets containing it.
+        self.index = defaultdict(list)  # Phrase: [(obj idx, set idx)]
+        for obj_idx, phrase_sets in enumerate(self.phrase_sets):
+            for set_idx, phrase_set in enumerate(phrase_sets):
+                for phrase in set([phrase for phrase, g in phrase_set]):
+                    self.index[phrase] += [(obj_idx, set_idx)]
+
+    def score(self, gq_sentence):
+        '''
+        Args:
+            gq_sentence (Sentence): The grounding query as a Sentence.
+
+        Returns:
+            [float]: The best phrase set score of each ObjectOption (in
+                order).
+        '''
+        weights = {}  # Phrase: float
+        for p in gq_sentence.get_phrases():
+            weight = gq_sentence.get_weight(p)
+            if weight and p in self.index:
+                weights[p] = weight
+
+        # Score only the phrase sets the query touches (others score
+        # 0.0). Phrases are added in phrase set order, as in
+        # Sentence.compute_score(...), so scores are identical.
+        touched = set()
+        for phrase in weights:
+            touched.update(self.index[phrase])
+        set_scores = defaultdict(list)  # obj idx: [float]
+        for obj_idx, set_idx in touched:
+            set_score = 0.0
+            for phrase, ground_score in self.phrase_sets[obj_idx][set_idx]:
+                if phrase in weights:
+                    set_score += ground_score * weights[phrase]
+            set_scores[obj_idx] += [set_score]
+
+        scores = []
+        for obj_idx, phrase_sets in enumerate(self.phrase_sets):
+            obj_scores = set_scores.get(obj_idx, [])
+            if len(obj_scores) < len(phrase_sets):
+                obj_scores = obj_scores + [0.0]
+            scores += [max(obj_scores)]
+        return scores
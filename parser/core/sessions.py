@@ -0,0 +1,341 @@
+'''Many independent worlds (e.g. a fleet of robots) in one process.
+
+    - Each session has its own world objects, robot, and what depends
+        on them (scores, descriptions, and what the last parse asked to
+        clarify), in its own Parser. This includes all its commands:
+        those without objects are the same for every world, but hold
+        the session's scores, so each session makes its own.
+
+    - All sessions share one CompiledGrammar: the phrases and their
+        index (Vocabulary), the word options and the templates (without
+        objects). Matchers are shared by every Parser already.
+
+    - Sessions are made on first use and evicted least-recently-used
+        first: when there are too many, when one has been idle too
+        long, or when they (together) use too much memory.
+
+    - Memory is accounted per session: what its Parser holds that the
+        shared grammar doesn't (see SessionManager.memory(...)).
+
+SessionManager's API is Parser's, with a session ID first.
+'''
+
+__author__ = 'mbforbes'
+
+
+########################################################################
+# Imports
+########################################################################
+
+# Builtins
+from collections import OrderedDict
+import gc
+import sys
+import threading
+import time
+import types
+
+# Local
+from grammar import CompiledGrammar
+from hybridbayes import Parser
+from util import Info
+
+
+########################################################################
+# Constants
+########################################################################
+
+# Not walked when accounting memory: shared by everything.
+SHARED_TYPES = (
+    type, types.ClassType, types.ModuleType, types.FunctionType,
+    types.BuiltinFunctionType, types.MethodType)
+
+
+########################################################################
+# Classes
+########################################################################
+
+class Session(object):
+    '''One world's state.'''
+
+    def __init__(self, session_id, parser):
+        '''
+        Args:
+            session_id (object): Any hashable.
+            parser (Parser): This session's own.
+        '''
+        self.session_id = session_id
+        self.parser = parser
+
+        # What the last parse asked to clarify, if it did (see
+        # Parser.parse_in_context(...)).
+        self.clarify_context = None
+
+        # When last used (time.time()).
+        self.last_used = time.time()
+
+        # Bytes used (see SessionManager.memory(...)); None until
+        # measured for the current world.
+        self.size = None
+
+
+class SessionManager(object):
+    '''Parser-like front for many sessions sharing one grammar.'''
+
+    def __init__(
+            self, grammar=None, max_sessions=None, max_idle=None,
+            max_bytes=None):
+        '''
+        Args:
+            grammar (CompiledGrammar, optional): For all sessions.
+                Defaults to None (the process's; see
+                CompiledGrammar.load(...)).
+            max_sessions (int, optional): Defaults to None (no limit).
+            max_idle (float, optional): Seconds a session is kept
+                unused. Defaults to None (no limit).
+            max_bytes (int, optional): Memory all sessions may use
+                together; checked on world updates. Defaults to None (no
+                limit).
+        '''
+        if grammar is None:
+            grammar = CompiledGrammar.load()
+        self.grammar = grammar
+        self.max_sessions = max_sessions
+        self.max_idle = max_idle
+        self.max_bytes = max_bytes
+
+        # Map of session ID: Session, least recently used first.
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+        # IDs of what's reachable from the grammar, which sessions don't
+        # pay for. Made on first use (see memory(...)).
+        self.shared_ids = None
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self.sessions
+
+    ####################################################################
+    # API (same as Parser, plus session ID)
+    ####################################################################
+
+    def set_world(self, session_id, world_objects=None, robot=None):
+        '''
+        Like Parser.set_world(...), only updates parameters that are
+        not None. Makes the session if it's new.
+
+        Args:
+            session_id (object)
+            world_objects ([WorldObject], optional): Defaults to None.
+            robot ([Robot], optional): Defaults to None.
+        '''
+        session = self.get(session_id)
+        session.parser.set_world(world_objects, robot)
+        session.size = None
+        if self.max_bytes is not None:
+            self._evict_for_memory(session_id)
+
+    def parse(self, session_id, u):
+        '''
+        If the session's last parse asked for clarification, the
+        utterance is first tried as an answer to it.
+
+        Args:
+            session_id (object)
+            u (str|{str: float}): utterance
+
+        Returns:
+            RobotCommand|None: The top command, or a clarification.
+                None if the session's world isn't set.
+        '''
+        session = self.get(session_id)
+        rc, session.clarify_context = session.parser.parse_in_context(
+            u, session.clarify_context)
+        return rc
+
+    def parse_nbest(self, session_id, hyps, k=5):
+        '''
+        Args:
+            session_id (object)
+            hyps (str|[(str, float)])
+            k (int, optional): Defaults to 5.
+
+        Returns:
+            [RobotCommand]: Empty if the session's world isn't set.
+        '''
+        return self.get(session_id).parser.parse_nbest(hyps, k)
+
+    def ground(self, session_id, gq):
+        '''
+        Args:
+            session_id (object)
+            gq (str): Grounding query.
+
+        Returns:
+            {str: float}: Map of obj : P(obj). Empty if the session's
+                world isn't set.
+        '''
+        return self.get(session_id).parser.ground(gq)
+
+    def describe(self, session_id):
+        '''
+        Args:
+            session_id (object)
+
+        Returns:
+            {str: str}: Map of object names to their description. Empty
+                if the session's world isn't set.
+        '''
+        return self.get(session_id).parser.describe()
+
+    ####################################################################
+    # Session-specific
+    ####################################################################
+
+    def get(self, session_id):
+        '''
+        Returns the session (made if new) and marks it most recently
+        used. Evicts sessions that are idle too long, or (if it's new)
+        the least recently used one if there are too many.
+
+        Args:
+            session_id (object)
+
+        Returns:
+            Session
+        '''
+        self.lock.acquire()
+        now = time.time()
+        if session_id in self.sessions:
+            # Move to the end (most recently used).
+            session = self.sessions.pop(session_id)
+        else:
+            session = Session(session_id, Parser(grammar=self.grammar))
+            if (self.max_sessions is not None and
+                    len(self.sessions) >= self.max_sessions):
+                self._evict(next(iter(self.sessions)), 'too many sessions')
+        session.last_used = now
+        self.sessions[session_id] = session
+        if self.max_idle is not None:
+            for sid, other in self.sessions.items():
+                if now - other.last_used <= self.max_idle:
+                    break  # The rest were used more recently.
+                self._evict(sid, 'idle')
+        self.lock.release()
+        return session
+
+    def close(self, session_id):
+        '''
+        Drops a session (if it exists).
+
+        Args:
+            session_id (object)
+        '''
+        self.lock.acquire()
+        if session_id in self.sessions:
+            self._evict(session_id, 'closed')
+        self.lock.release()
+
+    def memory(self, session_id=None):
+        '''
+        Bytes used by sessions' own state: everything reachable from
+        their Parser that isn't reachable from the shared grammar.
+
+        This includes all of a session's commands, even those without
+        objects (made once per session, not shared; see
+        CompiledGrammar).
+
+        Measuring walks a session's whole state (under its parser's
+        lock), so it's done once per world update: the world decides
+        nearly all of it (commands, options, scorer and indexes), and
+        caches filled by queries (e.g. descriptions) are not recounted
+        until the next update.
+
+        Args:
+            session_id (object, optional): Defaults to None (all).
+
+        Returns:
+            {object: int}: Map of session ID: bytes.
+        '''
+        self.lock.acquire()
+        if session_id is None:
+            sessions = self.sessions.values()
+        elif session_id in self.sessions:
+            sessions = [self.sessions[session_id]]
+        else:
+            sessions = []
+        self.lock.release()
+
+        if self.shared_ids is None:
+            self.shared_ids = set(_reachable(self.grammar, set()))
+        usage = {}
+        for session in sessions:
+            if session.size is None:
+                session.parser.lock.acquire()
+                owned = _reachable(session.parser, self.shared_ids)
+                session.size = sum(
+                    [sys.getsizeof(obj) for obj in owned.itervalues()])
+                session.parser.lock.release()
+            usage[session.session_id] = session.size
+        return usage
+
+    def _evict_for_memory(self, keep):
+        '''
+        Evicts sessions, least recently used first, until they use at
+        most max_bytes together (or only keep is left).
+
+        Args:
+            keep (object): ID of a session not to evict.
+        '''
+        usage = self.memory()
+        total = sum(usage.values())
+        self.lock.acquire()
+        for sid in self.sessions.keys():
+            if total <= self.max_bytes:
+                break
+            if sid == keep:
+                continue
+            total -= usage.get(sid, 0)
+            self._evict(sid, 'memory')
+        self.lock.release()
+
+    def _evict(self, session_id, reason):
+        '''
+        Must hold lock.
+
+        Args:
+            session_id (object)
+            reason (str): For logging.
+        '''
+        del self.sessions[session_id]
+        Info.p('Evicted session %s (%s)' % (str(session_id), reason))
+
+
+########################################################################
+# Functions
+########################################################################
+
+def _reachable(root, stop_ids):
+    '''
+    Args:
+        root (object)
+        stop_ids (set(int)): IDs of objects not to walk into.
+
+    Returns:
+        {int: object}: Map of ID: object, for root and all objects
+            reachable from it (but not through those in stop_ids, or
+            shared types).
+    '''
+    seen = {}
+    todo = [root]
+    while len(todo) > 0:
+        obj = todo.pop()
+        if (id(obj) in seen or id(obj) in stop_ids or
+                isinstance(obj, SHARED_TYPES)):
+            continue
+        seen[id(obj)] = obj
+        todo += gc.get_referents(obj)
+    return seen
@@ -7,8 +7,11 @@ __author__ = 'mbforbes'
 # Imports
 # ######################################################################
 
+import cPickle
 import os
 import sys
+import tempfile
+import threading
 
 
 # ######################################################################
@@ -21,6 +24,12 @@ INFO_PRINTING_DEFAULT = True
 ERROR_PRINTING_DEFAULT = True
 WARN_PRINTING_DEFAULT = True
 
+# YAML
+# Whether to save pre-parsed (pickled) YAML files next to the originals,
+# to load next time instead (when they're up to date).
+YAML_PICKLE_CACHE = False
+YAML_PICKLE_EXT = '.pickle'
+
 # Numbers
 FLOAT_COMPARE_EPSILON = 0.001
 LENGTH_EXP = 10.0  # Polynomial degree for weight by length (x^this).
@@ -42,6 +51,9 @@ class Logger(object):
     prefix = '[IMPLEMENT ME]'
     print_buffer = []
 
+    # Per-thread state (see mute(...)).
+    local = threading.local()
+
     @classmethod
     def p(cls, obj):
         cls.pl(0, obj)
@@ -53,18 +65,72 @@ class Logger(object):
             level (int): how many tabs (one space if 0)
             obj (Object): what to print
         '''
-        string = str(obj)
-        if cls.printing:
+        if cls.printing and not Logger.is_muted():
+            string = str(obj)
             # tab = '\t'  # use for 'normal' tabs
             tab = '  '  # use for 'space' tabs (adjust as needed)
             indent = ' ' if level == 0 else tab * (level + 1)
             output = ''.join([cls.prefix, indent, string])
-            if Logger.buffer_printing:
+            capture = Logger.get_capture()
+            if capture is not None:
+                # Just this thread's.
+                capture += [output]
+            elif Logger.buffer_printing:
                 # Save for later
                 Logger.print_buffer += [output]
             else:
                 print output
 
+    @staticmethod
+    def mute(muted=True):
+        '''
+        Turns all logging off (or back on) for the calling thread only,
+        e.g. while serving a request that doesn't want the log. Nothing
+        is formatted while muted.
+
+        Args:
+            muted (bool, optional): Defaults to True.
+        '''
+        Logger.local.muted = muted
+
+    @staticmethod
+    def is_muted():
+        '''
+        Returns:
+            bool: Whether logging is muted for the calling thread.
+        '''
+        return getattr(Logger.local, 'muted', False)
+
+    @staticmethod
+    def start_capture():
+        '''
+        Sends the calling thread's logging to its own buffer (see
+        stop_capture()) rather than the shared one, e.g. to return the
+        log of one request among many served at once.
+        '''
+        Logger.local.capture = []
+
+    @staticmethod
+    def get_capture():
+        '''
+        Returns:
+            [str]|None: The calling thread's capture buffer, if it's
+                capturing.
+        '''
+        return getattr(Logger.local, 'capture', None)
+
+    @staticmethod
+    def stop_capture():
+        '''
+        Stops capturing the calling thread's logging.
+
+        Returns:
+            str: What it logged since start_capture().
+        '''
+        capture = Logger.get_capture()
+        Logger.local.capture = None
+        return '' if capture is None else '\n'.join(capture)
+
     @staticmethod
     def get_buffer():
         '''
@@ -117,6 +183,103 @@ class Fs:
             ) + os.sep)
 
 
+class Yaml:
+    '''
+    Loads our data (YAML) files. Each file is parsed once per process,
+    with the C-accelerated safe loader when available, and the result is
+    shared: callers must not modify it (copy what you need to change).
+
+    The yaml module itself is imported on first load.
+    '''
+
+    # Map of path: loaded object.
+    loaded = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def load(path):
+        '''
+        Args:
+            path (str): Path to a YAML file.
+
+        Returns:
+            object: The (shared) loaded contents.
+        '''
+        Yaml.lock.acquire()
+        try:
+            if path not in Yaml.loaded:
+                Yaml.loaded[path] = Yaml._load_uncached(path)
+            return Yaml.loaded[path]
+        finally:
+            Yaml.lock.release()
+
+    @staticmethod
+    def _load_uncached(path):
+        '''
+        Parses the file at path, or loads the pickle cache next to it
+        if YAML_PICKLE_CACHE and it's up to date (writing one if not).
+
+        The cache is written to a temporary file and renamed into place,
+        so other processes never read a partial one; any cache that
+        can't be loaded is remade.
+
+        Args:
+            path (str): Path to a YAML file.
+
+        Returns:
+            object
+        '''
+        if not YAML_PICKLE_CACHE:
+            return Yaml._parse(path)
+
+        pickle_path = path + YAML_PICKLE_EXT
+        if (os.path.exists(pickle_path) and
+                os.path.getmtime(pickle_path) >= os.path.getmtime(path)):
+            try:
+                return cPickle.load(open(pickle_path, 'rb'))
+            except Exception:
+                pass  # Bad cache (unpickling can raise most anything).
+        res = Yaml._parse(path)
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                prefix=os.path.basename(pickle_path) + '.',
+                dir=os.path.dirname(pickle_path))
+        except (IOError, OSError):
+            return res  # E.g. read-only install; just don't cache.
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                cPickle.dump(res, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            # mkstemp makes it private; the cache is for everyone.
+            os.chmod(tmp_path, 0644)
+            os.rename(tmp_path, pickle_path)
+        except (IOError, OSError):
+            # Not cached (e.g. disk full, or Windows, where rename won't
+            # replace a file).
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return res
+
+    @staticmethod
+    def _parse(path):
+        '''
+        Args:
+            path (str): Path to a YAML file.
+
+        Returns:
+            object
+        '''
+        import yaml
+        try:
+            # C-accelerated, if libyaml is available.
+            loader = yaml.CSafeLoader
+        except AttributeError:
+            loader = yaml.SafeLoader
+        return yaml.load(open(path), Loader=loader)
+
+
 class Numbers:
     '''
     Misc. helper functionality related to numbers.
@@ -222,9 +385,25 @@ class Numbers:
         else:
             for obj in objs:
                 orig = getattr(obj, attr)
-                new = (orig / max_)**LENGTH_EXP
+                new = Numbers.prob_decay(orig, max_)
                 setattr(obj, attr, new)
 
+    @staticmethod
+    def prob_decay(num, max_):
+        '''
+        The transform make_prob(...) applies to each value: num is
+        scaled by max_ (becoming 1.0 at the max) and decays
+        exponentially to 0.0.
+
+        Args:
+            num (float)
+            max_ (float): Must be nonzero.
+
+        Returns:
+            float
+        '''
+        return (num / max_)**LENGTH_EXP
+
     @staticmethod
     def normalize(objs, attr='score', min_score=0.0, scale=1.0):
         '''
@@ -0,0 +1,119 @@
+'''Interned vocabulary: integer IDs for the grammar's tokens (words) and
+phrases.
+
+    - Tokens and phrases are interned once, when the grammar is loaded,
+        and get dense IDs (0, 1, ...).
+
+    - Each phrase is kept as the IDs of its tokens, and each token knows
+        the phrases it's in, so matching an utterance splits it once
+        and only checks the phrases its words could complete.
+
+Everything here is integers; the grammar keeps the Phrase objects, by
+ID (see CompiledGrammar).
+'''
+
+__author__ = 'mbforbes'
+
+
+########################################################################
+# Classes
+########################################################################
+
+class Vocabulary(object):
+    '''Token and phrase IDs, and phrase matching by them.'''
+
+    def __init__(self):
+        self.token_ids = {}  # str: int
+        self.tokens = []  # str, by ID
+        self.phrase_ids = {}  # (str, object): int
+        self.phrase_tokens = []  # (int) token IDs (in order), by ID
+        self.token_phrases = []  # [int] IDs of phrases with token, by ID
+
+    def intern_token(self, token):
+        '''
+        Args:
+            token (str)
+
+        Returns:
+            int: token's ID (made if new).
+        '''
+        if token not in self.token_ids:
+            self.token_ids[token] = len(self.tokens)
+            self.tokens += [token]
+            self.token_phrases += [[]]
+        return self.token_ids[token]
+
+    def intern_phrase(self, words, kind=None):
+        '''
+        Args:
+            words (str): Space-separated tokens.
+            kind (object, optional): Distinguishes phrases with the same
+                words (e.g. their matching strategy). Defaults to None.
+
+        Returns:
+            int: The phrase's ID (made if new; then, it's the number of
+                phrases before it).
+        '''
+        key = (words, kind)
+        if key not in self.phrase_ids:
+            phrase_id = len(self.phrase_tokens)
+            self.phrase_ids[key] = phrase_id
+            token_ids = tuple([
+                self.intern_token(token) for token in words.split(' ')])
+            self.phrase_tokens += [token_ids]
+            for token_id in set(token_ids):
+                self.token_phrases[token_id] += [phrase_id]
+        return self.phrase_ids[key]
+
+    def __len__(self):
+        '''
+        Returns:
+            int: The number of phrases.
+        '''
+        return len(self.phrase_tokens)
+
+    def match(self, utterance):
+        '''
+        Args:
+            utterance (str)
+
+        Returns:
+            [int]: IDs (sorted) of the phrases all of whose tokens are
+                in utterance.
+        '''
+        token_ids = set()
+        for token in utterance.split(' '):
+            if token in self.token_ids:
+                token_ids.add(self.token_ids[token])
+        candidates = set()
+        for token_id in token_ids:
+            candidates.update(self.token_phrases[token_id])
+        return sorted([
+            phrase_id for phrase_id in candidates
+            if token_ids.issuperset(self.phrase_tokens[phrase_id])])
+
+    def match_weights(self, word_confs):
+        '''
+        Args:
+            word_confs ({str: float}): Map of word: confidence.
+
+        Returns:
+            {int: float}: Map of phrase ID: how confidently the phrase
+                is in word_confs (the product of its tokens'
+                confidences), for phrases with confidence > 0.0.
+        '''
+        confs = {}  # token ID: float
+        for word, conf in word_confs.iteritems():
+            if word in self.token_ids and conf > 0.0:
+                confs[self.token_ids[word]] = conf
+        candidates = set()
+        for token_id in confs:
+            candidates.update(self.token_phrases[token_id])
+        weights = {}
+        for phrase_id in candidates:
+            weight = 1.0
+            for token_id in self.phrase_tokens[phrase_id]:
+                weight *= confs.get(token_id, 0.0)
+            if weight > 0.0:
+                weights[phrase_id] = weight
+        return weights
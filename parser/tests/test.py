@@ -33,14 +33,33 @@ __author__ = 'mbforbes'
 # ######################################################################
 
 # Builtins
+import cPickle
+import copy
 import getpass
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
 # Local
-from parser.core.frontends import Frontend
+from parser.core.dispatch import ChangeFeed, LocalBus
+from parser.core.frontends import (
+    Frontend, AsyncFrontend, ROSFrontend, WebFrontend)
+from parser.core.grammar import CompiledGrammar, Sentence, SentenceStore
+from parser.core.hybridbayes import Parser, GROUND_BASE_SCORE
 from parser.core.roslink import WorldObject, Robot, RobotCommand
-from parser.core.util import Info, Debug
+from parser.core.scoring import FactoredScorer
+from parser.core.sessions import SessionManager
+from parser.core import util
+from parser.core.constants import C
+from parser.core.util import Logger, Info, Debug, Numbers, Yaml, Algo
 from parser.core.matchers import DefaultMatcher
+from parser.core.vocab import Vocabulary
+from parser.core.pool import ParserPool
 
 
 # ######################################################################
@@ -604,6 +623,315 @@ class TestDefaultMatcher(unittest.TestCase):
             'right', 'right-hand right'), 0.0)
 
 
+class TestLogger(unittest.TestCase):
+    def setUp(self):
+        self.printing = Info.printing
+        self.buffer_printing = Logger.buffer_printing
+        Info.printing = True
+        Logger.buffer_printing = True
+        Logger.get_buffer()
+
+    def tearDown(self):
+        Logger.mute(False)
+        Logger.stop_capture()
+        Info.printing = self.printing
+        Logger.buffer_printing = self.buffer_printing
+
+    def test_mute(self):
+        formatted = []
+
+        class Loud(object):
+            def __str__(self):
+                formatted.append(True)
+                return 'loud'
+
+        Logger.mute()
+        Info.p(Loud())
+        self.assertEqual(formatted, [])
+        self.assertEqual(Logger.get_buffer(), '')
+
+        # Only the calling thread is muted.
+        thread = threading.Thread(target=lambda: Info.p(Loud()))
+        thread.start()
+        thread.join()
+        self.assertEqual(Logger.get_buffer(), '[INFO] loud')
+
+        Logger.mute(False)
+        Info.p(Loud())
+        self.assertEqual(Logger.get_buffer(), '[INFO] loud')
+        self.assertEqual(len(formatted), 2)
+
+    def test_capture(self):
+        Logger.start_capture()
+        Info.p('mine')
+        # Other threads' logging isn't captured.
+        thread = threading.Thread(target=lambda: Info.p('theirs'))
+        thread.start()
+        thread.join()
+        Info.p('mine again')
+        self.assertEqual(
+            Logger.stop_capture(), '[INFO] mine\n[INFO] mine again')
+        self.assertEqual(Logger.get_buffer(), '[INFO] theirs')
+        Info.p('shared')
+        self.assertEqual(Logger.stop_capture(), '')
+        self.assertEqual(Logger.get_buffer(), '[INFO] shared')
+
+
+class TestYaml(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.yml')
+        open(self.path, 'w').write('a: [1, 2]\nb: {c: true}\n')
+
+    def tearDown(self):
+        util.YAML_PICKLE_CACHE = False
+        shutil.rmtree(self.dir)
+
+    def test_loaded_once(self):
+        self.assertEqual(Yaml.load(self.path), {'a': [1, 2], 'b': {'c': True}})
+        self.assertTrue(Yaml.load(self.path) is Yaml.load(self.path))
+        self.assertFalse(os.path.exists(self.path + '.pickle'))
+
+    def test_pickle_cache(self):
+        util.YAML_PICKLE_CACHE = True
+        res = Yaml._load_uncached(self.path)
+        self.assertTrue(os.path.exists(self.path + '.pickle'))
+        self.assertEqual(Yaml._load_uncached(self.path), res)
+
+        # A stale cache isn't used.
+        open(self.path, 'w').write('a: 3\n')
+        mtime = os.path.getmtime(self.path + '.pickle') + 1
+        os.utime(self.path, (mtime, mtime))
+        self.assertEqual(Yaml._load_uncached(self.path), {'a': 3})
+
+    def test_bad_pickle_cache(self):
+        util.YAML_PICKLE_CACHE = True
+        res = Yaml._load_uncached(self.path)
+        for bad in ['', 'garbage', 'c__builtin__\nno_such_thing\n.']:
+            open(self.path + '.pickle', 'wb').write(bad)
+            self.assertEqual(Yaml._load_uncached(self.path), res)
+            # It's remade, without leaving temporary files around.
+            self.assertEqual(
+                cPickle.load(open(self.path + '.pickle', 'rb')), res)
+            self.assertEqual(
+                sorted(os.listdir(self.dir)), ['test.yml', 'test.yml.pickle'])
+
+
+class TestPropertyGetter(unittest.TestCase):
+    def test_cached_serialization(self):
+        robot = Robot({'last_cmd_side': 'right_hand'})
+        yaml_str, json_str = robot.to_dict_str(), robot.to_json()
+        self.assertEqual(json.loads(json_str), robot.properties)
+        self.assertTrue(robot.to_dict_str() is yaml_str)
+        self.assertTrue(robot.to_json() is json_str)
+
+        # Invalidated on write.
+        robot.set_property('last_cmd_side', 'left_hand')
+        self.assertEqual(
+            json.loads(robot.to_json()), {'last_cmd_side': 'left_hand'})
+        self.assertTrue('left_hand' in robot.to_dict_str())
+
+    def test_frozen(self):
+        props = {'name': 'obj0', 'color': 'red'}
+        obj = WorldObject.from_dicts([props])[0]
+        self.assertRaises(TypeError, obj.set_property, 'color', 'blue')
+        props['color'] = 'blue'
+        self.assertEqual(obj.get_property('color'), 'red')
+        robot = Robot.from_dict(R_RIGHT_PREF)
+        self.assertRaises(TypeError, robot.set_property, 'x', 'y')
+
+
+class TestChangeFeed(unittest.TestCase):
+    def test_get_since(self):
+        feed = ChangeFeed()
+        feed.put('a', '1')
+        feed.put('b', '2')
+        feed.put('a', '3')
+        seq, changes = feed.get_since(0)
+        self.assertEqual(changes, [(2, 'b', '2'), (3, 'a', '3')])
+
+        # Only changes since, including removals.
+        feed.put('b', None)
+        seq, changes = feed.get_since(seq)
+        self.assertEqual(changes, [(4, 'b', None)])
+        self.assertEqual(feed.get_since(0)[1], [(3, 'a', '3')])
+
+        # Waits for changes.
+        self.assertEqual(feed.get_since(seq, 0.01), (seq, []))
+        timer = threading.Timer(0.05, lambda: feed.put('c', '5'))
+        timer.start()
+        self.assertEqual(feed.get_since(seq), (5, [(5, 'c', '5')]))
+
+    def test_forgotten_removals(self):
+        feed = ChangeFeed(max_removed=2)
+        for key in ['a', 'b', 'c', 'd']:
+            feed.put(key, key)
+        seq, changes = feed.get_since(0)
+        feed.put('a', None)
+        feed.put('b', None)
+        feed.put('a', 'a')  # No longer removed.
+        self.assertEqual(feed.get_since(seq)[1], [
+            (6, 'b', None), (7, 'a', 'a')])
+        feed.put('c', None)
+        feed.put('d', None)  # Forgets b.
+        self.assertEqual(sorted(feed.state.keys()), ['a', 'c', 'd'])
+
+        # Clients that saw b's removal (or later) still get changes.
+        self.assertEqual(feed.get_since(7)[1], [
+            (8, 'c', None), (9, 'd', None)])
+
+        # Older clients start over.
+        self.assertEqual(feed.get_since(seq), (9, [
+            ChangeFeed.RESET, (7, 'a', 'a')]))
+        self.assertEqual(feed.get_since(100)[1], [
+            ChangeFeed.RESET, (7, 'a', 'a')])
+        self.assertEqual(feed.get_since(0)[1], [(7, 'a', 'a')])
+
+
+class TestVocabulary(unittest.TestCase):
+    def setUp(self):
+        Info.printing = False
+        Debug.printing = False
+        self.parser = Parser()
+        self.parser.set_world([WorldObject(O_FULL_REACHABLE)], Robot())
+
+    def test_match(self):
+        phrases = self.parser.phrases
+        for u in ['move right-hand up', 'pick up the red box', '',
+                  'up up and away', 'point  to the  box']:
+            self.assertEqual(
+                self.parser._match(u).get_phrases(),
+                [p for p in phrases if p.found_in(u)])
+
+    def test_match_weights(self):
+        word_confs = {'pick': 0.6, 'up': 0.9, 'red': 0.3, 'box': 0.0}
+        u_sentence = self.parser._match(word_confs)
+        expected = {}
+        for p in self.parser.phrases:
+            weight = 1.0
+            for word in p.words.split(' '):
+                weight *= word_confs.get(word, 0.0)
+            if weight > 0.0:
+                expected[p] = weight
+        self.assertEqual(u_sentence.get_matched(), expected)
+
+    def test_match_weights_product(self):
+        vocab = Vocabulary()
+        right, hand, hand_up = [
+            vocab.intern_phrase(words)
+            for words in ['right', 'right-hand', 'right-hand up']]
+        weights = vocab.match_weights({'right-hand': 0.5, 'up': 0.8})
+        self.assertEqual(sorted(weights.keys()), [hand, hand_up])
+        self.assertEqual(weights[hand], 0.5)
+        self.assertAlmostEqual(weights[hand_up], 0.4)
+
+    def test_sentence_ids(self):
+        a, b, c = self.parser.phrases[:3]
+        self.assertEqual(Sentence([a, b]), Sentence([b, a]))
+        self.assertNotEqual(Sentence([a, b]), Sentence([a]))
+        self.assertNotEqual(Sentence([a]), Sentence([a, c]))
+        self.assertEqual(len(set([Sentence([a, b]), Sentence([b, a])])), 1)
+
+
+class TestSentenceStore(unittest.TestCase):
+    def setUp(self):
+        Info.printing = False
+        Debug.printing = False
+        self.parser = Parser()
+        self.parser.set_world([WorldObject(O_FULL_REACHABLE)], Robot())
+
+    def test_intern(self):
+        a, b, c = self.parser.phrases[:3]
+        store = SentenceStore()
+        self.assertEqual(store.intern([a, b]), store.intern([b, a]))
+        self.assertNotEqual(store.intern([a, b]), store.intern([a, c]))
+        self.assertEqual(len(store), 2)
+
+    def test_shared(self):
+        sentences = SentenceStore.from_commands(
+            self.parser.commands).sentences
+        self.assertEqual(len(set(sentences)), len(sentences))
+        for cmd in self.parser.commands:
+            for sentence in cmd.sentences:
+                self.assertTrue(sentence is sentences[sentences.index(
+                    sentence)])
+        self.assertEqual(
+            sorted([s.get_ids() for s in sentences]),
+            sorted(set([
+                Sentence(pl).get_ids() for cmd in self.parser.commands
+                for pl in Algo.gen_phrases(cmd.option_map.values())])))
+
+
+class TestFactoredScorer(unittest.TestCase):
+    def setUp(self):
+        Info.printing = False
+        Debug.printing = False
+        self.frontend = Frontend()
+        self.frontend.set_default_world()
+        self.parser = self.frontend.parser
+        self.utterances = [
+            'move right-hand up',
+            'move',
+            'pick-up the red box with your left-hand',
+            'place the smallest thing',
+            'nothing matches here',
+        ]
+
+    def tearDown(self):
+        FactoredScorer.approx_support = None
+
+    def _enumerated_lang_scores(self, u):
+        '''
+        The language scores from explicitly scoring every sentence.
+
+        Returns:
+            [float]
+        '''
+        u_sentence = Sentence(
+            [p for p in self.parser.phrases if p.found_in(u)])
+        sentences = SentenceStore.from_commands(
+            self.parser.commands).sentences
+        Sentence.compute_score(sentences, u_sentence)
+        scores = [
+            sum([s.score for s in c.sentences]) / len(c.sentences)
+            for c in self.parser.commands]
+        return Numbers.normalize_list(scores)
+
+    def _factored_lang_scores(self, u):
+        '''
+        Returns:
+            [float]
+        '''
+        u_sentence = Sentence(
+            [p for p in self.parser.phrases if p.found_in(u)])
+        self.parser.scorer.score(u_sentence)
+        return [c.lang_score for c in self.parser.commands]
+
+    def test_matches_enumeration(self):
+        for u in self.utterances:
+            expected = self._enumerated_lang_scores(u)
+            for exp, got in zip(expected, self._factored_lang_scores(u)):
+                self.assertAlmostEqual(exp, got)
+
+    def test_phrase_ids(self):
+        # Dense, and all that scoring reads of what an utterance heard.
+        phrases = self.parser.phrases
+        self.assertEqual(
+            sorted([p.id for p in phrases]), range(len(phrases)))
+        u_sentence = self.parser._match('move right-hand up')
+        heard = u_sentence.get_heard()
+        for p in phrases:
+            in_u = p in u_sentence.get_phrases()
+            self.assertEqual(p.id < len(heard) and heard[p.id] == 1.0, in_u)
+
+    def test_approx_close(self):
+        FactoredScorer.approx_support = 2
+        for u in self.utterances:
+            expected = self._enumerated_lang_scores(u)
+            for exp, got in zip(expected, self._factored_lang_scores(u)):
+                self.assertAlmostEqual(exp, got, places=1)
+
+
 class FullAdminCommands(unittest.TestCase):
     def setUp(self):
         Info.printing = False
@@ -1594,6 +1922,820 @@ class FullImpossibleObjCommands(unittest.TestCase):
                 S_PLACE[cmd]), RC_PLACE[cmd])
 
 
+class FullBatch(unittest.TestCase):
+    def setUp(self):
+        Info.printing = False
+        Debug.printing = False
+        self.frontend = Frontend()
+        objs = [
+            WorldObject(O_FULL_REACHABLE),  # obj0
+            WorldObject(O_FULL_REACHABLE_SECOND),  # obj1
+        ]
+        self.frontend.set_world(world_objects=objs)
+
+    def test_parse_batch(self):
+        utterances = (
+            S_PICKUP.values() + S_MOVEABS.values() +
+            ['move', 'move', 'move nowhere', 'pick-up the blue thing'] +
+            S_PICKUP.values())
+        rcs = self.frontend.parse_batch(utterances)
+        self.assertEqual(len(rcs), len(utterances))
+        for u, rc in zip(utterances, rcs):
+            single = self.frontend.parse(u)
+            self.assertEqual(rc, single)
+            self.assertEqual(rc.phrases, single.phrases)
+            self.assertEqual(rc.utterance, u)
+
+    def test_parse_batch_weighted(self):
+        bag = {'open': 0.9, 'left-hand': 0.8, 'right-hand': 0.2}
+        utterances = [bag, 'stop', dict(bag)]
+        rcs = self.frontend.parse_batch(utterances)
+        for u, rc in zip(utterances, rcs):
+            single = self.frontend.parse(u)
+            self.assertEqual(rc, single)
+            self.assertEqual(rc.utterance, single.utterance)
+
+    def test_parse_batch_no_world(self):
+        self.assertEqual(Parser().parse_batch(['stop', 'move']), [None, None])
+
+    def test_ground_no_world(self):
+        parser = Parser()
+        self.assertEqual(parser.describe(), {})
+        self.assertEqual(parser.ground('the red box'), {})
+        self.assertEqual(parser.ground_batch(['box', 'box']), [{}, {}])
+
+        # The lock was released, so the world can still be set.
+        parser.set_world(
+            [WorldObject(O_FULL_REACHABLE)], Robot())
+        self.assertEqual(parser.ground('the red box'), {'obj0': 1.0})
+
+    def test_ground_batch(self):
+        queries = ['the red box', 'the blue box', 'the red box', 'box', '']
+        res = self.frontend.ground_batch(queries)
+        self.assertEqual(len(res), len(queries))
+        for query, probs in zip(queries, res):
+            self.assertEqual(probs, self.frontend.ground(query))
+
+
+class FullNBest(unittest.TestCase):
+    def setUp(self):
+        Info.printing = False
+        Debug.printing = False
+        self.frontend = Frontend()
+        objs = [
+            WorldObject(O_FULL_REACHABLE),  # obj0
+            WorldObject(O_FULL_REACHABLE_SECOND),  # obj1
+        ]
+        self.frontend.set_world(world_objects=objs)
+
+    def test_top_matches_parse(self):
+        for u in S_PICKUP.values() + S_MOVEABS.values():
+            rcs = self.frontend.parse_nbest(u, 3)
+            self.assertEqual(len(rcs), 3)
+            self.assertEqual(rcs[0], self.frontend.parse(u))
+
+    def test_scores_ordered(self):
+        rcs = self.frontend.parse_nbest('move right-hand', 10)
+        self.assertEqual(len(rcs), 10)
+        lang_scores = [rc.lang_score for rc in rcs]
+        self.assertEqual(lang_scores, sorted(lang_scores, reverse=True))
+        for rc in rcs:
+            self.assertIsNotNone(rc.score)
+
+    def test_hypotheses(self):
+        # A confident hypothesis wins.
+        rcs = self.frontend.parse_nbest([
+            (S_MOVEABS['RH_UP'], 0.7),
+            (S_MOVEABS['LH_DOWN'], 0.3),
+        ])
+        self.assertEqual(rcs[0], RC_MOVEABS['RH_UP'])
+        self.assertEqual(rcs[1], RC_MOVEABS['LH_DOWN'])
+        self.assertEqual(rcs[0].utterance, S_MOVEABS['RH_UP'])
+
+        # Agreeing hypotheses outweigh a more confident one.
+        rcs = self.frontend.parse_nbest([
+            (S_MOVEABS['RH_UP'], 0.4),
+            ('move left-hand down', 0.3),
+            ('move left-hand down please', 0.3),
+        ])
+        self.assertEqual(rcs[0], RC_MOVEABS['LH_DOWN'])
+
+    def test_no_hypotheses(self):
+        self.assertEqual(self.frontend.parse_nbest([]), [])
+
+    def test_weighted_hypotheses(self):
+        bag = {'open': 0.9, 'left-hand': 0.8}
+        rcs = self.frontend.parse_nbest([(bag, 0.6), ('stop', 0.4)])
+        self.assertEqual(rcs[0], self.frontend.parse(bag))
+        self.assertEqual(rcs[0].utterance, 'open left-hand')
+
+
+class FullWeightedUtterance(unittest.TestCase):
+    def setUp(self):
+        Info.printing = False
+        Debug.printing = False
+        self.frontend = Frontend()
+        objs = [WorldObject(O_FULL_REACHABLE)]
+        self.frontend.set_world(world_objects=objs)
+
+    def test_certain_matches_parse(self):
+        for u in S_PICKUP.values() + S_MOVEABS.values():
+            confs = dict([(w, 1.0) for w in u.split(' ')])
+            rc = self.frontend.parse(confs)
+            self.assertEqual(rc, self.frontend.parse(u))
+            self.assertEqual(
+                sorted(rc.utterance.split(' ')), sorted(confs.keys()))
+
+    def test_uncertain_words(self):
+        self.assertEqual(
+            self.frontend.parse({
+                'move': 1.0,
+                'right-hand': 0.6,
+                'left-hand': 0.4,
+                'up': 0.9,
+                'down': 0.1,
+            }),
+            RC_MOVEABS['RH_UP'])
+        self.assertEqual(
+            self.frontend.parse({
+                'move': 1.0,
+                'right-hand': 0.3,
+                'left-hand': 0.7,
+                'up': 0.2,
+                'down': 0.8,
+            }),
+            RC_MOVEABS['LH_DOWN'])
+
+
+class FullAsync(unittest.TestCase):
+    def setUp(self):
+        Info.printing = False
+        Debug.printing = False
+        self.frontend = AsyncFrontend()
+        objs = [WorldObject(O_FULL_REACHABLE)]
+        self.frontend.set_world_async(objs, Robot()).result()
+
+    def tearDown(self):
+        self.frontend.shutdown()
+
+    def test_queries(self):
+        futures = [
+            self.frontend.parse_async(S_PICKUP[k]) for k in S_PICKUP]
+        for k, future in zip(S_PICKUP, futures):
+            self.assertEqual(future.result(), RC_PICKUP[k])
+        self.assertEqual(
+            self.frontend.ground_async('the red box').result(),
+            {'obj0': 1.0})
+        self.assertEqual(
+            self.frontend.describe_async().result().keys(), ['obj0'])
+
+    def test_coalesce(self):
+        # Hold the parser so updates pile up behind the first.
+        self.frontend.parser.lock.acquire()
+        futures = [
+            self.frontend.update_robot_async(Robot(R_RIGHT_PREF)),
+            self.frontend.update_robot_async(Robot(R_LEFT_PREF)),
+            self.frontend.update_objects_async([]),
+            self.frontend.update_robot_async(Robot(R_RIGHT_PREF)),
+        ]
+        self.frontend.parser.lock.release()
+        for future in futures:
+            future.result()
+
+        # At most the first alone, then the rest merged.
+        stats = self.frontend.get_update_stats()
+        self.assertEqual(stats['received'], 5)  # Including setUp.
+        self.assertTrue(stats['applied'] <= 3)
+        self.assertEqual(stats['received'] - stats['applied'], stats['merged'])
+        self.assertTrue(stats['dropped'] >= 1)
+        self.assertEqual(self.frontend.parser.world_objects, [])
+        self.assertEqual(
+            self.frontend.parser.robot.get_property('last_cmd_side'),
+            'right_hand')
+
+    def test_queries_first(self):
+        # Hold the parser so the query and the second update both wait.
+        self.frontend.parser.lock.acquire()
+        self.frontend.update_objects_async([WorldObject(O_FULL_REACHABLE)])
+        update = self.frontend.update_objects_async(
+            [WorldObject(O_FULL_REACHABLE_SECOND)])
+        query = self.frontend.describe_async()
+        self.frontend.parser.lock.release()
+        self.assertEqual(query.result().keys(), ['obj0'])
+        update.result()
+        self.assertEqual(
+            self.frontend.describe_async().result().keys(), ['obj1'])
+
+    def test_rate_limit(self):
+        frontend = AsyncFrontend(max_update_rate=5.0)
+        frontend.set_world_async([], Robot()).result()
+        start = time.time()
+        update = frontend.update_robot_async(Robot(R_LEFT_PREF))
+
+        # Queries don't wait for rate-limited updates.
+        frontend.parse_async('open').result()
+        self.assertFalse(update.done())
+        update.result()
+        self.assertTrue(time.time() - start > 0.1)
+        frontend.shutdown()
+
+    def test_after_shutdown(self):
+        self.frontend.shutdown()
+        # Fails at once rather than never resolving.
+        for future in [
+                self.frontend.parse_async('stop'),
+                self.frontend.update_robot_async(Robot())]:
+            self.assertTrue(future.done())
+            self.assertRaises(RuntimeError, future.result)
+
+    def test_bus(self):
+        bus = LocalBus()
+        self.frontend.attach(bus)
+        commands, groundings = [], []
+        bus.subscribe('handsfree_command', commands.append)
+        bus.subscribe('handsfree_grounding', groundings.append)
+
+        # World change service describes the new objects.
+        objs = [WorldObject(O_FULL_REACHABLE_SECOND)]
+        descs = bus.call('handsfree_worldchange', objs)
+        self.assertEqual(descs.keys(), ['obj1'])
+
+        # Updates are asynchronous; wait for it before parsing.
+        bus.publish('handsfree_robotstate', Robot(R_LEFT_PREF))
+        self.frontend.set_world_async().result()
+
+        # Queries run in order, so the command has been published once
+        # the grounding finishes.
+        bus.publish('recognizer/output', 'pick-up the blue box')
+        self.frontend.ground_async('the blue box').result()
+        self.assertEqual(
+            commands,
+            [RobotCommand.from_strs('pick_up', ['obj1', 'left_hand'])])
+        self.assertEqual(groundings, [({'obj1': 1.0}, 'the blue box')])
+
+
+class FullROSLocalBus(unittest.TestCase):
+    def setUp(self):
+        Info.printing = False
+        Debug.printing = False
+        self.frontend = ROSFrontend()
+        self.bus = LocalBus()
+        self.assertTrue(self.frontend.startup_ros(bus=self.bus))
+
+    def tearDown(self):
+        self.frontend.shutdown()
+
+    def test_roundtrip(self):
+        commands = []
+        self.bus.subscribe('handsfree_command', commands.append)
+        descs = self.bus.call(
+            'handsfree_worldchange', [WorldObject(O_FULL_REACHABLE)])
+        self.assertEqual(descs.keys(), ['obj0'])
+
+        # Bursts of robot state get collapsed. Parses go ahead of
+        # pending updates, so wait for it to be applied.
+        for i in range(20):
+            self.bus.publish('handsfree_robotstate', Robot(R_LEFT_PREF))
+        self.frontend.set_world_async().result()
+        self.bus.publish('recognizer/output', '')
+        self.bus.publish('recognizer/output', 'pick-up the box')
+        self.frontend.describe_async().result()
+        self.assertEqual(
+            commands,
+            [RobotCommand.from_strs('pick_up', ['obj0', 'left_hand'])])
+        self.assertTrue(self.frontend.get_update_stats()['applied'] < 20)
+
+
+class FullWebFeed(unittest.TestCase):
+    def setUp(self):
+        Info.printing = False
+        Debug.printing = False
+        self.frontend = WebFrontend()
+
+    def tearDown(self):
+        Logger.buffer_printing = False
+        Logger.get_buffer()
+
+    def test_only_changes(self):
+        feed = self.frontend.feed
+        self.frontend.set_world(
+            [WorldObject(O_FULL_REACHABLE), WorldObject(O_FULL_REACHABLE)],
+            Robot(R_RIGHT_PREF))
+        seq, changes = feed.get_since(0)
+        self.assertEqual(
+            [key for key_seq, key, value in changes], ['object/obj0', 'robot'])
+        self.assertEqual(json.loads(changes[1][2]), R_RIGHT_PREF)
+
+        # Same world: nothing new. New robot and objects: only those.
+        self.frontend.set_world(
+            [WorldObject(O_FULL_REACHABLE)], Robot(R_RIGHT_PREF))
+        self.assertEqual(feed.get_since(seq, 0.0), (seq, []))
+        self.frontend.set_world(
+            [WorldObject(O_FULL_REACHABLE_SECOND)], Robot(R_LEFT_PREF))
+        seq, changes = feed.get_since(seq)
+        self.assertEqual(
+            [(key, value is None) for key_seq, key, value in changes],
+            [('object/obj1', False), ('object/obj0', True), ('robot', False)])
+
+        rc = self.frontend.parse('pick-up the box')
+        seq, changes = feed.get_since(seq)
+        self.assertEqual(
+            json.loads(changes[0][2])['args'], ['obj1', 'left_hand'])
+        self.assertEqual(feed.get_since(seq, 0.0), (seq, []))
+
+
+class FullGroundingIndex(unittest.TestCase):
+    def setUp(self):
+        Info.printing = False
+        Debug.printing = False
+        self.parser = Parser()
+        objs = WorldObject.from_dicts(WorldObject.gen_objs()[::37])
+        self.parser.set_world(objs, Robot())
+
+    def brute_force(self, gq):
+        # Grounding as it was: a Sentence per phrase set.
+        gq_sentence = self.parser._match(gq)
+        opts = self.parser.grounder.obj_opts
+        scores = []
+        for opt in opts:
+            sentences = [Sentence(ps) for ps in opt.get_phrases()]
+            Sentence.compute_score(
+                sentences, gq_sentence, normalize=False, ground=True)
+            scores += [max([s.score for s in sentences])]
+        scores = Numbers.normalize_list(scores, GROUND_BASE_SCORE)
+        return {opt.name: score for opt, score in zip(opts, scores)}
+
+    def test_same_as_brute_force(self):
+        queries = [
+            '', 'box', 'the red box', 'the big green cup',
+            'the left-most red thing', 'the tallest cube nearest',
+            'pick up the smallest blue box please', 'the the the box box',
+        ]
+        for gq in queries:
+            self.assertEqual(self.parser.ground(gq), self.brute_force(gq))
+
+
+class FullDescribeCache(unittest.TestCase):
+    def setUp(self):
+        Info.printing = False
+        Debug.printing = False
+        self.parser = Parser()
+        self.objs = [
+            WorldObject(O_FULL_REACHABLE),  # obj0, red box
+            WorldObject(O_FULL_REACHABLE_SECOND),  # obj1, blue box
+        ]
+        self.parser.set_world(self.objs, Robot())
+
+    def test_cached(self):
+        descs = self.parser.describe()
+        cached = self.parser.desc_cache['obj0']
+
+        # Robot changes and unchanged objects don't redescribe.
+        self.parser.set_world(robot=Robot(R_LEFT_PREF))
+        self.assertEqual(self.parser.describe(), descs)
+        self.parser.set_world(world_objects=self.objs[:])
+        self.assertEqual(self.parser.describe(), descs)
+        self.assertTrue(self.parser.desc_cache['obj0'] is cached)
+
+    def test_changed(self):
+        self.parser.describe()
+
+        # obj1 leaves, so the box type identifies obj0 alone; obj0's
+        # description must change though obj0 didn't.
+        self.parser.set_world(world_objects=self.objs[:1])
+        single = Parser()
+        single.set_world(self.objs[:1], Robot())
+        self.assertEqual(self.parser.describe(), single.describe())
+        self.assertEqual(self.parser.describe().keys(), ['obj0'])
+
+
+class FullClarify(unittest.TestCase):
+    def setUp(self):
+        Info.printing = False
+        Debug.printing = False
+        self.parser = Parser()
+        objs = WorldObject.from_dicts(WorldObject.gen_objs()[::37])
+        self.parser.set_world(objs, Robot())
+
+    def pairwise(self, top_cmds):
+        # Clarify args as they were: compare every pair of commands.
+        if len(set([cmd.template for cmd in top_cmds])) > 1:
+            return []
+        clarify_args = set()
+        for cmd1 in top_cmds:
+            for cmd2 in top_cmds:
+                for opt_name, opt_val in cmd1.option_map.iteritems():
+                    if cmd2.option_map[opt_name] is not opt_val:
+                        clarify_args.add(opt_name)
+        return sorted(clarify_args)
+
+    def test_same_as_pairwise(self):
+        for u in ['move', 'pick up', 'move right-hand', 'point to', '']:
+            top_cmds = self.parser._rank(self.parser._match(u))
+            self.assertTrue(len(top_cmds) > 1)
+            rc = self.parser._get_clarify_rc(top_cmds, u)
+            self.assertEqual(rc.name, 'clarify')
+            self.assertEqual(sorted(rc.args), self.pairwise(top_cmds))
+
+
+class FullClarifyFollowup(unittest.TestCase):
+    def setUp(self):
+        Info.printing = False
+        Debug.printing = False
+        self.frontend = Frontend()
+        self.frontend.set_world(world_objects=[
+            WorldObject(O_FULL_REACHABLE),  # obj0
+            WorldObject(O_FULL_REACHABLE_SECOND),  # obj1
+        ])
+
+    def test_narrows(self):
+        rc, context = self.frontend.parse_followup('pick up')
+        self.assertEqual(sorted(rc.args), ['obj', 'side'])
+        rc, context = self.frontend.parse_followup('the red box', context)
+        self.assertEqual(rc.args, ['side'])
+        rc, context = self.frontend.parse_followup('left-hand', context)
+        self.assertEqual(
+            rc, self.frontend.parse('pick up the red box with your left-hand'))
+        self.assertTrue(context is None)
+
+    def test_fallback(self):
+        rc, context = self.frontend.parse_followup('pick up')
+        self.assertEqual(
+            self.frontend.parse_followup('stop', context)[0].name, 'stop')
+        self.assertEqual(
+            self.frontend.parse_followup('move right-hand up', context)[0],
+            self.frontend.parse('move right-hand up'))
+
+    def test_parse_stateless(self):
+        fresh = Frontend(parser=self.frontend.parser)
+        self.frontend.parse('pick up')
+        for u in ['the red box', 'left-hand']:
+            self.assertEqual(self.frontend.parse(u), fresh.parse(u))
+
+
+class FullFromCommand(unittest.TestCase):
+    def setUp(self):
+        Info.printing = False
+        Debug.printing = False
+        self.parser = Parser()
+        self.parser.set_world([WorldObject(O_FULL_REACHABLE)], Robot())
+
+    def test_phrases(self):
+        self.assertEqual(
+            self.parser.parse('move right-hand up').phrases,
+            ['move', 'right-hand', 'up'])
+        self.assertEqual(
+            self.parser.parse({'open': 0.9, 'left-hand': 0.8}).phrases,
+            ['open', 'left-hand'])
+
+    def test_to_dict(self):
+        rc = self.parser.parse('pick-up the red box')
+        d = json.loads(json.dumps(rc.to_dict()))
+        self.assertEqual(
+            RobotCommand.from_strs(d['name'], d['args'], d['phrases']), rc)
+        self.assertEqual(d['utterance'], 'pick-up the red box')
+        self.assertEqual(d['lang_score'], rc.lang_score)
+
+    def test_lookup(self):
+        for opt in self.parser.options:
+            index, joined = opt.get_phrase_lookup()
+            phrase_sets = opt.get_phrases()
+            self.assertEqual(
+                joined, [' '.join(map(str, ps)) for ps in phrase_sets])
+            for phrase, idxs in index.iteritems():
+                for idx, phrase_set in enumerate(phrase_sets):
+                    self.assertEqual(idx in idxs, phrase in phrase_set)
+
+
+class FullStaticGrammar(unittest.TestCase):
+    def setUp(self):
+        Info.printing = False
+        Debug.printing = False
+        self.parser = Parser()
+        self.objs = [
+            WorldObject(O_FULL_REACHABLE),  # obj0
+            WorldObject(O_FULL_REACHABLE_SECOND),  # obj1
+        ]
+        self.parser.set_world(self.objs, Robot())
+        self.utterances = [
+            'move right-hand up', 'open left-hand', 'stop', 'move',
+            'pick up the red box', 'move left-hand above the blue cup',
+        ]
+
+    def _check_same_as_fresh(self):
+        fresh = Parser()
+        fresh.set_world(self.parser.world_objects, self.parser.robot)
+        for u in self.utterances:
+            rc, fresh_rc = self.parser.parse(u), fresh.parse(u)
+            self.assertEqual(rc, fresh_rc)
+            self.assertEqual(
+                (rc.phrases, rc.score, rc.lang_score),
+                (fresh_rc.phrases, fresh_rc.score, fresh_rc.lang_score))
+
+    def test_world_update(self):
+        stop = [c for c in self.parser.commands if c.name == 'stop']
+        pick_up = [c for c in self.parser.commands if c.name == 'pick_up']
+        self.parser.set_world(world_objects=self.objs[:1])
+        # Object-free commands are kept; the rest are remade.
+        self.assertTrue(stop[0] in self.parser.commands)
+        self.assertFalse(pick_up[0] in self.parser.commands)
+        self._check_same_as_fresh()
+
+    def test_robot_update(self):
+        commands = set(self.parser.commands)
+        for robot in [R_LEFT_PREF, R_ONLY_RIGHT_POSSIBLE, R_RIGHT_PREF]:
+            self.parser.set_world(robot=Robot(robot))
+            self.assertEqual(set(self.parser.commands), commands)
+            self._check_same_as_fresh()
+
+
+class FullSharedGrammar(unittest.TestCase):
+    def setUp(self):
+        Info.printing = False
+        Debug.printing = False
+        self.world = (
+            [
+                WorldObject(O_FULL_REACHABLE),  # obj0
+                WorldObject(O_FULL_REACHABLE_SECOND),  # obj1
+            ],
+            Robot(R_LEFT_PREF))
+
+    def test_shared(self):
+        first, second = Parser(), Parser()
+        self.assertTrue(first.grammar is second.grammar)
+        self.assertTrue(first.grammar is CompiledGrammar.load())
+        frontend = Frontend(grammar=first.grammar)
+        self.assertTrue(frontend.parser.grammar is first.grammar)
+
+    def test_same_as_own(self):
+        own = Parser(grammar=CompiledGrammar(Yaml.load(C.command_grammar)))
+        shared = Parser()
+        self.assertFalse(own.grammar is shared.grammar)
+        own.set_world(*self.world)
+        shared.set_world(*self.world)
+        # Another parser with another world doesn't affect it.
+        Parser().set_world(self.world[0][:1], Robot(R_RIGHT_PREF))
+        for u in S_PICKUP.values() + ['move', 'open left-hand', 'stop']:
+            rc, own_rc = shared.parse(u), own.parse(u)
+            self.assertEqual(rc, own_rc)
+            self.assertEqual(
+                (rc.phrases, rc.score, rc.lang_score),
+                (own_rc.phrases, own_rc.score, own_rc.lang_score))
+
+    def test_name_padding(self):
+        parser = Parser()
+        parser.set_world(*self.world)
+        width = parser.grammar.longest_cmd_name_len
+        for cmd in parser.commands:
+            self.assertEqual(len(cmd._name_str()), width + 2)
+
+    def test_yaml_unmodified(self):
+        # Compiling the grammar copies what it changes.
+        ydict = Yaml.load(C.command_grammar)
+        snapshot = copy.deepcopy(ydict)
+        Frontend().set_world(*self.world)
+        self.assertEqual(ydict, snapshot)
+
+
+class FullLazyFrontend(unittest.TestCase):
+    def setUp(self):
+        Info.printing = False
+        Debug.printing = False
+
+    def test_lazy_parser(self):
+        frontend = Frontend()
+        self.assertTrue(frontend._parser is None)
+        frontend.set_world()
+        self.assertFalse(frontend._parser is None)
+        self.assertEqual(C.side_to_idx[C.sides[1]], 1)
+
+
+class FullSessions(unittest.TestCase):
+    def setUp(self):
+        Info.printing = False
+        Debug.printing = False
+        self.objs = [
+            WorldObject(O_FULL_REACHABLE),  # obj0
+            WorldObject(O_FULL_REACHABLE_SECOND),  # obj1
+        ]
+        self.sessions = SessionManager()
+        self.sessions.set_world('a', self.objs, Robot())
+        self.sessions.set_world('b', self.objs[:1], Robot(R_RIGHT_PREF))
+
+    def test_independent(self):
+        a, b = self.sessions.get('a'), self.sessions.get('b')
+        self.assertTrue(a.parser.grammar is b.parser.grammar)
+        for session in [a, b]:
+            own = Parser()
+            own.set_world(
+                session.parser.world_objects, session.parser.robot)
+            for u in ['pick up the red box', 'move', 'open left-hand']:
+                self.assertEqual(
+                    self.sessions.parse(session.session_id, u),
+                    own.parse(u))
+            self.assertEqual(
+                self.sessions.describe(session.session_id), own.describe())
+
+    def test_clarify_per_session(self):
+        rc = self.sessions.parse('a', 'pick up')
+        self.assertEqual(sorted(rc.args), ['obj', 'side'])
+        self.assertEqual(self.sessions.parse('b', 'stop').name, 'stop')
+        self.assertEqual(self.sessions.parse('a', 'the red box').args, [
+            'side'])
+
+    def test_max_sessions(self):
+        self.sessions.max_sessions = 2
+        self.sessions.get('a')  # Now b is least recently used.
+        self.sessions.get('c')
+        self.assertEqual(self.sessions.sessions.keys(), ['a', 'c'])
+
+    def test_max_idle(self):
+        self.sessions.max_idle = 60.0
+        self.sessions.get('a').last_used -= 120.0
+        self.sessions.get('b')
+        self.assertFalse('a' in self.sessions)
+        self.assertTrue('b' in self.sessions)
+
+    def test_memory(self):
+        usage = self.sessions.memory()
+        self.assertEqual(sorted(usage.keys()), ['a', 'b'])
+        # More objects, more commands.
+        self.assertTrue(usage['a'] > usage['b'] > 0)
+        # Commands without objects are each session's own, and counted.
+        a = self.sessions.sessions['a'].parser.static_commands
+        b = self.sessions.sessions['b'].parser.static_commands
+        for ct, cmds in a.iteritems():
+            self.assertFalse(cmds[0] is b[ct][0])
+        self.assertTrue(usage['b'] > sum([
+            sys.getsizeof(cmd) for cmds in b.values() for cmd in cmds]))
+        self.assertEqual(self.sessions.memory('b'), {'b': usage['b']})
+        # Queries don't make it measure again; world updates do.
+        self.sessions.parse('a', 'pick up the red box')
+        self.sessions.describe('a')
+        self.assertEqual(self.sessions.get('a').size, usage['a'])
+        self.sessions.set_world('a', self.objs[:1])
+        self.assertTrue(self.sessions.get('a').size is None)
+
+        # Over budget: least recently used go first, but not the one
+        # just updated.
+        self.sessions.max_bytes = usage['b']
+        self.sessions.set_world('b', robot=Robot())
+        self.assertEqual(self.sessions.sessions.keys(), ['b'])
+        self.sessions.max_bytes = 1
+        self.sessions.set_world('c', self.objs, Robot())
+        self.assertEqual(self.sessions.sessions.keys(), ['c'])
+
+    def test_no_world(self):
+        # Queries on a new session are empty, and don't stop its world
+        # being set after.
+        self.assertEqual(self.sessions.describe('c'), {})
+        self.assertEqual(self.sessions.ground('c', 'the red box'), {})
+        self.assertEqual(self.sessions.parse_nbest('c', 'move'), [])
+        self.assertTrue(self.sessions.parse('c', 'move') is None)
+        self.sessions.set_world('c', self.objs, Robot())
+        self.assertEqual(
+            self.sessions.describe('c'), self.sessions.describe('a'))
+        self.assertEqual(self.sessions.parse('c', 'stop').name, 'stop')
+
+
+class FullSnapshot(unittest.TestCase):
+    def setUp(self):
+        Info.printing = False
+        Debug.printing = False
+        self.parser = Parser()
+        self.parser.set_world(
+            [
+                WorldObject(O_FULL_REACHABLE),  # obj0
+                WorldObject(O_FULL_REACHABLE_SECOND),  # obj1
+            ],
+            Robot(R_LEFT_PREF))
+
+    def test_restore(self):
+        restored = Parser.from_snapshot(self.parser.snapshot())
+        for u in S_PICKUP.values() + ['move', 'pick-up the blue thing']:
+            self.assertEqual(restored.parse(u), self.parser.parse(u))
+        self.assertEqual(
+            restored.ground('the red box'), self.parser.ground('the red box'))
+        self.assertEqual(restored.describe(), self.parser.describe())
+
+        # Still works after the world changes.
+        robot = Robot(R_RIGHT_PREF)
+        restored.set_world(robot=robot)
+        self.parser.set_world(robot=robot)
+        self.assertEqual(
+            restored.parse('pick-up the box'),
+            self.parser.parse('pick-up the box'))
+
+    def test_pool_from_parser(self):
+        expected = self.parser.parse('pick-up the box')
+        pool = ParserPool(2, self.parser)
+        try:
+            futures = [
+                pool.submit('parse', 'pick-up the box') for i in range(4)]
+            for future in futures:
+                self.assertEqual(future.result(), expected)
+            self.assertEqual(
+                [repr(o) for o in pool.world_objects], ['obj0', 'obj1'])
+        finally:
+            pool.close()
+
+
+class FullPool(unittest.TestCase):
+    def setUp(self):
+        Info.printing = False
+        Debug.printing = False
+        self.pool = ParserPool(2)
+        self.frontend = Frontend(parser=self.pool)
+        self.single = Frontend()
+
+    def tearDown(self):
+        self.pool.close()
+
+    def set_world(self, **kwargs):
+        self.frontend.set_world(**kwargs)
+        self.single.set_world(**kwargs)
+
+    def test_same_results(self):
+        self.set_world(
+            world_objects=[
+                WorldObject(O_FULL_REACHABLE),  # obj0
+                WorldObject(O_FULL_REACHABLE_SECOND),  # obj1
+            ],
+            robot=Robot(R_RIGHT_PREF))
+        utterances = S_PICKUP.values() + ['move', 'pick-up the blue thing']
+        for u in utterances:
+            self.assertEqual(self.frontend.parse(u), self.single.parse(u))
+        self.assertEqual(
+            self.frontend.parse_batch(utterances),
+            self.single.parse_batch(utterances))
+        self.assertEqual(
+            self.frontend.ground('the red box'),
+            self.single.ground('the red box'))
+        self.assertEqual(self.frontend.describe(), self.single.describe())
+
+    def test_world_updates(self):
+        # Each query sees all updates made before it, on any worker.
+        for robot in [R_RIGHT_PREF, R_LEFT_PREF] * 3:
+            self.set_world(
+                world_objects=[WorldObject(O_FULL_REACHABLE)],
+                robot=Robot(robot))
+            futures = [
+                self.pool.submit('parse', 'pick-up the box')
+                for i in range(4)]
+            expected = self.single.parse('pick-up the box')
+            for future in futures:
+                self.assertEqual(future.result(), expected)
+
+    def test_error(self):
+        self.assertRaises(
+            RuntimeError, self.pool.submit('no_such_method').result)
+        # Workers keep going.
+        self.assertEqual(
+            self.frontend.parse('stop'), self.single.parse('stop'))
+
+    def test_failing_query(self):
+        # One worker, so it answers both: a query failing inside the
+        # parser leaves it usable.
+        pool = ParserPool(1)
+        try:
+            pool.set_world([WorldObject(O_FULL_REACHABLE)], Robot())
+            self.single.set_world([WorldObject(O_FULL_REACHABLE)], Robot())
+            self.assertRaises(
+                RuntimeError, pool.submit('parse', None).result, 10.0)
+            self.assertEqual(
+                pool.submit('parse', 'stop').result(10.0),
+                self.single.parse('stop'))
+        finally:
+            pool.close()
+
+    def test_idle_workers_read_updates(self):
+        for robot in [R_RIGHT_PREF, R_LEFT_PREF] * 10:
+            self.pool.set_world(robot=Robot(robot))
+        # Workers read their updates without being queried.
+        start = time.time()
+        while (not all([c.empty() for c in self.pool.controls]) and
+                time.time() - start < 5.0):
+            time.sleep(0.01)
+        self.assertTrue(all([c.empty() for c in self.pool.controls]))
+
+    def test_dead_workers(self):
+        self.set_world(
+            world_objects=[WorldObject(O_FULL_REACHABLE)], robot=Robot())
+        # A query being answered when its worker dies fails.
+        utterances = ['move %d' % (i) for i in range(100000)]
+        future = self.pool.submit('parse_batch', utterances)
+        start = time.time()
+        while (not any([c.value >= 0 for c in self.pool.currents]) and
+                time.time() - start < 5.0):
+            time.sleep(0.001)
+        for worker in self.pool.workers:
+            worker.terminate()
+        self.assertRaises(RuntimeError, future.result, 10.0)
+        # Once none are left, queries fail rather than wait.
+        self.assertRaises(
+            RuntimeError, self.pool.submit('parse', 'stop').result, 10.0)
+
+
 # TODO: This is where we really test the tuning of the system. We need
 #       to have the weights such that impossible AND unpreferred
 #       commands are still returned if the person said them. This
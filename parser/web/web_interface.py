@@ -8,16 +8,21 @@ __author__ = 'mbforbes'
 ########################################################################
 
 # Builtins
+import json
 import os
 import sys
+import time
 import traceback
 import yaml
 
 # 3rd party
-from flask import Flask, render_template, request
+from flask import Flask, Response, jsonify, render_template, request
+from werkzeug.serving import WSGIRequestHandler
 
 # Local
 from parser.core.frontends import WebFrontend
+from parser.core.roslink import WorldObject, Robot
+from parser.core.util import Logger
 
 ########################################################################
 # Globals
@@ -26,6 +31,12 @@ from parser.core.frontends import WebFrontend
 app = Flask(__name__)
 frontend = None
 
+# Seconds between keepalives on idle event streams.
+EVENTS_KEEPALIVE = 15.0
+
+# Replied (409) to JSON API queries made before the world is set.
+NO_WORLD_MSG = 'No world set: POST its objects and robot to /world first.'
+
 
 @app.route('/style.css')
 def style():
@@ -34,55 +45,277 @@ def style():
 
 @app.route('/', methods=['GET', 'POST'])
 def parse():
+    # World objects and robot state are filled in (and kept up to date)
+    # from /events, as are parses made after the page (seq).
     try:
-        objs_str = frontend.get_world_objects_str()
-        robot_str = frontend.get_robot_str()
-
         if request.method == 'POST':
-            if request.form['type'] == 'describe':
-                res = frontend.describe()
-                debug = frontend.get_buffer()
-            elif request.form['type'] == 'ground':
-                data = request.form['groundquery']
-                res = frontend.ground(data)
-                debug = frontend.get_buffer()
-            else:
-                # request.form['type'] == 'parse'
-                data = request.form['inputtext']
-                res = frontend.parse(data)
-                debug = frontend.get_buffer()
+            # Requests are served at once, so each keeps its own log.
+            Logger.start_capture()
+            try:
+                if request.form['type'] == 'describe':
+                    res = frontend.describe()
+                elif request.form['type'] == 'ground':
+                    data = request.form['groundquery']
+                    res = frontend.ground(data)
+                else:
+                    # request.form['type'] == 'parse'
+                    data = request.form['inputtext']
+                    res = frontend.parse(data)
+            finally:
+                log = Logger.stop_capture()
+            debug = '\n'.join([frontend.start_buffer, log])
             return render_template(
                 'template.html',
                 response=str(res),
                 debug=debug,
-                objs=objs_str,
-                robot=robot_str
+                seq=frontend.feed.seq
             )
         else:
             # GET: just show form
-            return render_template(
-                'template.html',
-                objs=objs_str,
-                robot=robot_str
-            )
+            return render_template('template.html', seq=frontend.feed.seq)
     except:
         print traceback.format_exc()
 
 
+@app.route('/events')
+def events():
+    '''Server-sent events: the current world objects, robot and latest
+    parse, then changes to them as they happen. Event types are
+    'object', 'robot' and 'parse'; data is {"key": str, "value": object}
+    (value null means the object was removed). Reconnecting clients get
+    only what they missed, unless they missed too much: then a 'reset'
+    event (forget everything) comes first, then the full state.'''
+    seq = request.headers.get('Last-Event-ID', '0')
+    seq = int(seq) if seq.isdigit() else 0
+    return Response(event_stream(seq), mimetype='text/event-stream')
+
+
+def event_stream(seq):
+    '''
+    Args:
+        seq (int): Last feed sequence number the client saw.
+
+    Yields:
+        str: Server-sent events. Values are already serialized (once
+            per change, by the frontend), so are written as-is.
+    '''
+    while True:
+        seq, changes = frontend.feed.get_since(seq, EVENTS_KEEPALIVE)
+        if len(changes) == 0:
+            yield ': keepalive\n\n'
+        for key_seq, key, value in changes:
+            if key is None:
+                # Starting over (see ChangeFeed.get_since(...)).
+                yield 'event: reset\ndata: {}\n\n'
+                continue
+            yield 'id: %d\nevent: %s\ndata: {"key": %s, "value": %s}\n\n' % (
+                key_seq, key.split('/')[0], json.dumps(key),
+                'null' if value is None else value)
+
+
+########################################################################
+# JSON API
+#
+# Requests are JSON bodies; replies are JSON objects with 'result' and
+# 'timing' ({'seconds': float}). Add "debug": true to a request to also
+# get its log ('debug'); otherwise nothing is logged for it. Errors are
+# replied as {'error': str}; queries made before the world (objects and
+# robot) is set get a 409.
+#
+# Queries go straight to the parser, so they have no side effects:
+# unlike the form, nothing is published (to ROS or /events).
+########################################################################
+
+@app.route('/parse', methods=['POST'])
+def api_parse():
+    '''Body: {"utterance": str} or {"utterances": [str]} (a batch).
+    Result: a RobotCommand (dict), or a list of them.'''
+    return api_query(
+        'utterance', 'utterances', frontend.parser.parse,
+        frontend.parser.parse_batch, lambda rc: rc.to_dict())
+
+
+@app.route('/ground', methods=['POST'])
+def api_ground():
+    '''Body: {"query": str} or {"queries": [str]} (a batch).
+    Result: a map of object name to probability, or a list of them.'''
+    return api_query(
+        'query', 'queries', frontend.parser.ground,
+        frontend.parser.ground_batch, lambda gprobs: gprobs)
+
+
+@app.route('/describe', methods=['GET', 'POST'])
+def api_describe():
+    '''Result: a map of object name to description.'''
+    body = api_body()
+    if body is None:
+        return api_error('Request body must be a JSON object.', 400)
+    if not api_has_world():
+        return api_error(NO_WORLD_MSG, 409)
+    return api_run(frontend.parser.describe, body)
+
+
+@app.route('/world', methods=['GET', 'POST'])
+def api_world():
+    '''GET: result is the world ({"objects": [dict], "robot": dict}).
+    POST body: {"objects": [dict]} and/or {"robot": dict}; sets them,
+    and the result is the new world.'''
+    body = api_body()
+    if body is None:
+        return api_error('Request body must be a JSON object.', 400)
+    if request.method == 'GET':
+        return api_run(frontend.get_world_dict, body)
+
+    def set_world():
+        objs, robot = body.get('objects'), body.get('robot')
+        if objs is not None:
+            objs = WorldObject.from_dicts(objs)
+        if robot is not None:
+            robot = Robot.from_dict(robot)
+        if objs is not None and robot is not None:
+            frontend.set_world(objs, robot)
+        elif objs is not None:
+            frontend.update_objects(objs)
+        elif robot is not None:
+            frontend.update_robot(robot)
+        return frontend.get_world_dict()
+    return api_run(set_world, body)
+
+
+def api_body():
+    '''
+    Returns:
+        {str: object}|None: The request's JSON body ({} if empty); None
+            if it isn't a JSON object.
+    '''
+    if len(request.data) == 0:
+        body = {}
+    else:
+        body = request.get_json(force=True, silent=True)
+    if not isinstance(body, dict):
+        return None
+    if request.args.get('debug') in ['1', 'true']:
+        body['debug'] = True
+    return body
+
+
+def api_query(single_key, batch_key, single_fn, batch_fn, to_json):
+    '''
+    Answers a request for one input (body[single_key]) or a batch
+    (body[batch_key], done with one batch call).
+
+    Args:
+        single_key (str)
+        batch_key (str)
+        single_fn (function): Takes one input.
+        batch_fn (function): Takes a list of inputs.
+        to_json (function): Makes one output serializable.
+
+    Returns:
+        Response
+    '''
+    body = api_body()
+    if body is not None and single_key in body:
+        def query():
+            return to_json(single_fn(body[single_key]))
+    elif body is not None and isinstance(body.get(batch_key), list):
+        def query():
+            return [to_json(res) for res in batch_fn(body[batch_key])]
+    else:
+        return api_error(
+            'Request body must be {"%s": ...} or {"%s": [...]}.' % (
+                single_key, batch_key),
+            400)
+    if not api_has_world():
+        return api_error(NO_WORLD_MSG, 409)
+    return api_run(query, body)
+
+
+def api_has_world():
+    '''
+    Returns:
+        bool: Whether the parser's world objects and robot are set
+            (queries before then have no result).
+    '''
+    return (
+        frontend.parser.world_objects is not None and
+        frontend.parser.robot is not None)
+
+
+def api_run(fn, body):
+    '''
+    Args:
+        fn (function): Makes the (serializable) result.
+        body ({str: object}): The request; logs only if its 'debug'.
+
+    Returns:
+        Response
+    '''
+    # Requests are served at once, so each keeps its own log.
+    debug = body.get('debug', False)
+    if debug:
+        Logger.start_capture()
+    else:
+        Logger.mute()
+    start = time.time()
+    try:
+        res = fn()
+    except:
+        print traceback.format_exc()
+        return api_error(traceback.format_exc().splitlines()[-1], 500)
+    finally:
+        Logger.mute(False)
+        log = Logger.stop_capture()
+    reply = {'result': res, 'timing': {'seconds': time.time() - start}}
+    if debug:
+        reply['debug'] = log
+    return jsonify(reply)
+
+
+def api_error(msg, code):
+    '''
+    Args:
+        msg (str)
+        code (int): HTTP status code.
+
+    Returns:
+        Response
+    '''
+    resp = jsonify({'error': msg})
+    resp.status_code = code
+    return resp
+
+
 def main(args=[]):
-    # Check args
-    useros = len(args) == 0 or args[0] != 'noros'
+    # Check args: [noros] [pool [N]]
+    useros = 'noros' not in args
+    usepool = 'pool' in args
+    n_workers = None
+    if usepool:
+        idx = args.index('pool')
+        if idx + 1 < len(args) and args[idx + 1].isdigit():
+            n_workers = int(args[idx + 1])
 
-    # Make parser frontend, enabling ROS if desired.
+    # Make parser frontend, enabling ROS if desired. With a pool, each
+    # worker process has its own parser, so requests are served in
+    # parallel.
     global frontend
-    frontend = WebFrontend()
+    parser = None
+    if usepool:
+        # Build the parser once; workers start from it.
+        from parser.core.hybridbayes import Parser
+        from parser.core.pool import ParserPool
+        parser = ParserPool(n_workers, Parser())
+    frontend = WebFrontend(parser)
     if useros:
         frontend.startup_ros(spin=False)
     else:
         frontend.set_default_world()
 
-    # Serve
-    app.run(debug=True, use_reloader=False)
+    # Serve. HTTP/1.1 keeps connections alive for polling API clients,
+    # so serve each on its own thread.
+    WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+    app.run(debug=True, use_reloader=False, threaded=True)
 
 
 if __name__ == '__main__':